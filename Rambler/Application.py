@@ -1,8 +1,10 @@
+import errno
 import pwd
 import os
 import signal
 import socket
 import sys
+import time
 import traceback
 
 from hashlib import md5
@@ -19,6 +21,8 @@ from Rambler.SessionRegistry import SessionRegistry
 
 from Rambler.LoggingExtensions  import LogService
 from Rambler.RunLoop import RunLoop, Port
+from Rambler.ThreadStorageService import ThreadStorageService
+from Rambler.Watchdog import Watchdog
 
 
 from Rambler.twistedlogging import  StdioOnnaStick
@@ -109,12 +113,18 @@ class Application(object):
     CONFIG_MODIFIED   = 1
     CONFIG_MISSING    = 2
 
+    # seconds workers are given to shutdown in pre-fork mode before
+    # they're killed
+    drainTimeout = 30
+
     
 
     __slots__ = ['name', 'config','appDir', 'pidPath', 'configFile', 'context',
                  'status', 'configError', 'digest',
                  'deferred', '_dh','scheduler',
                  'appBundle','mainRunLoop',
+                 'workers', 'workerRunLoop', 'draining', 'previousSigChild',
+                 'watchdog', 'configSource',
                  ]
 
 
@@ -129,6 +139,16 @@ class Application(object):
         self.digest = ""
         self.name = os.path.basename(os.path.abspath(appDir))
 
+        # pid -> start time of the worker processes, only used in
+        # pre-fork mode
+        self.workers = {}
+        self.workerRunLoop = None
+        self.draining = False
+        self.previousSigChild = None
+        self.watchdog = None
+        # holds the extension options, reload() swaps in new ones
+        self.configSource = None
+
         if not authoritativeOptions:
             authoritativeOptions = {}
         authoritativeOptions['application.name'] =  self.name
@@ -301,6 +321,12 @@ class Application(object):
         self.config = Config(extensions)
     
 
+    def extensionOptions(self):
+        options = {}
+        for extension in self.config.extensions:
+            options[extension.name] = extension.options
+        return options
+
     def getConfigStatus(self):
         md5sum = md5()
 
@@ -376,11 +402,8 @@ class Application(object):
 
 
 
-            options = {}
-            for extension in self.config.extensions:
-                options[extension.name] = extension.options
-
-            self.configService.addConfigSource(DictConfigSource(options))
+            self.configSource = DictConfigSource(self.extensionOptions())
+            self.configService.addConfigSource(self.configSource)
 
             compReg.bind()
 
@@ -479,6 +502,12 @@ class Application(object):
 
     def shutdown(self):
         runLoop = self.mainRunLoop
+        if self.workers:
+            # we're supervising workers, they shutdown first
+            if not self.draining:
+                self.drainWorkers()
+            return
+
         if self.status ==  Application.STARTED:
 
             self.log.info("Shutdown requested")
@@ -504,6 +533,118 @@ class Application(object):
             runLoop.callFromThread(self.shutdown)
 
 
+    ## Pre-fork mode ##
+
+    def prefork(self, workers):
+        """Runs the loaded application in pre-fork mode. Returns the
+        exit status once the application has shutdown.
+
+        Every port the application opened while loading is inherited
+        by the worker processes, each running it's own copy of the
+        RunLoop. This process stays behind to supervise. It restarts
+        workers that die, passes SIGHUP on to them and when asked to
+        shutdown gives them drainTimeout seconds to do the same before
+        killing them.
+        """
+
+        if self.workers:
+            raise AppErrLoaded('The application is already running in pre-fork mode.')
+
+        # The RunLoop the app loaded into is left untouched, so
+        # workers restarted later on fork a pristine copy of it. We
+        # supervise from a RunLoop of our own.
+        self.workerRunLoop = self.mainRunLoop
+        self.mainRunLoop = (RunLoop.implementation or RunLoop)()
+        ThreadStorageService.addToCurrent('RunLoop', self.mainRunLoop)
+        if self.watchdog:
+            self.watchdog.unwatch(self.workerRunLoop)
+            self.watchdog.watch(self.mainRunLoop)
+
+        self.previousSigChild = signal.signal(signal.SIGCHLD, self.onSigChild)
+
+        for x in range(workers):
+            self.spawnWorker()
+
+        # catches any exits we missed a SIGCHLD for and keeps our
+        # RunLoop from running out of things to do
+        self.mainRunLoop.intervalBetweenCalling(1, self.reapChildren)
+        self.mainRunLoop.run()
+        return 0
+
+    def spawnWorker(self):
+        if self.draining:
+            return
+
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.time()
+            return pid
+
+        # we're the worker, this method never returns
+        status = 0
+        try:
+            signal.signal(signal.SIGCHLD,
+                          self.previousSigChild or signal.SIG_DFL)
+            supervisor = self.mainRunLoop
+            supervisor.waker.close()
+            supervisor.poller.close()
+
+            self.workers = {}
+            self.mainRunLoop = self.workerRunLoop
+            ThreadStorageService.addToCurrent('RunLoop', self.mainRunLoop)
+            self.mainRunLoop.afterFork()
+            if self.watchdog:
+                # threads don't survive the fork, we need our own
+                threshold = self.watchdog.threshold
+                self.watchdog = None
+                self.watchForStalls(threshold)
+            self.mainRunLoop.run()
+        except:
+            self.log.exception("Worker %s crashed", os.getpid())
+            status = 255
+        os._exit(status)
+
+    def watchForStalls(self, threshold):
+        """Starts a Watchdog that logs the stack of the main RunLoop
+        whenever it's been busy with one pass for threshold seconds."""
+        if self.watchdog:
+            self.watchdog.stop()
+        self.watchdog = Watchdog(threshold, log=self.log)
+        self.watchdog.watch(self.mainRunLoop)
+        self.watchdog.start()
+
+    def signalWorkers(self, signum):
+        for pid in self.workers.keys():
+            try:
+                os.kill(pid, signum)
+            except OSError, e:
+                # exited, we'll hear about it from reapChildren
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def drainWorkers(self):
+        self.log.info("Shutting down %s workers", len(self.workers))
+        self.draining = True
+        self.signalWorkers(signal.SIGTERM)
+        self.mainRunLoop.waitBeforeCalling(self.drainTimeout,
+                                           self.signalWorkers, signal.SIGKILL)
+
+    def onWorkerExit(self, pid, status):
+        started = self.workers.pop(pid)
+        if self.draining:
+            if not self.workers:
+                # all done, now it's our turn
+                self.shutdown()
+            return
+
+        self.log.error("Worker %s exited unexpectedly with status %s, restarting",
+                       pid, status)
+        if time.time() - started < 1:
+            # don't spin if workers die as soon as they start
+            self.mainRunLoop.waitBeforeCalling(1, self.spawnWorker)
+        else:
+            self.spawnWorker()
+
     # ASYNC event listeners
 
     def sighandler(self, signum, frame):
@@ -522,22 +663,52 @@ class Application(object):
 
     def onSigChild(self, signum, frame):
         self.mainRunLoop.callFromThread(self.reapChildren)
+        # children that aren't workers, Tasks for instance, are reaped
+        # by whoever was handling SIGCHLD before us
+        if callable(self.previousSigChild):
+            self.previousSigChild(signum, frame)
 
     def reapChildren(self):
-        while(1):
-            # keep calling waitpid, until it throws error 10, which
-            # means their are no more dead children to reap.
+        # only wait on the workers, waitpid(-1) would steal the exit
+        # status of children that somebody else is waiting on
+        for pid in self.workers.keys():
             try:
-                os.waitpid(0,0)
+                exited, status = os.waitpid(pid, os.WNOHANG)
             except OSError, e:
-                if e.errno == 10:
-                    break
-                else:
+                if e.errno != errno.ECHILD:
                     raise
+                # already reaped, all we know is that it's gone
+                exited, status = pid, None
+
+            if exited:
+                self.onWorkerExit(pid, status)
 
     def onSigHUP(self, signum, frame):
-      pass
-      #self.mainRunLoop.callFromThread(self.reattach)
+      self.mainRunLoop.callFromThread(self.reload)
+
+    def reload(self):
+        """Re-reads the config file and applies the extension options
+        to the running app. In pre-fork mode the supervisor passes the
+        SIGHUP on to the workers and they each reload themselves.
+
+        Extensions can't be loaded or unloaded while running, a change
+        to which extensions are installed needs a restart.
+        """
+        if self.workers:
+            self.signalWorkers(signal.SIGHUP)
+            return
+
+        loaded = set([extension.name for extension in self.config.extensions])
+        try:
+            self.loadConfig()
+        except AppMisconfigured, e:
+            self.log.error("Ignoring SIGHUP, %s", e)
+            return
+
+        if loaded != set([extension.name for extension in self.config.extensions]):
+            self.log.warn("Extensions changed, restart %s to load them", self.name)
+        if self.configSource is not None:
+            self.configSource.data = self.extensionOptions()
 
 
     def onMessage(self, context, subject):
@@ -617,6 +788,15 @@ def main():
     parser.add_option("-o", action="append", dest="options",
                       default=[], help='Set extension option -o "section:key=value"')
 
+    parser.add_option("-w", dest="workers", type="int", default=0,
+                      help="Pre-fork this many worker processes to service requests")
+
+    parser.add_option("-s", dest="stallTime", type="float", default=0,
+                      help="Log the stack of the RunLoop whenever it's been blocked for this many seconds")
+
+    parser.add_option("-a", dest="asyncio", action="store_true", default=False,
+                      help="Run the RunLoop on an asyncio event loop")
+
 
     (options, args) = parser.parse_args()
 
@@ -721,6 +901,11 @@ def main():
         except OSError:   # ERROR (ignore)
             pass
 
+    if options.asyncio:
+        # has to be chosen before anything asks for the current RunLoop
+        from Rambler.AsyncioRunLoop import AsyncioRunLoop
+        RunLoop.implementation = AsyncioRunLoop
+
     app = Application(appBundlePath,
                       authoritativeOptions=authoritativeOptions)
   
@@ -745,7 +930,12 @@ def main():
         app.log.exception("Exception encountred while loading as a subprocess")
         return 1
 
+    if options.stallTime:
+        app.watchForStalls(options.stallTime)
+
     try:
+        if options.workers:
+            return app.prefork(options.workers)
         RunLoop.currentRunLoop().run()
     except:
         app.log.exception("Unhandled exception encuntered in runLoop")
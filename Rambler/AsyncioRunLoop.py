@@ -0,0 +1,357 @@
+"""A RunLoop that runs on an asyncio event loop.
+
+AsyncioRunLoop keeps the RunLoop interface, so Ports, Streams, Tasks,
+DelayedCalls and coroutine operations work unchanged, but hands the
+descriptors and timers to an asyncio event loop rather than polling
+them itself. Libraries written for asyncio can then share the thread
+with Rambler components, no second event loop and no hopping between
+threads with callFromThread().
+
+On python 2 the trollius port of asyncio is used.
+
+To have RunLoop.currentRunLoop() create them, choose it before anything
+asks for a RunLoop, ramblerapp's -a option does this.
+
+  >> RunLoop.implementation = AsyncioRunLoop
+
+The asyncio loop defaults to the thread's event loop, pass one in to
+use another.
+
+Unlike a native RunLoop's, run() isn't one pass after another, it
+hands the thread over to the asyncio loop until stop() is called or
+there's nothing left to monitor. Callbacks asyncio libraries register
+themselves run as usual in between.
+"""
+
+import sys
+import thread
+import time
+
+try:
+  import asyncio
+except ImportError:
+  try:
+    import trollius as asyncio
+  except ImportError:
+    asyncio = None
+
+from Rambler.RunLoop import (RunLoop, DelayedCall, SelectPoller, TimeoutSweeper,
+                             CallQueue)
+
+
+class AsyncioTimers(object):
+  """Stands in for a RunLoop's TimingWheel, scheduling each timer with
+  the asyncio loop's call_at()."""
+
+  def __init__(self, runLoop):
+    self.runLoop = runLoop
+    # id(timer) -> (asyncio handle, timer)
+    self.handles = {}
+    self.cancelledCount = 0
+    self.firedCount = 0
+
+  def __len__(self):
+    return len(self.handles)
+
+  @property
+  def live(self):
+    return len(self.handles)
+
+  def add(self, timer):
+    """Schedules the timer, or moves it if it's already scheduled."""
+    self._unlink(timer)
+    loop = self.runLoop.loop
+    # timers keep wall clock time, asyncio keeps it's own
+    when = loop.time() + (timer.time - time.time())
+    handle = loop.call_at(when, self.fire, timer)
+    self.handles[id(timer)] = (handle, timer)
+    if isinstance(timer, DelayedCall):
+      timer.wheel = self
+    return timer
+
+  def remove(self, timer):
+    return self._unlink(timer)
+
+  def cancel(self, timer):
+    if self._unlink(timer):
+      self.cancelledCount += 1
+
+  def _unlink(self, timer):
+    entry = self.handles.pop(id(timer), None)
+    if entry is None:
+      return False
+    entry[0].cancel()
+    return True
+
+  def timers(self):
+    return [timer for handle, timer in self.handles.values()]
+
+  def clear(self):
+    for handle, timer in self.handles.values():
+      handle.cancel()
+    self.handles.clear()
+
+  def fire(self, timer):
+    self.handles.pop(id(timer), None)
+    if timer.cancelled:
+      self.cancelledCount += 1
+      return
+    self.firedCount += 1
+    self.runLoop.lag.tally(max(time.time() - timer.time, 0))
+    self.runLoop.dispatch('timer', timer.onTimeout)
+
+
+class LoopWaker(object):
+  """Stands in for the RunLoop's Waker. Rather than writing to a
+  descriptor it has the asyncio loop drain the RunLoop's
+  threadCallQueue with call_soon_threadsafe(), once however many
+  wakeups arrive before the drain. Keeps the sleeping flag the
+  Watchdog looks at."""
+
+  def __init__(self, runLoop):
+    self.runLoop = runLoop
+    self.sleeping = True
+    self.pending = False
+    # True from the time a drain is scheduled until it starts
+    self.signaled = False
+    self.requested = 0
+    self.sent = 0
+
+  def __repr__(self):
+    return "<loop waker>"
+
+  def wakeup(self):
+    self.requested += 1
+    if not self.signaled:
+      self.signaled = True
+      self.sent += 1
+      self.runLoop.loop.call_soon_threadsafe(self.runLoop.runCalls)
+
+  def close(self):
+    pass
+
+
+class AsyncioRunLoop(RunLoop):
+
+  # the asyncio loop does the polling, don't tie up a descriptor
+  pollerClass = SelectPoller
+
+  def __init__(self, loop=None):
+    if loop is None:
+      if asyncio is None:
+        raise RuntimeError("AsyncioRunLoop needs asyncio, or trollius on python 2")
+      try:
+        loop = asyncio.get_event_loop()
+      except (RuntimeError, AssertionError):
+        # only the main thread gets one for free
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+    self.loop = loop
+
+    # True while runOnce() is waiting for a single callback
+    self.once = False
+    # exc_info of a callback that raised, re-raised by run()
+    self.error = None
+
+    RunLoop.__init__(self)
+    self.timers = AsyncioTimers(self)
+    # the asyncio loop is woken for us, the Watchdog treats us as
+    # asleep unless we're dispatching
+    self.removeReader(self.waker)
+    self.waker.close()
+    self.waker = LoopWaker(self)
+
+  def dispatch(self, kind, f, *args):
+    self.waker.sleeping = False
+    self.progress += 1
+    try:
+      try:
+        if self.stats:
+          self.stats.call(kind, f, *args)
+        else:
+          f(*args)
+      except Exception:
+        self.error = sys.exc_info()
+        self.loop.stop()
+    finally:
+      self.waker.sleeping = True
+      if self.once or not self._shouldRun(0):
+        self.loop.stop()
+
+  def addReader(self, source, persistent=False):
+    fd = source.fileno()
+    self.readers[fd] = source
+    if persistent:
+      self.persistentReaders.add(fd)
+    else:
+      self.persistentReaders.discard(fd)
+    self.loop.add_reader(fd, self.readReady, fd)
+
+  def removeReader(self, source):
+    fd = source.fileno()
+    self.persistentReaders.discard(fd)
+    try:
+      del self.readers[fd]
+    finally:
+      self.loop.remove_reader(fd)
+
+  def addWriter(self, source, persistent=False):
+    fd = source.fileno()
+    self.writers[fd] = source
+    if persistent:
+      self.persistentWriters.add(fd)
+    else:
+      self.persistentWriters.discard(fd)
+    self.loop.add_writer(fd, self.writeReady, fd)
+
+  def removeWriter(self, source):
+    fd = source.fileno()
+    self.persistentWriters.discard(fd)
+    try:
+      del self.writers[fd]
+    finally:
+      self.loop.remove_writer(fd)
+
+  def readReady(self, fd):
+    if fd in self.persistentReaders:
+      source = self.readers.get(fd)
+    else:
+      # sources that aren't persistent have to add themselves back
+      source = self.readers.pop(fd, None)
+      self.loop.remove_reader(fd)
+    if source is not None:
+      self.dispatch('read', source.canRead, source)
+
+  def writeReady(self, fd):
+    if fd in self.persistentWriters:
+      source = self.writers.get(fd)
+    else:
+      source = self.writers.pop(fd, None)
+      self.loop.remove_writer(fd)
+    if source is not None:
+      self.dispatch('write', source.canWrite, source)
+
+  def addTimer(self, timer):
+    if thread.get_ident() != self.threadCallQueue.owner:
+      # call_at() isn't thread safe
+      self.loop.call_soon_threadsafe(self.timers.add, timer)
+      return timer
+    return self.timers.add(timer)
+
+  def runCalls(self):
+    # callFromThread() queues calls on the threadCallQueue like any
+    # RunLoop, the waker has us make them a batch at a time
+    self.waker.signaled = False
+    calls = self.threadCallQueue.drain(self.callBatchSize)
+    deadline = self._sliceEnd(self.callTimeSlice)
+    tried = 0
+    for f, args, kw in calls:
+      if self.error or (deadline and tried and time.time() >= deadline):
+        break
+      tried += 1
+      if kw:
+        self.dispatch('thread', lambda f=f, args=args, kw=kw: f(*args, **kw))
+      else:
+        self.dispatch('thread', f, *args)
+    if tried < len(calls):
+      # a call raised or we ran out of time, the rest go back on the
+      # front of the queue
+      self.threadCallQueue.requeue(calls[tried:])
+    if self.threadCallQueue and not self.error:
+      self.waker.wakeup()
+
+  def runLoop(self):
+    # runs the asyncio loop until a callback stops it, re-raising
+    # anything the callback raised
+    self.error = None
+    self.threadCallQueue.owner = thread.get_ident()
+    if self.threadCallQueue:
+      # calls left over when one of them raised
+      self.waker.wakeup()
+    self.active = True
+    try:
+      self.loop.run_forever()
+    finally:
+      self.active = False
+    if self.error:
+      error, self.error = self.error, None
+      raise error[0], error[1], error[2]
+
+  def runOnce(self):
+    """Waits for and makes a single callback."""
+    self.once = True
+    try:
+      if self._shouldRun(0):
+        self.runLoop()
+    finally:
+      self.once = False
+
+  def run(self, reset_on_stop=True):
+    if self.running:
+      raise RuntimeError("RunLoop is already running.")
+    self.running = True
+
+    while self._shouldRun(0):
+      try:
+        self.runLoop()
+      except Exception, e:
+        self.log.exception("Caught unexpected error in RunLoop.")
+        self.handleException(e)
+
+    if reset_on_stop:
+      self.reset()
+
+  def _shouldRun(self, timerCapacity):
+    # we're driven by run() or runOnce(), both need something to wait on
+    return ((self.running or self.once) and
+            (len(self.readers) + len(self.writers) > 0 or
+             len(self.timers) > timerCapacity or self.threadCallQueue))
+
+  def stop(self):
+    self.running = False
+    self.loop.call_soon_threadsafe(self.loop.stop)
+
+  def reset(self):
+    """Forgets every descriptor and timer, the asyncio loop is left
+    running for anybody else using it."""
+    self.running = False
+    for fd in self.readers.keys():
+      self.loop.remove_reader(fd)
+    for fd in self.writers.keys():
+      self.loop.remove_writer(fd)
+    self.readers = {}
+    self.writers = {}
+    self.persistentReaders = set()
+    self.persistentWriters = set()
+    self.timers.clear()
+    # the old sweeper's timer went with the rest
+    self.sweeper = TimeoutSweeper(self)
+    self.threadCallQueue.clear()
+
+  def afterFork(self):
+    """Moves everything over to a new asyncio loop, the parent's is no
+    good to a forked child."""
+    readers, writers = self.readers, self.writers
+    persistentReaders = self.persistentReaders
+    persistentWriters = self.persistentWriters
+    timers = self.timers.timers()
+    self.timers.handles.clear()
+
+    self.loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(self.loop)
+    # calls queued for the parent are dropped, a thread in the parent
+    # could have been holding the queue's lock
+    self.threadCallQueue = CallQueue(self.callQueueSize, self.callQueuePolicy)
+    self.waker = LoopWaker(self)
+    self.running = False
+    self.readers = {}
+    self.writers = {}
+    self.persistentReaders = set()
+    self.persistentWriters = set()
+
+    for fd, source in readers.items():
+      self.addReader(source, fd in persistentReaders)
+    for fd, source in writers.items():
+      self.addWriter(source, fd in persistentWriters)
+    for timer in timers:
+      self.timers.add(timer)
@@ -0,0 +1,319 @@
+"""Splits the bytes read from a Port into frames.
+
+Protocols built directly on Port have to cope with short reads, the
+data for one message can show up over several calls to onRead() and
+one call can hold several messages. A Framer sits between the Port and
+the protocol's delegate, it keeps a single growing buffer per
+connection, reads into it and calls the delegate's onFrame(port,
+frame) once for every complete frame. Everything else the Port tells
+it is passed straight on to the delegate.
+
+  >>> class Echo(object):
+  ...   def onFrame(self, port, frame):
+  ...     print repr(frame)
+  ...   def onClose(self, port):
+  ...     pass
+
+  >>> framer = DelimiterFramer(Echo(), '\\n')
+
+Framers are the Port's delegate, they start reading as soon as the
+port is accepted or connects.
+
+  >>> import socket
+  >>> ours, theirs = socket.socketpair()
+  >>> port = Port(None, framer)
+  >>> port.connectionAccepted(ours)
+
+  >>> framer.onRead(port, 'hello\\nwor')
+  'hello'
+  False
+  >>> framer.onRead(port, 'ld\\n')
+  'world'
+  False
+
+Framers can write frames as well. The pieces go out in one writev() so
+nothing is copied to glue them together.
+
+  >>> framer.writeFrame(port, 'hi')
+  >>> len(port.writebuffer)
+  3
+"""
+
+import socket
+import struct
+
+from Rambler.RunLoop import Port
+
+
+class FrameError(Exception):
+  """Raised when the other end sends something that can't be framed."""
+
+
+class FrameBuffer(object):
+  """Bytes read from one connection that haven't been framed yet."""
+
+  def __init__(self):
+    self.data = bytearray()
+    # where the next frame starts
+    self.start = 0
+    # where to resume looking for a delimiter
+    self.scan = 0
+    # used by ChunkedFramer
+    self.state = None
+    self.chunkSize = 0
+
+  def __len__(self):
+    return len(self.data) - self.start
+
+  def compact(self):
+    # drops the frames we've handed out, once per read rather than
+    # once per frame
+    if self.start:
+      del self.data[:self.start]
+      self.scan = max(self.scan - self.start, 0)
+      self.start = 0
+
+  def take(self, start, end):
+    # the bytes between start and end copied out once
+    return str(buffer(self.data, start, end - start))
+
+
+class Framer(object):
+  """Base class for Port delegates that frame what they read.
+
+  Subclasses implement parse() which takes as many complete frames as
+  it can off the front of the FrameBuffer, passing each to
+  frameReceived(), and writeFrame().
+  """
+
+  # most bytes asked for with each read
+  readSize = 65536
+  # a frame bigger than this closes the connection with a FrameError
+  maxFrameSize = 16 << 20
+
+  def __init__(self, delegate):
+    self.delegate = delegate
+    # port -> FrameBuffer
+    self.buffers = {}
+
+  def __getattr__(self, name):
+    # the rest of the Port delegate protocol goes straight through
+    if name == 'delegate':
+      raise AttributeError(name)
+    return getattr(self.delegate, name)
+
+  def onAccept(self, port):
+    self.startReading(port)
+    if hasattr(self.delegate, 'onAccept'):
+      self.delegate.onAccept(port)
+
+  def onConnect(self, port):
+    self.startReading(port)
+    if hasattr(self.delegate, 'onConnect'):
+      self.delegate.onConnect(port)
+
+  def startReading(self, port):
+    self.buffers[port] = FrameBuffer()
+    port.read(self.readSize)
+
+  def onRead(self, port, data):
+    buffer = self.buffers.get(port)
+    if buffer is None:
+      buffer = self.buffers[port] = FrameBuffer()
+    buffer.data += data
+
+    try:
+      self.parse(port, buffer)
+    except FrameError, e:
+      self.buffers.pop(port, None)
+      port.close()
+      self.delegate.onError(port, e)
+      return False
+
+    buffer.compact()
+    if self.isReading(port):
+      port.read(self.readSize)
+    # short reads are expected, we've asked for more either way
+    return False
+
+  def onClose(self, port):
+    self.buffers.pop(port, None)
+    if hasattr(self.delegate, 'onClose'):
+      self.delegate.onClose(port)
+
+  def onError(self, port, error):
+    self.buffers.pop(port, None)
+    self.delegate.onError(port, error)
+
+  def isReading(self, port):
+    # whether frames should still be handed out for the port, the
+    # buffer goes once it's closed
+    return port in self.buffers and not getattr(port, 'closing', False)
+
+  def frameReceived(self, port, frame):
+    self.delegate.onFrame(port, frame)
+
+  def parse(self, port, buffer):
+    raise NotImplementedError
+
+  def writeFrame(self, port, data):
+    raise NotImplementedError
+
+  def checkSize(self, size):
+    if size > self.maxFrameSize:
+      raise FrameError("Frame of %s bytes is larger than %s"
+                       % (size, self.maxFrameSize))
+
+
+class LengthPrefixFramer(Framer):
+  """Frames that start with their length, not counting the prefix,
+  packed using the struct format prefix. The default is a 4 byte
+  unsigned int in network order.
+
+  >>> class Printer(object):
+  ...   def onFrame(self, port, frame):
+  ...     print repr(frame)
+  >>> framer = LengthPrefixFramer(Printer(), '!H')
+  >>> port = Port(None, framer)
+  >>> port.connectionAccepted(socket.socketpair()[0])
+  >>> framer.onRead(port, '\\x00\\x02hi\\x00\\x05he')
+  'hi'
+  False
+  >>> framer.onRead(port, 'llo')
+  'hello'
+  False
+  """
+
+  def __init__(self, delegate, prefix='!I'):
+    Framer.__init__(self, delegate)
+    self.header = struct.Struct(prefix)
+
+  def parse(self, port, buffer):
+    data = buffer.data
+    size = self.header.size
+    end = len(data)
+    start = buffer.start
+    while end - start >= size and self.isReading(port):
+      length, = self.header.unpack_from(data, start)
+      self.checkSize(length)
+      if end - start - size < length:
+        break
+      frameStart = start + size
+      start = buffer.start = frameStart + length
+      self.frameReceived(port, buffer.take(frameStart, start))
+
+  def writeFrame(self, port, data):
+    port.write(self.header.pack(len(data)))
+    port.write(data)
+
+
+class DelimiterFramer(Framer):
+  """Frames that end with delimiter, lines by default. The delimiter
+  isn't included in the frames handed to the delegate."""
+
+  def __init__(self, delegate, delimiter='\r\n'):
+    Framer.__init__(self, delegate)
+    self.delimiter = delimiter
+
+  def parse(self, port, buffer):
+    data = buffer.data
+    width = len(self.delimiter)
+    while self.isReading(port):
+      end = data.find(self.delimiter, max(buffer.scan, buffer.start))
+      if end < 0:
+        # the start of the delimiter could be at the end
+        buffer.scan = max(len(data) - width + 1, buffer.start)
+        self.checkSize(len(buffer))
+        break
+      start = buffer.start
+      buffer.start = buffer.scan = end + width
+      self.frameReceived(port, buffer.take(start, end))
+
+  def writeFrame(self, port, data):
+    port.write(data)
+    port.write(self.delimiter)
+
+
+class ChunkedFramer(Framer):
+  """Frames sent with HTTP/1.1 chunked transfer encoding, each chunk is
+  a frame. The last chunk of a message is handed to the delegate as an
+  empty frame once it's trailers, which are ignored, have been read.
+  The next message can follow straight after.
+
+  >>> class Printer(object):
+  ...   def onFrame(self, port, frame):
+  ...     print repr(frame)
+  >>> framer = ChunkedFramer(Printer())
+  >>> port = Port(None, framer)
+  >>> port.connectionAccepted(socket.socketpair()[0])
+  >>> framer.onRead(port, '5\\r\\nhello\\r\\n0\\r\\n\\r\\n')
+  'hello'
+  ''
+  False
+  """
+
+  SIZE, DATA, TRAILER = range(3)
+
+  # longest chunk size or trailer line we'll wait for
+  maxLineSize = 4096
+
+  def line(self, buffer):
+    # returns the next line, None if we don't have all of it yet
+    end = buffer.data.find('\r\n', max(buffer.scan, buffer.start))
+    if end < 0:
+      if len(buffer) > self.maxLineSize:
+        raise FrameError("Line longer than %s bytes" % self.maxLineSize)
+      buffer.scan = max(len(buffer.data) - 1, buffer.start)
+      return None
+    line = buffer.take(buffer.start, end)
+    buffer.start = buffer.scan = end + 2
+    return line
+
+  def parse(self, port, buffer):
+    if buffer.state is None:
+      buffer.state = self.SIZE
+
+    while self.isReading(port):
+      if buffer.state == self.SIZE:
+        line = self.line(buffer)
+        if line is None:
+          break
+        try:
+          size = int(line.split(';', 1)[0].strip(), 16)
+        except ValueError:
+          raise FrameError("Bad chunk size %r" % line)
+        self.checkSize(size)
+        if size:
+          buffer.chunkSize = size
+          buffer.state = self.DATA
+        else:
+          buffer.state = self.TRAILER
+
+      elif buffer.state == self.DATA:
+        size = buffer.chunkSize
+        if len(buffer) < size + 2:
+          break
+        start = buffer.start
+        if buffer.take(start + size, start + size + 2) != '\r\n':
+          raise FrameError("Chunk isn't followed by CRLF")
+        buffer.start = buffer.scan = start + size + 2
+        buffer.state = self.SIZE
+        self.frameReceived(port, buffer.take(start, start + size))
+
+      else:
+        line = self.line(buffer)
+        if line is None:
+          break
+        if not line:
+          # end of the message
+          buffer.state = self.SIZE
+          self.frameReceived(port, '')
+
+  def writeFrame(self, port, data):
+    """Writes data as a chunk, an empty string ends the message."""
+    if data:
+      port.write('%x\r\n' % len(data))
+      port.write(data)
+      port.write('\r\n')
+    else:
+      port.write('0\r\n\r\n')
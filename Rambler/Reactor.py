@@ -0,0 +1,141 @@
+"""Spreads a listening Port across several RunLoops.
+
+A Port only accepts connections on the RunLoop that called listen()
+and the accepted Ports are serviced by that same RunLoop. The Reactor
+starts a thread per RunLoop, each listening on the same address with
+SO_REUSEPORT, and lets the kernel balance incoming connections
+between them.
+
+  >>> class Echo(object):
+  ...   def onAccept(self, port):
+  ...     port.read(1024)
+  ...   def onRead(self, port, data):
+  ...     port.write(data)
+  ...     port.read(1024)
+  ...   def onWrite(self, port, bytes):
+  ...     pass
+  ...   def onClose(self, port):
+  ...     pass
+
+  >>> reactor = Reactor(('127.0.0.1', 0), Echo, loops=2)
+  >>> reactor.start()
+  >>> len(reactor.load())
+  2
+  >>> reactor.stop()
+
+Keep in mind python threads share the interpreter lock, the Reactor
+helps services that spend their time waiting on the network. Spread
+CPU bound work across processes instead.
+"""
+
+import threading
+
+from Rambler.RunLoop import RunLoop, Port
+
+
+class ReactorLoop(threading.Thread):
+  """Thread running one of the Reactor's RunLoops."""
+
+  def __init__(self, reactor, index):
+    threading.Thread.__init__(self, name="%s-%s" % (reactor.name, index))
+    self.setDaemon(True)
+    self.reactor = reactor
+    self.runLoop = None
+    self.port = None
+    self.error = None
+    self.listening = threading.Event()
+
+  def run(self):
+    reactor = self.reactor
+    try:
+      self.runLoop = RunLoop.currentRunLoop()
+      self.port = reactor.portClass(reactor.address, reactor.delegateFactory())
+      self.port.listen(reactor.backlog, self.runLoop, reusePort=True)
+    except Exception, e:
+      self.error = e
+      self.listening.set()
+      return
+
+    self.listening.set()
+    self.runLoop.run()
+
+  def shutdown(self):
+    # called from our own thread, stop accepting, close the
+    # connections we're serving and quit the RunLoop. The listening
+    # Port tells it's delegate with callFromThread(), so we stop
+    # behind it
+    self.port.closeAll()
+    self.runLoop.callFromThread(self.runLoop.stop)
+
+
+class Reactor(object):
+  """Listens on address from several RunLoops, each in it's own thread.
+
+  delegateFactory is called once per RunLoop to create the delegate
+  for it's listening Port, accepted Ports share their listener's
+  delegate.
+
+  Only TCP addresses can be spread this way. SO_REUSEPORT doesn't
+  apply to unix sockets, the second RunLoop to listen on the path
+  finds it in use and start() raises the RuntimeError.
+  """
+
+  name = "Reactor"
+
+  def __init__(self, address, delegateFactory, loops=2, backlog=128,
+               portClass=Port):
+    self.address = address
+    self.delegateFactory = delegateFactory
+    self.loops = loops
+    self.backlog = backlog
+    self.portClass = portClass
+    self.workers = []
+
+  def start(self):
+    """Starts the RunLoops, returns once they're all listening."""
+    if self.workers:
+      raise RuntimeError("Reactor is already running.")
+
+    for index in range(self.loops):
+      worker = ReactorLoop(self, index)
+      worker.start()
+      worker.listening.wait()
+      if worker.error:
+        self.stop()
+        raise worker.error
+
+      self.workers.append(worker)
+      if type(self.address) == tuple and self.address[1] == 0:
+        # the first RunLoop was handed an ephemeral port, the rest
+        # need to share it
+        self.address = worker.port._socket.getsockname()
+
+  def stop(self, timeout=None):
+    """Closes the listening Ports, and the Ports they accepted, then
+    stops each RunLoop."""
+    workers, self.workers = self.workers, []
+    for worker in workers:
+      worker.runLoop.callFromThread(worker.shutdown)
+    for worker in workers:
+      worker.join(timeout)
+
+  def load(self):
+    """Returns a dictionary per RunLoop describing how busy it is."""
+    load = []
+    for worker in self.workers:
+      runLoop = worker.runLoop
+      calls = runLoop.threadCallQueue
+      load.append({
+        'thread': worker.getName(),
+        'accepted': worker.port.accepted,
+        'connections': worker.port.connections,
+        'rejected': worker.port.rejected,
+        'acceptRate': worker.port.acceptRate,
+        # includes the RunLoop's waker and listening port
+        'descriptors': len(runLoop.readers) + len(runLoop.writers),
+        'timers': len(runLoop.timers),
+        'queuedCalls': len(calls),
+        'callLatency': calls.latency.mean,
+        'lag': runLoop.lag.mean,
+      })
+    return load
@@ -52,14 +52,17 @@ OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
 WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
-import os, select, thread, threading, time, heapq, fcntl, datetime
-import socket, errno
+import os, select, sys, thread, threading, time, fcntl, datetime
+import socket, errno, struct, Queue, itertools, io, traceback
+from collections import deque
 
 from dateutil.relativedelta import relativedelta
 from dateutil import rrule
 
 from Rambler import outlet
+from Rambler import syscalls
 from Rambler.ThreadStorageService import ThreadStorageService
+from Rambler.controllers.Stat import Stat
 from zope.interface import Interface, Attribute, implements
 
 
@@ -69,14 +72,279 @@ if not hasattr(socket, 'SHUT_RD'):
    socket.SHUT_RD=0
    socket.SHUT_WR=1
    socket.SHUT_RDWR = 2
-   
-import sys
-class Stream(object):
+
+if not hasattr(socket, 'SO_REUSEPORT') and sys.platform.startswith('linux'):
+   # Linux has had SO_REUSEPORT since 3.9 but python 2 doesn't
+   # define it
+   socket.SO_REUSEPORT = 15
+
+
+class WriteBuffer(object):
+   r"""Data waiting to be written to a descriptor.
+
+   Everything that's queued is flushed with a single writev() where
+   the platform has one, otherwise small chunks are joined and sent
+   with one write(). A short write only advances an offset into the
+   first chunk, what's left of it is never copied.
+
+     >>> r, w = os.pipe()
+     >>> buffer = WriteBuffer()
+     >>> for chunk in ('HTTP/1.1 200 OK\r\n', 'Content-Length: 2\r\n', '\r\n', 'hi'):
+     ...   buffer.append(chunk)
+     >>> buffer.write(w), len(buffer)
+     (40, 0)
+     >>> os.read(r, 100)
+     'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nhi'
+     >>> os.close(r); os.close(w)
+   """
+
+   # when writev() isn't available, chunks are joined until at least
+   # this many bytes are ready to go
+   coalesceSize = 64 * 1024
+
+   def __init__(self):
+      self.chunks = deque()
+      # bytes of the first chunk that have already been written
+      self.offset = 0
+      # bytes waiting to be written
+      self.size = 0
+
+   def __len__(self):
+      return self.size
+
+   def append(self, data):
+      if data:
+         self.chunks.append(data)
+         self.size += len(data)
+
+   def clear(self):
+      self.chunks.clear()
+      self.offset = 0
+      self.size = 0
+
+   def consume(self, sent):
+      """Discards sent bytes from the front of the buffer."""
+      self.size -= sent
+      sent += self.offset
+      while self.chunks and sent >= len(self.chunks[0]):
+         sent -= len(self.chunks.popleft())
+      self.offset = sent
+
+   def write(self, fd):
+      """Writes as much of the buffer to fd as a single call will take,
+      returns the number of bytes written. Errors, including EAGAIN,
+      are raised as OSError."""
+
+      if len(self.chunks) > 1 and syscalls.writev is not None:
+         sent = syscalls.writev(fd, self.chunks, self.offset)
+      else:
+         data = memoryview(self.chunks[0])[self.offset:]
+         if len(data) < self.coalesceSize and len(self.chunks) > 1:
+            pieces = [data.tobytes()]
+            size = len(data)
+            for chunk in itertools.islice(self.chunks, 1, None):
+               if size >= self.coalesceSize:
+                  break
+               pieces.append(chunk)
+               size += len(chunk)
+            data = ''.join(pieces)
+         sent = os.write(fd, data)
+
+      self.consume(sent)
+      return sent
+
+
+class BufferPool(object):
+   """Preallocated bytearrays that Ports and Streams reading with
+   readInto fill rather than allocating a new string for every read.
+   Each RunLoop has one, see RunLoop.buffers.
+
+     >>> pool = BufferPool(size=8)
+     >>> buffer = pool.acquire()
+     >>> len(buffer)
+     8
+     >>> pool.release(buffer)
+     >>> pool.acquire() is buffer
+     True
+   """
+
+   def __init__(self, size=64 * 1024, keep=16):
+      self.size = size
+      # most idle buffers held onto
+      self.keep = keep
+      self.free = []
+      # number of buffers the pool has had to create
+      self.allocated = 0
+
+   def acquire(self):
+      if self.free:
+         return self.free.pop()
+      self.allocated += 1
+      return bytearray(self.size)
+
+   def release(self, buffer):
+      if len(self.free) < self.keep:
+         self.free.append(buffer)
+
+
+class Transfer(object):
+   """Moves data from a file or pipe to a Port's socket without it
+   passing through python, see Port.sendFile() and Stream.pipeTo().
+
+   Files are sent with sendfile() and pipes with splice(). Where those
+   aren't available the data is read and written in chunks.
+   """
+
+   chunkSize = 64 * 1024
+
+   def __init__(self, fd, offset=None, count=None):
+      self.fd = fd
+      # where to read from next, None for pipes
+      self.offset = offset
+      # bytes left to read, None to go until the end
+      self.remaining = count
+      # bytes written to the port so far
+      self.sent = 0
+      self.finished = False
+      # True while a pipe has nothing for us to send
+      self.starved = False
+
+      # data written to the port while the transfer is underway goes
+      # out once it's finished
+      self.following = WriteBuffer()
+      # set when the transfer is queued
+      self.port = None
+
+      # data read but not yet sent, when there's no sendfile/splice
+      self.pending = None
+
+   def __repr__(self):
+      return "<transfer %s sent=%s>" % (self.fd, self.sent)
+
+   def fileno(self):
+      return self.fd
+
+   def send(self, out):
+      """Moves the next chunk to out, returns the number of bytes
+      written. Raises OSError with EAGAIN when out is full and sets
+      starved when a pipe has nothing to give."""
+
+      size = self.chunkSize
+      if self.remaining is not None:
+         size = min(size, self.remaining)
+
+      if self.pending is not None:
+         sent = os.write(out, self.pending)
+         self.pending = self.pending[sent:]
+         if not self.pending:
+            self.pending = None
+            self.finished = self.remaining == 0
+         self.sent += sent
+         return sent
+      elif size == 0:
+         self.finished = True
+         return 0
+
+      try:
+         if self.offset is not None and syscalls.sendfile is not None:
+            sent = syscalls.sendfile(out, self.fd, self.offset, size)
+         elif self.offset is None and syscalls.splice is not None:
+            sent = syscalls.splice(self.fd, out, size)
+         else:
+            return self._copy(out, size)
+      except OSError, e:
+         if e.errno == errno.EAGAIN and self.offset is None:
+            # splice doesn't say which end would block
+            readable, writable, errors = select.select([self.fd], [], [], 0)
+            if not readable:
+               self.starved = True
+               return 0
+         raise
+
+      if sent == 0:
+         # end of the file or the pipe was closed
+         self.finished = True
+         return 0
+
+      if self.offset is not None:
+         self.offset += sent
+      if self.remaining is not None:
+         self.remaining -= sent
+         self.finished = self.remaining == 0
+      self.sent += sent
+      return sent
+
+   def _copy(self, out, size):
+      # read and write the data ourselves
+      try:
+         if self.offset is not None:
+            os.lseek(self.fd, self.offset, os.SEEK_SET)
+         data = os.read(self.fd, size)
+      except OSError, e:
+         if e.errno == errno.EAGAIN:
+            self.starved = True
+            return 0
+         raise
+
+      if not data:
+         self.finished = True
+         return 0
+
+      if self.offset is not None:
+         self.offset += len(data)
+      if self.remaining is not None:
+         self.remaining -= len(data)
+
+      self.pending = memoryview(data)
+      return self.send(out)
+
+   def canRead(self, stream):
+      # a starved pipe has more data, have the port pick up where
+      # it left off
+      self.starved = False
+      RunLoop.currentRunLoop().addWriter(self.port, self.port.persistent)
+
+   def onError(self, error):
+      self.port.delegate.onError(self.port, error)
+
+
+class FlowControl(object):
+   """Write side flow control shared by Streams and Ports.
+
+   Once more than highWaterMark bytes are waiting to be written the
+   delegate's pauseProducing(source) is called, when the buffer drains
+   to lowWaterMark or less it's resumeProducing(source). Both are
+   optional. Delegates that proxy data between two connections can
+   pair them with pauseReading() and resumeReading() on the
+   connection they're reading from to keep memory use flat.
+   """
+
+   highWaterMark = 256 * 1024
+   lowWaterMark = 64 * 1024
+
+   def bufferedBytes(self):
+      """Returns the number of bytes waiting to be written."""
+      raise NotImplementedError
+
+   def _checkHighWater(self):
+      if not self.producerPaused and self.bufferedBytes() > self.highWaterMark:
+         self.producerPaused = True
+         if hasattr(self.delegate, 'pauseProducing'):
+            self.delegate.pauseProducing(self)
+
+   def _checkLowWater(self):
+      if self.producerPaused and self.bufferedBytes() <= self.lowWaterMark:
+         self.producerPaused = False
+         if hasattr(self.delegate, 'resumeProducing'):
+            self.delegate.resumeProducing(self)
+
+
+class Stream(FlowControl):
    def __init__(self, fd, observer=None):
          # list of ints, each items represents one outstanding call to Stream.read
          self.readRequests = []
-         # list of raw data to send to the file
-         self.writeBuffer = []
+         # raw data to send to the file
+         self.writeBuffer = WriteBuffer()
          
          #sys.stderr.write('\033[0;32m')
          #sys.stderr.write('New stream with %s\n' % fd)
@@ -93,6 +361,23 @@ class Stream(object):
          fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_NDELAY)
 
          self.observer = observer
+
+         # When True the stream stays registered with the RunLoop
+         # between reads and writes rather than being readded after
+         # every event, see RunLoop.addReader()
+         self.persistent = False
+
+         # When True reads fill a buffer from the RunLoop's pool and
+         # the observer's onRead() is passed a memoryview of it. The
+         # view is only good until onRead() returns, copy anything
+         # that needs to be kept.
+         self.readInto = False
+         self._file = None
+
+         # see FlowControl
+         self.producerPaused = False
+         # True while pauseReading() is in effect
+         self.readingPaused = False
          
    # TODO: For some reason __del__ is firing before the object is being deleted
    # which in turn is closing the file to soon. It may be do to a deepcopy issue.
@@ -108,7 +393,19 @@ class Stream(object):
 
    def read(self, bytes):
          self.readRequests.append(bytes)
-         RunLoop.currentRunLoop().addReader(self)
+         if not self.readingPaused:
+               RunLoop.currentRunLoop().addReader(self, self.persistent)
+
+   def pauseReading(self):
+         """Stops reading until resumeReading() is called, outstanding
+         read requests are kept."""
+         self.readingPaused = True
+         self.stopReading()
+
+   def resumeReading(self):
+         self.readingPaused = False
+         if self.readRequests and self.fd is not None:
+               RunLoop.currentRunLoop().addReader(self, self.persistent)
          
    def read_to_end(self):
      """Keeps reading and notifying observer until the end of stream has
@@ -149,28 +446,51 @@ class Stream(object):
    def canRead(self, stream):
 
          requestcount = len(self.readRequests)
-         while requestcount:
+         while requestcount and not self.readingPaused:
                requestcount -= 1
                # read until we get as much data as we've been
                # waiting for, or the socket would block.
                bytes2Read = self.readRequests[0]
 
+               buffer = None
                try:
-                     data = os.read(self.fd,bytes2Read)
-                     if data == '':
-                       if hasattr(self.observer,'end_of_data_for'):
-                         self.observer.end_of_data_for(self)
-                       return
-                         
-                         
-               except OSError, e:
-                     if e.errno == errno.EAGAIN:
-                           RunLoop.currentRunLoop().addReader(self)
-                     else:
-                           raise
+                     try:
+                           if self.readInto:
+                                 if self._file is None:
+                                       self._file = io.FileIO(self.fd, 'r', closefd=False)
+                                 pool = RunLoop.currentRunLoop().buffers
+                                 buffer = pool.acquire()
+                                 data = memoryview(buffer)[:bytes2Read]
+                                 count = self._file.readinto(data)
+                                 if count is None:
+                                       raise OSError(errno.EAGAIN, os.strerror(errno.EAGAIN))
+                                 data = data[:count]
+                           else:
+                                 data = os.read(self.fd,bytes2Read)
+                     # FileIO raises IOError on python 2, os.read OSError
+                     except (IOError, OSError), e:
+                           if e.errno == errno.EAGAIN:
+                                 if not self.readingPaused:
+                                       RunLoop.currentRunLoop().addReader(self, self.persistent)
+                                 return
+                           else:
+                                 raise
+
+                     if not data:
+                           if self.persistent:
+                                 # a closed pipe is always readable
+                                 self.stopReading()
+                           if hasattr(self.observer,'end_of_data_for'):
+                                 self.observer.end_of_data_for(self)
+                           return
 
-               # notify our observer that data's been returned
-               waitIfShort = self.observer.onRead(self, data)
+                     # notify our observer that data's been returned
+                     waitIfShort = self.observer.onRead(self, data)
+               finally:
+                     # the observer's done with the data, or we never
+                     # got any
+                     if buffer is not None:
+                           pool.release(buffer)
                bytesRead =  len(data)
                if bytesRead < bytes2Read and waitIfShort:
                      self.readRequests[0] -= bytesRead
@@ -178,26 +498,50 @@ class Stream(object):
                      # we're done with this request
                      del self.readRequests[0]
 
+         if self.persistent and not self.readRequests:
+               self.stopReading()
+
+   def pipeTo(self, port, count=None):
+      """Relays what's read from this stream to port, up to count bytes
+      or until the other end of the stream is closed. Where splice()
+      is available the data moves from the pipe to the socket without
+      passing through python.
+
+      The observer won't see any reads made while the transfer is
+      underway. Progress and completion are reported to the port's
+      delegate, see Port.sendFile(). Returns the Transfer.
+      """
+      del self.readRequests[:]
+      try:
+         RunLoop.currentRunLoop().removeReader(self)
+      except KeyError:
+         pass
+      return port.queueTransfer(Transfer(self.fd, None, count))
+
+   def stopReading(self):
+      """Unregisters a persistent stream that has nothing left to read."""
+      if self.fd is not None:
+         try:
+            RunLoop.currentRunLoop().removeReader(self)
+         except KeyError:
+            pass
+
 
    def write(self, data):
       self.writeBuffer.append(data)
-      RunLoop.currentRunLoop().addWriter(self)
+      RunLoop.currentRunLoop().addWriter(self, self.persistent)
+      self._checkHighWater()
+
+   def bufferedBytes(self):
+      return len(self.writeBuffer)
 
 
    def canWrite(self, data):
       bytessent = 0
       while self.writeBuffer:
             try:
-                  data = self.writeBuffer[0] 
                   # While we have data in our out goin buffer try to send it
-                  sent = os.write(self.fd, data)
-
-                  if len(data) == sent:
-                        # we sent all the data in one shot
-                        del self.writeBuffer[0]
-                  else:
-                        self.writeBuffer[0] = data[sent:]
-                  bytessent += sent
+                  bytessent += self.writeBuffer.write(self.fd)
             except OSError, e:
                   if e.errno == errno.EAGAIN:
 
@@ -205,14 +549,22 @@ class Stream(object):
                         # ask the runLoop when we can send more
                         # data
 
-                        RunLoop.currentRunLoop().addWriter(self)
+                        if not self.persistent:
+                              RunLoop.currentRunLoop().addWriter(self)
                         break
                   else:
                         raise
 
+      if self.persistent and not self.writeBuffer:
+            try:
+                  RunLoop.currentRunLoop().removeWriter(self)
+            except KeyError:
+                  pass
+
       # notify our observer of how much we wrote in this pass
       if bytessent > 0:
             self.observer.onWrite(self, bytessent)
+            self._checkLowWater()
             
    def onError(self, error):
      self.observer.onError(self, error)
@@ -268,11 +620,18 @@ class IPort(Interface):
       read it will return True.
             
       """
+
+   def pauseReading():
+      """Stops reading from the port, without discarding outstanding
+      read requests, until resumeReading() is called."""
+
+   def resumeReading():
+      """Resumes reading after a call to pauseReading()."""
    
 
 
 
-class Port(object):
+class Port(FlowControl):
    implements(IPort)
 
    """Port objects utilize the RunLoop to make working with sockets easier.
@@ -344,6 +703,30 @@ class Port(object):
 
    NUM_ACCEPT_AT_ONCE = 40
 
+   # ...to start with anyway. When a listener keeps finding more
+   # connections waiting than it accepts in a pass it doubles the
+   # number it tries, up to MAX_ACCEPT_AT_ONCE, and backs off again
+   # once the backlog clears.
+   MAX_ACCEPT_AT_ONCE = 1024
+
+   # Most connections accepted by a listening port that can be open
+   # at once, None for no limit. Once reached the port stops
+   # accepting until one of them closes, leaving new connections in
+   # the listen backlog, or if rejectOverflow is set accepts and
+   # immediately closes them.
+   maxConnections = None
+   rejectOverflow = False
+
+   # Seconds a connected port can go without reading or writing
+   # anything, seconds a read request can wait for data and seconds
+   # queued data can wait for the other end to take any of it before
+   # the port times out. None to wait forever. They're enforced by
+   # the RunLoop's TimeoutSweeper so expect them to be up to
+   # TimeoutSweeper.interval late.
+   idleTimeout = None
+   readTimeout = None
+   writeTimeout = None
+
    SHUT_RD=0
    SHUT_WR=1
    SHUT_RDWR = 2
@@ -355,9 +738,23 @@ class Port(object):
          self.address = address
          self.delegate = delegate
          self._socket = None
-         self.writebuffer = []
+         self.writebuffer = WriteBuffer()
+         # Transfers waiting to be sent once the writebuffer drains
+         self.transfers = deque()
          self.readrequests = []
-         self.timer = None
+
+         # when we last read or wrote anything, or started waiting to
+         # if we were idle
+         self.lastRead = self.lastWrite = None
+         # when the oldest outstanding read request was queued, the
+         # read timeout runs from then or the last read
+         self.readSince = None
+         # set by setTimeOut()
+         self.deadline = None
+         # the sweeper watching our timeouts
+         self.sweeper = None
+         # 'idle', 'read', 'write' or 'deadline' once we've timed out
+         self.timedOut = None
 
          # We should probably colapse all these variables into a
          # single state variable
@@ -367,6 +764,42 @@ class Port(object):
          self.closing = False # set to true by close() when we want this port to, well close duh...
          self.userInfo = {}
 
+         # connections accepted by a listening port
+         self.accepted = 0
+         # accepted connections that are still open
+         self.connections = 0
+         self.acceptedPorts = set()
+         # connections closed because we were at maxConnections
+         self.rejected = 0
+         # connections accepted per second, a moving average
+         self.acceptRate = 0.0
+         self.lastAccept = time.time()
+         self.acceptBatch = self.NUM_ACCEPT_AT_ONCE
+         # True while we've stopped accepting at maxConnections
+         self.overloaded = False
+         # the listening port that accepted us
+         self.listener = None
+
+         # Busy long lived connections can set this to True to stay
+         # registered with the RunLoop until they run out of reads or
+         # writes, rather than being readded after every
+         # event. Accepted ports inherit the setting from their
+         # listening port.
+         self.persistent = False
+
+         # When True reads are made with recv_into() using a buffer
+         # from the RunLoop's pool and the delegate's onRead() is
+         # passed a memoryview of it. The view is only good until
+         # onRead() returns, copy anything that needs to be kept.
+         # Accepted ports inherit the setting from their listening
+         # port.
+         self.readInto = False
+
+         # see FlowControl
+         self.producerPaused = False
+         # True while pauseReading() is in effect
+         self.readingPaused = False
+
    def __repr__(self):
          if self.listening:
                state = "listening"
@@ -389,24 +822,55 @@ class Port(object):
    def canRead(self, stream):
 
          if self.listening:
-               for x in range(self.NUM_ACCEPT_AT_ONCE):
+               runLoop = RunLoop.currentRunLoop()
+               batch = min(self.acceptBatch, runLoop.acceptsLeft())
+               accepted = 0
+               drained = False
+               while accepted < batch:
+                     full = (self.maxConnections is not None and
+                             self.connections >= self.maxConnections)
+                     if full and not self.rejectOverflow:
+                           # leave them in the backlog until a
+                           # connection closes
+                           self.overloaded = True
+                           self.pauseReading()
+                           break
+
                      try:
                            s, addr = self._socket.accept()
-                           # with the new socket in hand create a new
-                           # port to handle the communication.
-
-                           # use __class__ incase I decide to change the class Name
-                           port = self.__class__(addr, self.delegate)
-                           port.connectionAccepted(s) 
-                           port.scheduleInRunLoop(self.runLoop)
                      except socket.error, e:
                            if e[0] == errno.EWOULDBLOCK:
+                                 drained = True
                                  break
                            else:
                                  raise
 
+                     accepted += 1
+                     if full:
+                           s.close()
+                           self.rejected += 1
+                           continue
+
+                     # with the new socket in hand create a new
+                     # port to handle the communication.
+
+                     # use __class__ incase I decide to change the class Name
+                     port = self.__class__(addr, self.delegate)
+                     port.persistent = self.persistent
+                     port.readInto = self.readInto
+                     port.listener = self
+                     self.accepted += 1
+                     self.connections += 1
+                     self.acceptedPorts.add(port)
+                     port.connectionAccepted(s) 
+                     port.scheduleInRunLoop(self.runLoop)
+
+               runLoop.acceptsThisPass += accepted
+               self._adaptAccepting(accepted, drained)
+
                # wait for more connections
-               RunLoop.currentRunLoop().addReader(self)
+               if not self.persistent and not self.readingPaused:
+                     RunLoop.currentRunLoop().addReader(self)
          elif not self.connected:
                assert False, "How did we get here?"
                self.connected = True
@@ -415,21 +879,32 @@ class Port(object):
                # in the next iteration
 
                requestcount = len(self.readrequests)
-               while requestcount:
+               while requestcount and not self.readingPaused:
                      requestcount -= 1
                      # read until we get as much data as we've been
                      # waiting for, or the socket would block.
                      bytes2Read = self.readrequests[0]
 
+                     buffer = None
                      try:
-                           data = self._socket.recv(bytes2Read)
-                           if data == '':
+                           if self.readInto:
+                                 pool = RunLoop.currentRunLoop().buffers
+                                 buffer = pool.acquire()
+                                 count = self._socket.recv_into(buffer, min(bytes2Read, len(buffer)))
+                                 data = memoryview(buffer)[:count]
+                           else:
+                                 data = self._socket.recv(bytes2Read)
+                           if not data:
                               # Read connection was closed
+                              if buffer is not None:
+                                 pool.release(buffer)
                               self._reset()
                               self.delegate.onClose(self)
                               break
 
                      except socket.error, e:
+                           if buffer is not None:
+                                 pool.release(buffer)
                            if e[0] == errno.EWOULDBLOCK:
                                  break
                            else:
@@ -442,8 +917,13 @@ class Port(object):
                                  return
 
 
+                     self.lastRead = time.time()
                      # notify our observer that data's been returned
-                     waitIfShort = self.delegate.onRead(self, data)
+                     try:
+                           waitIfShort = self.delegate.onRead(self, data)
+                     finally:
+                           if buffer is not None:
+                                 pool.release(buffer)
                      bytesRead =  len(data)
                      if bytesRead < bytes2Read and waitIfShort:
                            self.readrequests[0] -= bytesRead
@@ -451,40 +931,55 @@ class Port(object):
                            # we're done with this request
                            del self.readrequests[0]
 
+               if self.persistent and self._socket and not self.readrequests:
+                     # nothing left to read, a readable socket would
+                     # otherwise wake us up on every pass
+                     try:
+                           RunLoop.currentRunLoop().removeReader(self)
+                     except KeyError:
+                           pass
+
    def canWrite(self, stream):
       if not self.connected:
+            # a connect that failed is reported as writable too
+            error = self._socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                  self._reset()
+                  self.delegate.onError(self, socket.error(error, os.strerror(error)))
+                  return
             self.connected = True
+            self._watchTimeouts()
             self.delegate.onConnect(self)
 
       bytessent = 0
+      finished = []
+      fd = self._socket.fileno()
 
-      # keep track of how much data was in the buffer at the time we
-      # start writing, that way if more is added during the callbacks
-      # it will be delayed to the next pass in the runloop
-
-      bufLen = len(self.writebuffer)
-
-      for x in range(bufLen):
+      while self.writebuffer or self._transferReady():
             try:
-                  data = self.writebuffer[0] 
-                  # While we have data in our outgoing buffer try to send it
+                  # While we have data in our outgoing buffer try to
+                  # send it, every queued chunk goes out in one call
                   try:
-                    sent = self._socket.send(data)
+                    if self.writebuffer:
+                      bytessent += self.writebuffer.write(fd)
+                    else:
+                      transfer = self.transfers[0]
+                      bytessent += transfer.send(fd)
+                      if transfer.finished:
+                        self.transfers.popleft()
+                        # what was written during the transfer is next
+                        self.writebuffer = transfer.following
+                        finished.append(transfer)
+                      elif transfer.starved:
+                        # the pipe will let us know when there's more
+                        RunLoop.currentRunLoop().addReader(transfer)
                   except Exception, e:
-                    if  isinstance(e, socket.error):
-                      # Q: why is there a blanket ecxception here?
+                    if  isinstance(e, (socket.error, OSError)):
                       raise
 
-                    self.log.exception('Error writing %s to socket', data)
+                    self.log.exception('Error writing to socket')
                     raise
-                  #print 'w>>>', data[:sent],
-                  if len(data) == sent:
-                        # if we sent all the data in one shot
-                        del self.writebuffer[0]
-                  else:
-                        self.writebuffer[0] = data[sent:]
-                  bytessent += sent
-            except socket.error,e:
+            except (socket.error, OSError), e:
                   if e[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
 
                         # other end of the socket is full, so
@@ -503,14 +998,80 @@ class Port(object):
 
       # notify our observer of how much we wrote in this pass
       if bytessent > 0:
+            self.lastWrite = time.time()
             self.delegate.onWrite(self, bytessent)
+            self._checkLowWater()
 
-      if self.writebuffer:
+      for transfer in finished:
+            if hasattr(self.delegate, 'onTransferred'):
+                  self.delegate.onTransferred(self, transfer)
+
+      if self.writebuffer or self._transferReady():
          # if we still have data reschedule our selves
-         RunLoop.currentRunLoop().addWriter(self)
-      elif self.closing:
+         if not self.persistent:
+            RunLoop.currentRunLoop().addWriter(self)
+      elif self.closing and not self.transfers:
          self._reset()
          self.delegate.onClose(self)
+      elif self.persistent:
+         try:
+            RunLoop.currentRunLoop().removeWriter(self)
+         except KeyError:
+            pass
+
+   def _adaptAccepting(self, accepted, drained):
+      now = time.time()
+      elapsed = now - self.lastAccept
+      if elapsed > 0:
+         self.acceptRate = .8 * self.acceptRate + .2 * (accepted / elapsed)
+      self.lastAccept = now
+
+      if not drained and accepted == self.acceptBatch:
+         # there were more waiting than we took
+         self.acceptBatch = min(self.acceptBatch * 2, self.MAX_ACCEPT_AT_ONCE)
+      elif drained and accepted < self.acceptBatch / 4:
+         self.acceptBatch = max(self.acceptBatch / 2, self.NUM_ACCEPT_AT_ONCE)
+
+   def connectionClosed(self, port):
+      """Called by the ports we accepted when they close."""
+      self.connections -= 1
+      self.acceptedPorts.discard(port)
+      if self.overloaded and self.connections < self.maxConnections:
+         self.overloaded = False
+         if self._socket is not None:
+            self.resumeReading()
+
+   def _transferReady(self):
+      # True if the next transfer in line has something to send
+      return self.transfers and not self.transfers[0].starved
+
+   def sendFile(self, fd, offset=0, count=None):
+      """Sends count bytes of the file starting at offset, or
+      everything to the end of the file if count is None, once the
+      data that's already been written is sent. The file's contents
+      never pass through python where sendfile() is available.
+
+      fd can be a descriptor or a file object and has to stay open
+      until the transfer finishes. Progress is reported to the
+      delegate's onWrite() like any other write, and if the delegate
+      has an onTransferred(port, transfer) method it's called once
+      the whole file is sent. Returns the Transfer.
+      """
+      if not isinstance(fd, (int, long)):
+         fd = fd.fileno()
+      return self.queueTransfer(Transfer(fd, offset, count))
+
+   def queueTransfer(self, transfer):
+      """Queues a Transfer behind any data already written to the port,
+      see sendFile() and Stream.pipeTo()."""
+      # sendfile() and splice() would block on a blocking socket
+      # until everything was sent
+      self._socket.setblocking(0)
+      transfer.port = self
+      self.transfers.append(transfer)
+      if self.connected:
+         RunLoop.currentRunLoop().addWriter(self, self.persistent)
+      return transfer
 
    def _reset(self):
 
@@ -520,19 +1081,31 @@ class Port(object):
       # the port shouldn't be in the runLoop at this point but just in
       # case
 
-      del self.writebuffer[:]
+      self.writebuffer.clear()
       del self.readrequests[:]
+      runLoop = RunLoop.currentRunLoop()
+      for transfer in self.transfers:
+         try:
+            runLoop.removeReader(transfer)
+         except KeyError:
+            pass
+      self.transfers.clear()
 
       self.removeFromRunLoop(RunLoop.currentRunLoop())
       self.connected = False
       self.listening = False
-      self.setTimeOut(None)
+      self.deadline = None
+      self.lastRead = self.lastWrite = self.readSince = None
+
+      if self.listener is not None:
+         self.listener.connectionClosed(self)
+         self.listener = None
 
       self._socket.close()
       self._socket = None
 
 
-   def listen(self, backlog, runLoop = None):
+   def listen(self, backlog, runLoop = None, reusePort=False):
          """Listen for incoming connections on this port.
 
            backlog - the maximum number of queued connectinos
@@ -540,6 +1113,12 @@ class Port(object):
            runLoop - the runLoop that will monitor this port for
                      incomming connections. Defaults to the
                      currentRunLoop if none is specified.  
+
+           reusePort - set SO_REUSEPORT so several ports, each in
+                       their own RunLoop, can listen on the same
+                       address with the kernel spreading incoming
+                       connections between them. Only applies to
+                       inet sockets.
          """
 
          if type(self.address) == tuple:
@@ -560,6 +1139,10 @@ class Port(object):
 
          
          serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+         if reusePort and socketPath is None:
+            if not hasattr(socket, 'SO_REUSEPORT'):
+               raise RuntimeError("SO_REUSEPORT isn't supported on this platform")
+            serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
          serversocket.bind(self.address)
 
          if socketPath: # ensure the world can read/write this socket
@@ -576,7 +1159,7 @@ class Port(object):
          if runLoop is None:
                runLoop = RunLoop.currentRunLoop()
 
-         runLoop.addReader(self)
+         runLoop.addReader(self, self.persistent)
          self.runLoop = runLoop
 
    def connect(self):
@@ -620,7 +1203,20 @@ class Port(object):
          # if we're a normal port, schedule us in the runLoop just in
          # case we have any out going data
 
-         runLoop.addWriter(self)
+         runLoop.addWriter(self, self.persistent)
+
+   def closeAll(self):
+      """Closes a listening port along with every port it accepted
+      that's still open. Unlike close() the accepted ports don't wait
+      for what's been written to them to be sent, their delegates'
+      onClose() is called as each one goes. Call it from the RunLoop
+      the port listens on."""
+      for port in list(self.acceptedPorts):
+         port.closing = True
+         port._reset()
+         port.delegate.onClose(port)
+      if self.listening:
+         self.close()
       
    def shutdown(self, how):
          self._socket.shutdown(how)
@@ -642,32 +1238,72 @@ class Port(object):
 
          If the socket is closed, the timer will automatically be removed.
 
+         Calling this again only moves the deadline, it's cheap enough
+         to do on every read. See idleTimeout, readTimeout and
+         writeTimeout for timeouts that don't need to be moved at all.
          """
 
-
          if seconds is None:
-               if self.timer:
-                     # cancel the previous timer
-                     self.timer.cancel()
-               return
-
-         if self.timer:
-               self.timer.reset(seconds)
+               self.deadline = None
          else:
-               self.timer=DelayedCall(seconds, False, self.onTimeOut)
-               RunLoop.currentRunLoop().addTimer(self.timer)
-
+               self.deadline = time.time() + seconds
+               self._watchTimeouts()
+
+   def setTimeouts(self, idle=None, read=None, write=None):
+         """Sets this port's idleTimeout, readTimeout and writeTimeout,
+         overriding the class's, None disables the timeout."""
+         self.idleTimeout = idle
+         self.readTimeout = read
+         self.writeTimeout = write
+         self._watchTimeouts()
+
+   def _watchTimeouts(self):
+         # hands us to the RunLoop's sweeper if we have any timeouts
+         if self.sweeper is None and self._socket is not None and (
+               self.deadline is not None or self.idleTimeout is not None
+               or self.readTimeout is not None
+               or self.writeTimeout is not None):
+               now = time.time()
+               self.lastRead = self.lastRead or now
+               self.lastWrite = self.lastWrite or now
+               self.sweeper = RunLoop.currentRunLoop().sweeper
+               self.sweeper.add(self)
+
+   def expired(self, now):
+         """Returns which of our timeouts has passed as of now, or None."""
+         if self.deadline is not None and now >= self.deadline:
+               return 'deadline'
+         if (self.readTimeout is not None and self.readrequests and
+             now - max(self.lastRead, self.readSince) >= self.readTimeout):
+               return 'read'
+         if (self.writeTimeout is not None and self.bufferedBytes() and
+             now - self.lastWrite >= self.writeTimeout):
+               return 'write'
+         if (self.idleTimeout is not None and
+             now - max(self.lastRead, self.lastWrite) >= self.idleTimeout):
+               return 'idle'
 
    def onTimeOut(self):
          # socket took to long, notify our observer, then tear the
          # socket down.
-         self.delegate.onTimeOut(self)
-         self.close()
+         if hasattr(self.delegate, 'onTimeOut'):
+               self.delegate.onTimeOut(self)
+         if self._socket is None:
+               # the delegate closed us
+               return
+         if self.timedOut == 'write':
+               # the other end isn't taking what we have, waiting for
+               # it to go out before closing would never finish
+               self._reset()
+               self.delegate.onClose(self)
+         elif not self.closing:
+               self.close()
 
 
    def connectionAccepted(self, socket):
          self._socket = socket
          self.connected = True
+         self._watchTimeouts()
          self.delegate.onAccept(self)
 
 
@@ -701,8 +1337,35 @@ class Port(object):
 
          """
 
+         if not self.readrequests:
+               # the read timeout runs from now, only data arriving
+               # counts as a read though
+               self.readSince = time.time()
          self.readrequests.append(bytes)
-         RunLoop.currentRunLoop().addReader(self)
+         if not self.readingPaused:
+               RunLoop.currentRunLoop().addReader(self, self.persistent)
+
+   def pauseReading(self):
+         """Stops reading, or accepting connections if we're listening,
+         until resumeReading() is called. Outstanding read requests
+         are kept."""
+         self.readingPaused = True
+         if self._socket is not None:
+               try:
+                     RunLoop.currentRunLoop().removeReader(self)
+               except KeyError:
+                     pass
+
+   def resumeReading(self):
+         self.readingPaused = False
+         if self._socket is not None and (self.listening or self.readrequests):
+               RunLoop.currentRunLoop().addReader(self, self.persistent)
+
+   def bufferedBytes(self):
+         buffered = len(self.writebuffer)
+         for transfer in self.transfers:
+               buffered += len(transfer.following)
+         return buffered
 
 
    def write(self, data):
@@ -716,10 +1379,19 @@ class Port(object):
       should be written to.
       """
 
+      if not self.bufferedBytes() and not self.transfers:
+         # the write timeout runs from now
+         self.lastWrite = time.time()
+
       # Add the data to the buffer and ensure that we're in the runLoop
-      self.writebuffer.append(data)
+      if self.transfers:
+         # goes out after the file we're sending
+         self.transfers[-1].following.append(data)
+      else:
+         self.writebuffer.append(data)
       if self.connected:
-         RunLoop.currentRunLoop().addWriter(self)
+         RunLoop.currentRunLoop().addWriter(self, self.persistent)
+      self._checkHighWater()
 
    def shutdown(self, how):
          self._socket.shutdown(how)
@@ -727,11 +1399,15 @@ class Port(object):
 
    # these probably shouldn't be called when we're listening
    def scheduleInRunLoop(self, runLoop):
-         runLoop.addReader(self)
-         runLoop.addWriter(self)
+         runLoop.addReader(self, self.persistent)
+         runLoop.addWriter(self, self.persistent)
 
    def removeFromRunLoop(self, runLoop):
-       self.setTimeOut(None)
+       # our timeouts stop being swept along with everything else
+       if self.sweeper is not None:
+           self.sweeper.remove(self)
+           self.sweeper = None
+
        try:
          runLoop.removeReader(self)
        except KeyError:
@@ -743,6 +1419,252 @@ class Port(object):
            pass
 
 
+class DatagramPort(object):
+   """A datagram socket, UDP or unix, serviced by the RunLoop.
+
+   Like Port the address is either a tuple containing the ip address
+   and port or the path of a unix socket. Call bind() to receive
+   datagrams sent to the address, or connect() to send to it with
+   write(). sendTo() sends to any address.
+
+   Each time the socket is readable the port receives datagrams until
+   there are no more waiting, or it has received NUM_RECV_AT_ONCE of
+   them, and hands them to the delegate in one call to
+   onDatagrams(port, datagrams) as a list of (data, address)
+   tuples. Sends are queued and written together once the socket is
+   writable, the delegate's onWrite(port, bytes) is told how much went
+   out if it has one.
+
+   >>> class Collector(object):
+   ...   def onDatagrams(self, port, datagrams):
+   ...     print [data for data, address in datagrams]
+
+   >>> receiver = DatagramPort(('127.0.0.1', 0), Collector())
+   >>> receiver.bind()
+   >>> sender = DatagramPort(receiver.getAddress(), None)
+   >>> sender.connect()
+   >>> sender.write('one')
+   >>> sender.write('two')
+   >>> runLoop = RunLoop.currentRunLoop()
+   >>> runLoop.runOnce()
+   >>> runLoop.runOnce()
+   ['one', 'two']
+   >>> sender.close()
+   >>> receiver.close()
+   """
+
+   # most datagrams received, and sent, per wakeup
+   NUM_RECV_AT_ONCE = 64
+   NUM_SEND_AT_ONCE = 64
+   # datagrams bigger than this are truncated
+   maxDatagramSize = 65536
+   # most datagrams queued to be sent, once full the oldest are
+   # dropped
+   maxQueued = 10000
+
+   def __init__(self, address, delegate=None):
+      self.address = address
+      self.delegate = delegate
+      self._socket = None
+      self.runLoop = None
+      # (data, address) waiting to be sent, address is None when
+      # sending to the connected address
+      self.sendQueue = deque()
+      self.bound = False
+      self.connected = False
+
+      self.received = 0
+      self.sent = 0
+      # datagrams thrown away because the queue was full or sending
+      # them failed
+      self.dropped = 0
+
+   def __repr__(self):
+      return "<%s %s object at %s delegate=%s >" % (
+         self.__class__.__name__, self.address, id(self), self.delegate)
+
+   def fileno(self):
+      if self._socket is None:
+         raise RuntimeError("You must call bind, connect or sendTo on this "
+                            "DatagramPort before it can be scheduled in a RunLoop")
+      return self._socket.fileno()
+
+   def getAddress(self):
+      """Returns the address we're bound to."""
+      return self._socket.getsockname()
+
+   def _open(self, address, runLoop=None):
+      if self._socket is None:
+         if type(address) == tuple:
+            family = socket.AF_INET
+         else:
+            family = socket.AF_UNIX
+         self._socket = socket.socket(family, socket.SOCK_DGRAM)
+         self._socket.setblocking(0)
+         self.runLoop = runLoop or RunLoop.currentRunLoop()
+      return self._socket
+
+   def bind(self, runLoop=None):
+      """Starts receiving datagrams sent to our address."""
+      sock = self._open(self.address, runLoop)
+      if type(self.address) != tuple and os.path.exists(self.address):
+         # unlike stream sockets there's no way to tell if somebody
+         # else is using it
+         os.unlink(self.address)
+      sock.bind(self.address)
+      self.bound = True
+      self.runLoop.addReader(self, True)
+
+   def connect(self, runLoop=None):
+      """Makes our address the destination of write()."""
+      self._open(self.address, runLoop).connect(self.address)
+      self.connected = True
+
+   def write(self, data):
+      """Queues data to be sent to the address we're connected to."""
+      self.sendTo(data, None)
+
+   def sendTo(self, data, address):
+      """Queues data to be sent to address."""
+      if self._socket is None:
+         self._open(address)
+      if len(self.sendQueue) >= self.maxQueued:
+         self.sendQueue.popleft()
+         self.dropped += 1
+      self.sendQueue.append((data, address))
+      self.runLoop.addWriter(self, True)
+
+   def canRead(self, stream):
+      datagrams = []
+      sock = self._socket
+      size = self.maxDatagramSize
+      while len(datagrams) < self.NUM_RECV_AT_ONCE:
+         try:
+            datagrams.append(sock.recvfrom(size))
+         except socket.error, e:
+            if e[0] in (errno.EWOULDBLOCK, errno.EAGAIN, errno.EINTR):
+               break
+            # ICMP errors from an earlier send, ECONNREFUSED and
+            # friends, show up here on connected sockets
+            if hasattr(self.delegate, 'onError'):
+               self.delegate.onError(self, e)
+            break
+
+      if datagrams:
+         self.received += len(datagrams)
+         self.delegate.onDatagrams(self, datagrams)
+
+   def canWrite(self, stream):
+      sock = self._socket
+      queue = self.sendQueue
+      bytessent = 0
+      count = 0
+      while queue and count < self.NUM_SEND_AT_ONCE:
+         data, address = queue[0]
+         try:
+            if address is None:
+               bytessent += sock.send(data)
+            else:
+               bytessent += sock.sendto(data, address)
+         except socket.error, e:
+            if e[0] in (errno.EWOULDBLOCK, errno.EAGAIN, errno.ENOBUFS):
+               # wait for room in the socket's buffer
+               break
+            # this datagram is never going anywhere
+            queue.popleft()
+            self.dropped += 1
+            if hasattr(self.delegate, 'onError'):
+               self.delegate.onError(self, e)
+            continue
+         queue.popleft()
+         count += 1
+
+      self.sent += count
+      if bytessent and hasattr(self.delegate, 'onWrite'):
+         self.delegate.onWrite(self, bytessent)
+
+      if not queue and self._socket is not None:
+         try:
+            self.runLoop.removeWriter(self)
+         except KeyError:
+            pass
+
+   def close(self):
+      """Closes the socket, anything still queued is dropped."""
+      if self._socket is None:
+         return
+      for remove in (self.runLoop.removeReader, self.runLoop.removeWriter):
+         try:
+            remove(self)
+         except KeyError:
+            pass
+      self.dropped += len(self.sendQueue)
+      self.sendQueue.clear()
+      self._socket.close()
+      self._socket = None
+      if self.bound and type(self.address) != tuple:
+         try:
+            os.unlink(self.address)
+         except OSError:
+            pass
+      self.bound = self.connected = False
+      if hasattr(self.delegate, 'onClose'):
+         self.delegate.onClose(self)
+
+
+class TimeoutSweeper(object):
+   """Enforces the timeouts of a RunLoop's Ports.
+
+   Rather than a timer per port, ports note when they last read and
+   wrote and a single timer checks every port with a timeout once
+   each interval seconds. Keeping a port's timeouts up to date costs
+   a call to time.time() per read or write, no matter how many ports
+   there are, at the price of timeouts firing up to interval seconds
+   late.
+   """
+   interval = 1.0
+
+   def __init__(self, runLoop):
+      self.runLoop = runLoop
+      self.ports = set()
+      self.timer = None
+      # number of ports timed out so far
+      self.expiredCount = 0
+
+   def __len__(self):
+      return len(self.ports)
+
+   def add(self, port):
+      self.ports.add(port)
+      if self.timer is None:
+         self.timer = self.runLoop.waitBeforeCalling(self.interval, self.sweep)
+
+   def remove(self, port):
+      self.ports.discard(port)
+
+   def sweep(self):
+      self.timer = None
+      now = time.time()
+      expired = []
+      for port in self.ports:
+         reason = port.expired(now)
+         if reason:
+            expired.append((port, reason))
+
+      try:
+         for port, reason in expired:
+            self.ports.discard(port)
+            port.sweeper = None
+            port.timedOut = reason
+            self.expiredCount += 1
+            port.onTimeOut()
+      finally:
+         # ports readded during onTimeOut() will have scheduled the
+         # next sweep already
+         if self.ports and self.timer is None:
+            self.timer = self.runLoop.waitBeforeCalling(self.interval, self.sweep)
+
+
 class DelayedCall:
     def __init__(self, secondsOrRRule, func, *args, **kw):
        self.repeatRule = None
@@ -759,9 +1681,8 @@ class DelayedCall:
        self.args = args
        self.kw = kw
        self.delayed_time = 0
-
-    def __cmp__(self, other):
-       return cmp(self.time, other.time)
+       # set by the TimingWheel this call is scheduled in
+       self.wheel = None
 
     def onTimeout(self):
        if self.delayed_time:
@@ -801,6 +1722,8 @@ class DelayedCall:
         else:
            self.cancelled = True
            del self.func, self.args, self.kw
+           if self.wheel is not None:
+              self.wheel.cancel(self)
 
     def pushBack(self, secondsLater):
        """Reschedule this call for a later time
@@ -822,13 +1745,722 @@ class DelayedCall:
        elif self.called:
           raise RuntimeError("Already Called")
 
+       elif self.wheel is not None:
+          # move straight to the new slot
+          self.time += secondsLater
+          self.wheel.add(self)
        else:
           self.delayed_time += secondsLater
- 
 
 
- 
-   
+class TimingWheel(object):
+   """Hierarchical timing wheel that stores the RunLoop's timers.
+
+   Time is divided into ticks of resolution seconds. The first level
+   has a slot for each of the next 256 ticks, each slot of the next
+   level covers 256 ticks of the level below it and so on. Timers are
+   placed in the slot for their tick on the lowest level that can
+   reach it and trickle down a level each time the level below wraps
+   around. Adding, moving and cancelling a timer is O(1) no matter how
+   many timers are scheduled.
+
+   Timers whose tick has come up are moved to the due list and handed
+   back by expire() once their time has passed, so they still fire at
+   the exact time they asked for, never early.
+
+   >>> wheel = TimingWheel(now=100)
+   >>> call = DelayedCall(5, lambda: None)
+   >>> call.time = 105
+   >>> call = wheel.add(call)
+   >>> len(wheel)
+   1
+   >>> wheel.timeout(100)
+   5
+   >>> wheel.expire(104.99)
+   []
+   >>> wheel.expire(105) == [call]
+   True
+   >>> len(wheel), wheel.firedCount
+   (0, 1)
+
+   Cancelled DelayedCalls are dropped from the wheel immediately.
+
+   >>> call = wheel.add(DelayedCall(5, lambda: None))
+   >>> call.cancel()
+   >>> len(wheel), wheel.cancelledCount
+   (0, 1)
+
+   The wheel isn't thread safe. Only the RunLoop's own thread may add,
+   cancel or push back timers, RunLoop.addTimer() hands timers added
+   from other threads over with callFromThread().
+   """
+   resolution = 0.01
+   bits = 8
+   levels = 4
+
+   def __init__(self, now=None):
+      if now is None:
+         now = time.time()
+
+      self.slots = 1 << self.bits
+      self.mask = self.slots - 1
+      self.wheels = [[{} for x in range(self.slots)] for level in range(self.levels)]
+      # number of timers on each level
+      self.counts = [0] * self.levels
+      # timers whose tick has passed but not their time
+      self.due = {}
+      # id(timer) -> (slot, seq, level)
+      self.entries = {}
+      self.seq = 0
+      self.current = int(now / self.resolution)
+
+      self.cancelledCount = 0
+      self.firedCount = 0
+
+   def __len__(self):
+      return len(self.entries)
+
+   @property
+   def live(self):
+      """Number of timers waiting to fire."""
+      return len(self.entries)
+
+   def add(self, timer):
+      """Schedules the timer, or moves it if it's already scheduled."""
+      self._unlink(timer)
+
+      # seq keeps timers set for the same time firing in the order
+      # they were added
+      self.seq += 1
+      tick = int(timer.time / self.resolution)
+      delta = tick - self.current
+      if delta <= 0:
+         slot = self.due
+         level = -1
+      else:
+         level = 0
+         while level < self.levels - 1 and delta >> (self.bits * (level + 1)):
+            level += 1
+         if delta >> (self.bits * self.levels):
+            # further out than the wheel reaches, park it in the
+            # furthest slot, it will be placed again when it cascades
+            tick = self.current + (1 << (self.bits * self.levels)) - 1
+         slot = self.wheels[level][(tick >> (self.bits * level)) & self.mask]
+         self.counts[level] += 1
+
+      slot[self.seq] = timer
+      self.entries[id(timer)] = (slot, self.seq, level)
+
+      if isinstance(timer, DelayedCall):
+         timer.wheel = self
+      return timer
+
+   def remove(self, timer):
+      """Unschedules the timer, returns False if it wasn't scheduled."""
+      return self._unlink(timer)
+
+   def cancel(self, timer):
+      if self._unlink(timer):
+         self.cancelledCount += 1
+
+   def _unlink(self, timer):
+      entry = self.entries.pop(id(timer), None)
+      if entry is None:
+         return False
+      slot, seq, level = entry
+      del slot[seq]
+      if level >= 0:
+         self.counts[level] -= 1
+      return True
+
+   def expire(self, now):
+      """Advances the wheel and returns the timers whose time has
+      come, earliest first. The timers are no longer scheduled."""
+      target = int(now / self.resolution)
+      wheel = self.wheels[0]
+      counts = self.counts
+
+      while self.current < target:
+         if counts[0]:
+            self.current += 1
+         else:
+            # nothing on the lowest levels, skip ahead to the next
+            # tick where a higher level cascades into them
+            level = 1
+            while level < self.levels and not counts[level]:
+               level += 1
+            if level == self.levels:
+               self.current = target
+               break
+            boundary = (self.current | ((1 << (self.bits * level)) - 1)) + 1
+            if boundary > target:
+               self.current = target
+               break
+            self.current = boundary
+
+         index = self.current & self.mask
+         if not index:
+            self._cascade(1)
+
+         slot = wheel[index]
+         if slot:
+            counts[0] -= len(slot)
+            for seq, timer in slot.iteritems():
+               self.due[seq] = timer
+               self.entries[id(timer)] = (self.due, seq, -1)
+            slot.clear()
+
+      if not self.due:
+         return []
+
+      expired = []
+      for seq, timer in self.due.items():
+         if timer.time <= now:
+            del self.due[seq]
+            del self.entries[id(timer)]
+            if isinstance(timer, DelayedCall):
+               # it's about to fire, pushBack() has to go through
+               # onTimeout() rather than put it back on the wheel
+               timer.wheel = None
+            if timer.cancelled:
+               # a timer cancelled without telling us
+               self.cancelledCount += 1
+            else:
+               expired.append((timer.time, seq, timer))
+
+      expired.sort()
+      self.firedCount += len(expired)
+      return [timer for t, seq, timer in expired]
+
+   def _cascade(self, level):
+      # Internal method, moves the timers in the current slot of the
+      # given level down to the levels below it
+      index = (self.current >> (self.bits * level)) & self.mask
+      if not index and level + 1 < self.levels:
+         self._cascade(level + 1)
+
+      slot = self.wheels[level][index]
+      if slot:
+         for seq, timer in sorted(slot.items()):
+            self.add(timer)
+
+   def timeout(self, now):
+      """Returns the number of seconds until the next timer is due or
+      None if there are no timers."""
+      if self.due:
+         return max(0, min([t.time for t in self.due.itervalues()]) - now)
+
+      # a timer still waiting to cascade from a higher level can be
+      # due before everything on the levels below it, so check the
+      # next occupied slot on every level
+      earliest = None
+      for level in range(self.levels):
+         if not self.counts[level]:
+            continue
+         wheel = self.wheels[level]
+         start = (self.current >> (self.bits * level)) + 1
+         for offset in xrange(self.slots):
+            slot = wheel[(start + offset) & self.mask]
+            if slot:
+               first = min([t.time for t in slot.itervalues()])
+               if earliest is None or first < earliest:
+                  earliest = first
+               break
+
+      if earliest is None:
+         return None
+      return max(0, earliest - now)
+
+
+# Event masks understood by every poller. They're the same values
+# poll() and epoll() use so native event masks can be used untranslated.
+POLL_READ  = getattr(select, 'POLLIN', 1)
+POLL_WRITE = getattr(select, 'POLLOUT', 4)
+POLL_ERROR = getattr(select, 'POLLERR', 8) | getattr(select, 'POLLHUP', 16)
+
+
+class SelectPoller(object):
+   """Waits on descriptors using select(). Available everywhere, but it
+   walks every descriptor on every pass and can't monitor descriptors
+   numbered above FD_SETSIZE (typically 1024).
+
+   All pollers share the same interface, register(fd, mask),
+   modify(fd, mask), unregister(fd), poll(timeout) and close(). poll()
+   returns a tuple of the readable and writable descriptors.
+   """
+
+   def __init__(self):
+      self.readable = set()
+      self.writable = set()
+
+   def register(self, fd, mask):
+      if mask & POLL_READ:
+         self.readable.add(fd)
+      else:
+         self.readable.discard(fd)
+
+      if mask & POLL_WRITE:
+         self.writable.add(fd)
+      else:
+         self.writable.discard(fd)
+
+   modify = register
+
+   def unregister(self, fd):
+      self.readable.discard(fd)
+      self.writable.discard(fd)
+
+   def poll(self, timeout):
+      ready2Read, ready2Write, hadErrors = select.select(self.readable,
+                                                         self.writable,
+                                                         [], timeout)
+      return ready2Read, ready2Write
+
+   def close(self):
+      self.readable.clear()
+      self.writable.clear()
+
+
+class PollPoller(object):
+   """Waits on descriptors using poll(), no FD_SETSIZE limit but the
+   kernel still scans every registered descriptor on each call."""
+
+   def __init__(self):
+      self._poll = select.poll()
+
+   def register(self, fd, mask):
+      # poll.register() modifies the mask of an existing registration
+      self._poll.register(fd, mask)
+
+   modify = register
+
+   def unregister(self, fd):
+      try:
+         self._poll.unregister(fd)
+      except KeyError:
+         pass
+
+   def poll(self, timeout):
+      if timeout is None:
+         events = self._poll.poll()
+      else:
+         events = self._poll.poll(timeout * 1000)
+
+      ready2Read = []
+      ready2Write = []
+      for fd, mask in events:
+         if mask & select.POLLNVAL:
+            # let the RunLoop weed out the closed descriptor
+            raise select.error(errno.EBADF, os.strerror(errno.EBADF))
+         # errors and hangups are reported to both sides so the
+         # source finds out about them on it's next read or write
+         if mask & (POLL_READ | POLL_ERROR):
+            ready2Read.append(fd)
+         if mask & (POLL_WRITE | POLL_ERROR):
+            ready2Write.append(fd)
+      return ready2Read, ready2Write
+
+   def close(self):
+      self._poll = None
+
+
+class EPollPoller(object):
+   """Waits on descriptors using Linux's epoll(), the cost of each call is
+   proportional to the number of ready descriptors rather than the
+   number being monitored."""
+
+   def __init__(self):
+      self._epoll = select.epoll()
+      # epoll refuses regular files, which are always ready, so we
+      # track them here and report them on every poll.
+      self.alwaysReady = {}
+
+   def register(self, fd, mask):
+      try:
+         self._epoll.register(fd, mask)
+      except IOError, e:
+         if e.errno == errno.EEXIST:
+            self._epoll.modify(fd, mask)
+         elif e.errno == errno.EPERM:
+            self.alwaysReady[fd] = mask
+         else:
+            raise
+
+   def modify(self, fd, mask):
+      if fd in self.alwaysReady:
+         self.alwaysReady[fd] = mask
+         return
+
+      try:
+         self._epoll.modify(fd, mask)
+      except IOError, e:
+         # the descriptor was closed and reopened behind our back,
+         # which silently drops it from the epoll set
+         if e.errno != errno.ENOENT:
+            raise
+         self.register(fd, mask)
+
+   def unregister(self, fd):
+      if self.alwaysReady.pop(fd, None) is not None:
+         return
+
+      try:
+         self._epoll.unregister(fd)
+      except IOError, e:
+         if e.errno not in (errno.ENOENT, errno.EBADF):
+            raise
+
+   def poll(self, timeout):
+      if self.alwaysReady:
+         timeout = 0
+      elif timeout is None:
+         timeout = -1
+
+      ready2Read = []
+      ready2Write = []
+      for fd, mask in self._epoll.poll(timeout):
+         if mask & (POLL_READ | POLL_ERROR):
+            ready2Read.append(fd)
+         if mask & (POLL_WRITE | POLL_ERROR):
+            ready2Write.append(fd)
+
+      for fd, mask in self.alwaysReady.items():
+         if mask & POLL_READ:
+            ready2Read.append(fd)
+         if mask & POLL_WRITE:
+            ready2Write.append(fd)
+
+      return ready2Read, ready2Write
+
+   def close(self):
+      self._epoll.close()
+      self.alwaysReady.clear()
+
+
+class CallQueue(object):
+   """Thread safe queue of calls handed to a RunLoop by other threads.
+
+   The queue holds at most maxsize calls (0 for no limit). What
+   happens when another thread tries to add a call to a full queue
+   depends on the policy:
+
+      BLOCK - wait until the RunLoop makes room
+      DROP  - discard the call, put() returns False
+      RAISE - raise Queue.Full
+
+   The thread draining the queue is never blocked, nor are it's calls
+   dropped, since it'd be waiting on itself, and it never takes the
+   queue's lock. Signal handlers run on the main thread and are
+   expected to hand calls to the main RunLoop which puts them in the
+   same boat, a handler that interrupts the RunLoop can't deadlock on
+   a lock the RunLoop is holding.
+
+     >>> queue = CallQueue(2, CallQueue.DROP, owner=-1)
+     >>> queue.put(len, ('a',), {}), queue.put(len, ('b',), {})
+     (True, True)
+     >>> queue.put(len, ('c',), {})
+     False
+     >>> [args for f, args, kw in queue.drain()]
+     [('a',), ('b',)]
+     >>> queue.dropped, queue.highWater, len(queue)
+     (1, 2, 0)
+   """
+
+   BLOCK = 'block'
+   DROP  = 'drop'
+   RAISE = 'raise'
+
+   def __init__(self, maxsize=0, policy=BLOCK, owner=None):
+      if policy not in (self.BLOCK, self.DROP, self.RAISE):
+         raise ValueError("Unknown call queue policy %r" % policy)
+
+      self.maxsize = maxsize
+      self.policy = policy
+      # thread id of the RunLoop draining the queue
+      if owner is None:
+         owner = thread.get_ident()
+      self.owner = owner
+
+      self.calls = deque()
+      # only used by other threads waiting for room
+      self.notFull = threading.Condition(threading.Lock())
+      self.waiting = 0
+      # keys of the calls put() with a key that are still queued
+      self.keys = set()
+
+      self.highWater = 0
+      self.dropped = 0
+      # seconds a call waited in the queue before being run
+      self.latency = Stat('call queue latency')
+
+   def __len__(self):
+      return len(self.calls)
+
+   def put(self, f, args, kw, key=None):
+      """Queues f(*args, **kw), returns False if the call was dropped.
+
+      A call with a key isn't queued while an earlier call with the
+      same key is still waiting, put() returns True as the call will
+      be made.
+
+      Only other threads finding the queue full take the lock. The
+      owner's calls, and so the calls of signal handlers interrupting
+      the owner while it holds the lock, are appended without it.
+      """
+      if key is not None and key in self.keys:
+         return True
+
+      if (self.maxsize and len(self.calls) >= self.maxsize
+          and thread.get_ident() != self.owner):
+         if self.policy == self.DROP:
+            self.dropped += 1
+            return False
+         elif self.policy == self.RAISE:
+            raise Queue.Full
+         self.notFull.acquire()
+         try:
+            self.waiting += 1
+            while len(self.calls) >= self.maxsize:
+               self.notFull.wait()
+         finally:
+            self.waiting -= 1
+            self.notFull.release()
+
+      if key is not None:
+         self.keys.add(key)
+      # appending to a deque is atomic
+      self.calls.append((f, args, kw, time.time(), key))
+      self.highWater = max(self.highWater, len(self.calls))
+      return True
+
+   def _notifyWaiting(self):
+      # only takes the lock when a thread is waiting for room, it
+      # checks the queue's length again once it has the lock so it
+      # can't miss the room we've made
+      if self.waiting:
+         self.notFull.acquire()
+         try:
+            self.notFull.notifyAll()
+         finally:
+            self.notFull.release()
+
+   def drain(self, limit=None):
+      """Removes and returns up to limit queued calls as (f, args, kw)
+      tuples, all of them if limit is None."""
+      count = len(self.calls)
+      if limit is not None:
+         count = min(count, limit)
+      popleft = self.calls.popleft
+      batch = [popleft() for x in xrange(count)]
+      if count:
+         self._notifyWaiting()
+
+      now = time.time()
+      calls = []
+      for f, args, kw, queued, key in batch:
+         if key is not None:
+            # calls with the key can be queued again
+            self.keys.discard(key)
+         self.latency.tally(now - queued)
+         calls.append((f, args, kw))
+      return calls
+
+   def requeue(self, calls):
+      """Puts calls returned by drain() that were never made back at the
+      front of the queue, regardless of the size limit."""
+      now = time.time()
+      for f, args, kw in reversed(calls):
+         self.calls.appendleft((f, args, kw, now, None))
+
+   def clear(self):
+      self.calls.clear()
+      self.keys.clear()
+      self._notifyWaiting()
+
+
+class Waker(object):
+   """Wakes up a RunLoop that's asleep in it's poller. Used by other
+   threads and signal handlers after they've handed the RunLoop
+   something to do.
+
+   The RunLoop flags the waker as sleeping while it polls. wakeup()
+   only touches the descriptor when the RunLoop is asleep and hasn't
+   already been signaled, so a burst of wakeups costs a single write
+   and read. A wakeup that arrives while the RunLoop is busy just
+   marks the waker pending, which keeps the RunLoop from going to
+   sleep at the end of that pass. Uses an eventfd where the platform
+   has one, otherwise a non-blocking pipe.
+   """
+
+   def __init__(self):
+      # set by the RunLoop around it's call to poll()
+      self.sleeping = False
+      # True if woken while the RunLoop was busy
+      self.pending = False
+      # True from the time the descriptor is written until it's drained
+      self.signaled = False
+
+      # wakeups asked for vs the ones that actually hit the descriptor
+      self.requested = 0
+      self.sent = 0
+
+      if syscalls.eventfd is not None:
+         self.reader = self.writer = syscalls.eventfd(0)
+         self.signal = struct.pack('Q', 1)
+      else:
+         self.reader, self.writer = os.pipe()
+         for fd in (self.reader, self.writer):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NDELAY)
+         self.signal = 'x'
+
+   def __repr__(self):
+      return "<waker %s>" % self.reader
+
+   def fileno(self):
+      return self.reader
+
+   def wakeup(self):
+      self.requested += 1
+      self.pending = True
+      if self.sleeping and not self.signaled:
+         self.signaled = True
+         self.sent += 1
+         try:
+            os.write(self.writer, self.signal)
+         except OSError, e:
+            # a full pipe will wake the RunLoop just as well
+            if e.errno != errno.EAGAIN:
+               raise
+
+   def canRead(self, stream):
+      try:
+         os.read(self.reader, 4096)
+      except OSError, e:
+         if e.errno != errno.EAGAIN:
+            raise
+      # cleared only after draining, otherwise a write landing between
+      # the two would leave us signaled with nothing to read
+      self.signaled = False
+
+   def onError(self, error):
+      pass
+
+   def close(self):
+      os.close(self.reader)
+      if self.writer != self.reader:
+         os.close(self.writer)
+
+
+class LoopStats(object):
+   """Records where a RunLoop spends it's time, see
+   RunLoop.enableStats().
+
+   Every callback the RunLoop makes, calls from other threads, timers
+   and canRead()/canWrite(), is timed. Any that take slowCallback
+   seconds or more are kept in slowest and logged as a warning along
+   with where the code that ran lives and a stack. The stack is where
+   the callback raised if it did, otherwise where it was dispatched
+   from. It's only formatted for slow callbacks.
+
+   >>> stats = LoopStats(slowCallback=10)
+   >>> stats.call('timer', len, 'abc')
+   3
+   >>> stats.callbackTime.count, stats.slowCallbacks
+   (1.0, 0)
+   >>> sorted(stats.snapshot())[:3]
+   ['callbackTime', 'descriptors', 'lag']
+   """
+
+   # number of slow callbacks kept in slowest
+   keepSlowest = 20
+
+   def __init__(self, slowCallback=0.1, log=None):
+      self.slowCallback = slowCallback
+      self.log = log
+
+      self.passes = 0
+      self.pollTime = Stat('time blocked polling')
+      self.callbackTime = Stat('time in each callback')
+      self.descriptors = Stat('descriptors monitored')
+      self.timers = Stat('timers scheduled')
+      self.lag = Stat('timer lag')
+      self.slowCallbacks = 0
+      # (seconds, kind, description, stack) of recent slow callbacks
+      self.slowest = deque(maxlen=self.keepSlowest)
+
+   def startPass(self, runLoop):
+      self.passes += 1
+      self.descriptors.tally(len(runLoop.readers) + len(runLoop.writers))
+      self.timers.tally(len(runLoop.timers))
+
+   def call(self, kind, f, *args, **kw):
+      """Calls f(*args, **kw) and records how long it took."""
+      start = time.time()
+      trace = None
+      try:
+         try:
+            return f(*args, **kw)
+         except:
+            trace = sys.exc_info()[2]
+            raise
+      finally:
+         elapsed = time.time() - start
+         self.callbackTime.tally(elapsed)
+         if elapsed >= self.slowCallback:
+            if trace is not None:
+               stack = traceback.format_tb(trace)
+            else:
+               stack = traceback.format_stack(sys._getframe(1))
+            self.onSlowCallback(kind, f, elapsed, ''.join(stack))
+         del trace
+
+   def onSlowCallback(self, kind, f, elapsed, stack):
+      self.slowCallbacks += 1
+      description = describeCallable(f)
+      self.slowest.append((elapsed, kind, description, stack))
+      if self.log is not None:
+         self.log.warn("Slow %s callback took %.3fs: %s\n%s"
+                       % (kind, elapsed, description, stack.rstrip()))
+
+   def snapshot(self):
+      """Returns the stats as a dictionary of plain values."""
+      snapshot = {'passes': self.passes,
+                  'slowCallbacks': self.slowCallbacks,
+                  'slowest': list(self.slowest)}
+      for name in ('pollTime', 'callbackTime', 'descriptors', 'timers', 'lag'):
+         stat = getattr(self, name)
+         snapshot[name] = dict([(key, getattr(stat, key))
+                                for key in stat.keys_to_serialize])
+      return snapshot
+
+
+def describeCallable(f):
+   """Returns a string naming f and the file and line it's defined at.
+   DelayedCalls, Ports and Streams are described by what they'll end
+   up calling."""
+   target = getattr(f, 'im_self', None)
+   if isinstance(target, DelayedCall):
+      f = getattr(target, 'func', f)
+   elif target is not None and getattr(target, 'delegate', None) is not None:
+      return "%s of %r" % (getattr(f, '__name__', f), target)
+
+   code = getattr(getattr(f, 'im_func', f), 'func_code', None)
+   if code is None:
+      return repr(f)
+   return "%s (%s:%s)" % (getattr(f, '__name__', f), code.co_filename,
+                          code.co_firstlineno)
+
+
+def bestPoller():
+   """Returns the most scalable poller available on this platform."""
+   if hasattr(select, 'epoll'):
+      return EPollPoller
+   elif hasattr(select, 'poll'):
+      return PollPoller
+   else:
+      return SelectPoller
+
 
 
 class RunLoop(object):
@@ -848,6 +2480,12 @@ class RunLoop(object):
       our file descriptors has data ready to be read or written to; or
       our timeout has expired.
 
+      How we sleep is up to the RunLoop's poller, epoll on Linux,
+      poll() where it's available and select() everywhere else. The
+      choice is made once when the module loads, set
+      RunLoop.pollerClass before the first RunLoop is created to pick
+      a different one.
+
       When we wake up it's because  one of our descriptors
       are in the ready state, a timer has expired or both.
       
@@ -855,7 +2493,8 @@ class RunLoop(object):
       descriptors to be monitored and then notify the apportiate
       callback/delegate that it can now read or write the descriptor
       without blocking. Note: it's the responsabilty of the delegate
-      to ask the runLoop to remonitor a descriptor
+      to ask the runLoop to remonitor a descriptor, unless it was
+      added as a persistent source (see addReader())
 
       And that's it the loop starts over if there are any timers or
       descriptors left to be monitored.
@@ -955,22 +2594,77 @@ class RunLoop(object):
 
       """
       log = outlet("LogService")
-      
+
+      pollerClass = bestPoller()
+
+      # the class currentRunLoop() creates RunLoops with, None for
+      # whichever class it's called on. See AsyncioRunLoop.
+      implementation = None
+
+      # bounds the calls other threads can queue up with
+      # callFromThread(), see CallQueue for the policies
+      callQueueSize = 10000
+      callQueuePolicy = CallQueue.BLOCK
+      # most calls made from the queue in one pass, None for all that
+      # were waiting when the pass started
+      callBatchSize = None
+
+      # most timers fired and most ready descriptors serviced in one
+      # pass, None for all of them
+      timerBatchSize = None
+      eventBatchSize = None
+
+      # seconds the calls, timers and descriptors can each take up of
+      # a pass, None for no limit. At least one of each is always
+      # serviced. What's left over is seen to first on the next pass
+      # and the RunLoop won't sleep until it's done.
+      callTimeSlice = None
+      timerTimeSlice = None
+      eventTimeSlice = None
+
+      # most connections all listening ports together accept in one
+      # pass, None for no limit
+      acceptBudget = 1024
+
+      # a LoopStats while enableStats() is in effect
+      stats = None
+
       def __init__(self):
-            self.threadCallQueue = []
+            self.threadCallQueue = CallQueue(self.callQueueSize,
+                                             self.callQueuePolicy)
+            self.acceptsThisPass = 0
             self.readers = {}
             self.writers = {}
 
-            reader, writer = os.pipe()
-            self.wakerStream = Stream(reader, self)
-            
-            
-            # no need to use an output stream because a pipe is almost
-            # always going to be be ready to be written to
-            
-            self.waker = writer
+            self.poller = self.pollerClass()
+            # fd -> (mask, source) as last told to the poller
+            self._interest = {}
+            # descriptors whose interest changed since the last poll,
+            # they're synced right before we go to sleep so a source
+            # that's dispatched then readded costs nothing
+            self._changed = set()
+            # descriptors that stay registered after being dispatched
+            self.persistentReaders = set()
+            self.persistentWriters = set()
+            # buffers for ports and streams that read with readInto
+            self.buffers = BufferPool()
+
+            self.waker = Waker()
+            self.addReader(self.waker, True)
             self.running = False
-            self.timers = []
+            self.timers = TimingWheel()
+            self.sweeper = TimeoutSweeper(self)
+            # ready descriptors we didn't get to last pass
+            self.readyReads = []
+            self.readyWrites = []
+            # how late timers fire
+            self.lag = Stat('run loop lag')
+            # bumped at the start of every pass and whenever we wake
+            # from polling, see Watchdog
+            self.progress = 0
+            # True while a thread is inside runOnce(), a RunLoop
+            # that's stopped or yet to start isn't stalled
+            self.active = False
 
             
 
@@ -980,14 +2674,9 @@ class RunLoop(object):
             try:
                   runLoop = ThreadStorageService.getFromCurrent('RunLoop')
             except KeyError:
-                  runLoop = klass()
+                  runLoop = (klass.implementation or klass)()
                   ThreadStorageService.addToCurrent('RunLoop', runLoop)
 
-                  # async read one, byte which will schedules in the
-                  # runLoop, can't do this in init because we'd
-                  # recures back to this currentRunLoop call
-                  runLoop.wakerStream.read(1)
-
             return runLoop
       
       currentRunLoop = classmethod(currentRunLoop)
@@ -1001,27 +2690,142 @@ class RunLoop(object):
       runLoopForThread = classmethod(runLoopForThread)
 
       
-      def addReader(self, source): 
-            self.readers[source.fileno()] = source
+      def addReader(self, source, persistent=False):
+            """Monitors the source and calls source.canRead() when it can
+            be read without blocking.
+
+            By default the source is removed from the RunLoop before
+            canRead() is called and it's up to the source to add itself
+            back. A persistent source stays registered until it's
+            explicitly removed with removeReader(), sparing busy
+            connections the work of reregistering after every event. It's
+            then up to the source to remove itself when it's no longer
+            interested otherwise canRead() will be called on every pass
+            while there's data waiting.
+            """
+            fd = source.fileno()
+            self.readers[fd] = source
+            if persistent:
+                  self.persistentReaders.add(fd)
+            else:
+                  self.persistentReaders.discard(fd)
+            self._changed.add(fd)
 
       def removeReader(self, source):
-            del self.readers[source.fileno()]
-
-      def addWriter(self, source):
-
-            self.writers[source.fileno()] = source
+            fd = source.fileno()
+            self.persistentReaders.discard(fd)
+            try:
+                  del self.readers[fd]
+            finally:
+                  # sources remove themselves right before closing
+                  # their descriptor, so tell the poller now rather
+                  # than on the next pass.
+                  self._updateInterest(fd)
+
+      def addWriter(self, source, persistent=False):
+            """Monitors the source and calls source.canWrite() when it can
+            be written to without blocking. See addReader() for the
+            meaning of persistent.
+            """
+            fd = source.fileno()
+            self.writers[fd] = source
+            if persistent:
+                  self.persistentWriters.add(fd)
+            else:
+                  self.persistentWriters.discard(fd)
+            self._changed.add(fd)
 
       def removeWriter(self, source):
-            del self.writers[source.fileno()]
-            
+            fd = source.fileno()
+            self.persistentWriters.discard(fd)
+            try:
+                  del self.writers[fd]
+            finally:
+                  self._updateInterest(fd)
+
+      def _updateInterest(self, fd):
+            # Internal method, brings the poller in line with the
+            # readers and writers for the given descriptor
+            self._changed.discard(fd)
+
+            mask = 0
+            source = self.readers.get(fd)
+            if source is not None:
+                  mask = POLL_READ
+            writer = self.writers.get(fd)
+            if writer is not None:
+                  mask |= POLL_WRITE
+                  source = source or writer
+
+            current, registered = self._interest.get(fd, (0, None))
+            if mask == current and source is registered:
+                  return
+
+            if not mask:
+                  del self._interest[fd]
+                  self.poller.unregister(fd)
+                  return
+
+            if registered is source:
+                  self.poller.modify(fd, mask)
+            else:
+                  if registered is not None:
+                        # descriptor was reused by a different source
+                        self.poller.unregister(fd)
+                  self.poller.register(fd, mask)
+            self._interest[fd] = (mask, source)
+
+      def _syncInterest(self):
+            for fd in list(self._changed):
+                  self._updateInterest(fd)
+
 
       def reset(self):
          self.running = False
          self.readers = {}
          self.writers = {}
-         self.timers  = []
-         self.threadCallQueue = []
-         self.wakerStream.read(1)
+         self.poller.close()
+         self.poller = self.pollerClass()
+         self._interest = {}
+         self._changed = set()
+         self.persistentReaders = set()
+         self.persistentWriters = set()
+         self.timers  = TimingWheel()
+         self.sweeper = TimeoutSweeper(self)
+         self.readyReads = []
+         self.readyWrites = []
+         self.threadCallQueue.clear()
+         self.addReader(self.waker, True)
+
+      def afterFork(self):
+         """Prepares a RunLoop inherited from the parent for use in a
+         forked child.
+
+         The child gets it's own poller and waker, sharing them with
+         the parent would let either process steal the other's events.
+         Every reader, writer and timer is kept, so a child can go on
+         to service the ports the parent set up, but calls queued for
+         the parent are dropped.
+         """
+         self.running = False
+         fd = self.waker.fileno()
+         self.readers.pop(fd, None)
+         self.persistentReaders.discard(fd)
+         self.waker.close()
+
+         self.poller.close()
+         self.poller = self.pollerClass()
+         self._interest = {}
+         self._changed = set(self.readers) | set(self.writers)
+         self.readyReads = []
+         self.readyWrites = []
+
+         # a thread in the parent could have been holding the queue's
+         # lock, it doesn't exist in the child to release it
+         self.threadCallQueue = CallQueue(self.callQueueSize,
+                                          self.callQueuePolicy)
+         self.waker = Waker()
+         self.addReader(self.waker, True)
 
       def _shouldRun(self,timerCapacity):
          # Internal method, determines if the runLoop should be stooped.
@@ -1137,22 +2941,46 @@ class RunLoop(object):
             
 
       def runOnce(self):
+         active, self.active = self.active, True
+         try:
+            self._runPass()
+         finally:
+            self.active = active
+
+      def _runPass(self):
 
          # call every fucnction that was queued via callFromThread up
          # until this point, but nothing more. If not we could be
          # stuck doing this forever and never getting to the other calls
          
-         pending = len(self.threadCallQueue)
-         tried   = 0
+         self.waker.pending = False
+         self.acceptsThisPass = 0
+         self.progress += 1
+         stats = self.stats
+         if stats:
+            stats.startPass(self)
+         # whoever runs us is the one thread that must never block on
+         # a full queue
+         self.threadCallQueue.owner = thread.get_ident()
+         calls = self.threadCallQueue.drain(self.callBatchSize)
+         tried = 0
          try:
-            for (f, a, kw) in self.threadCallQueue[:pending]:
+            deadline = self._sliceEnd(self.callTimeSlice)
+            for (f, a, kw) in calls:
+               if deadline and tried and time.time() >= deadline:
+                  break
                tried += 1
-               f(*a, **kw)
+               if stats:
+                  stats.call('thread', f, *a, **kw)
+               else:
+                  f(*a, **kw)
                
          finally:
-            # it's possible that more calls could have came in since we
-            # started, bu they should be on the end of the list
-            del self.threadCallQueue[:tried]
+            if tried < len(calls):
+               # a call raised or we ran out of time, the ones we
+               # didn't get to go back on the front of the queue for
+               # the next pass
+               self.threadCallQueue.requeue(calls[tried:])
 
 
          # we sleep until we either receive data or our earliest
@@ -1162,38 +2990,66 @@ class RunLoop(object):
          currentTime = time.time()
          # fire every timer that's expired
 
-         while self.timers:
-               timer   = heapq.heappop(self.timers)
-               if timer.cancelled:
-                     continue
-
-               timeout = timer.time - currentTime
-               if timeout <= 0:
-                     # it's expired call it
-                     timer.onTimeout()
+         expired = self.timers.expire(currentTime)
+         if self.timerBatchSize is not None:
+               self._carryTimers(expired[self.timerBatchSize:])
+               expired = expired[:self.timerBatchSize]
+         fired = 0
+         try:
+               deadline = self._sliceEnd(self.timerTimeSlice)
+               for timer in expired:
+                     now = time.time()
+                     if deadline and fired and now >= deadline:
+                           break
+                     fired += 1
+                     # how far behind we're running
+                     self.lag.tally(max(now - timer.time, 0))
+                     if stats:
+                           stats.call('timer', timer.onTimeout)
+                     else:
+                           timer.onTimeout()
+         finally:
+               if fired < len(expired):
+                     # a timer raised or we ran out of time, the rest
+                     # go back on the wheel, overdue, for the next
+                     # pass
+                     self._carryTimers(expired[fired:])
+
+         # from here on other threads have to wake us if they hand us
+         # something to do
+         self.waker.sleeping = True
+         try:
+               if self.timers:
+                     timeout = self.timers.timeout(currentTime)
                else:
-                     # this timer hasn't expired put it back on the list
-                     heapq.heappush(self.timers, timer)
-                     break
-
-         else:
-               if (len(self.readers) + len(self.writers)) <= 1:
-                     # we don't have any timers, if we're not monitoring
-                     # any descriptors we need to bail
-                     return
+                     if (len(self.readers) + len(self.writers)) <= 1:
+                           # we don't have any timers, if we're not monitoring
+                           # any descriptors we need to bail
+                           return
+                     else:
+                           # no timed events but we have file descriptors
+                           # to monitor so sleep until they have
+                           # activity.
+
+                           timeout = None 
+
+               if (self.waker.pending or self.threadCallQueue or
+                   self.readyReads or self.readyWrites):
+                     # someone woke us while we were busy, or we
+                     # didn't get through everything last pass,
+                     # there's more to do so don't go to sleep
+                     timeout = 0
+
+               self._syncInterest()
+               if stats:
+                     start = time.time()
+                     try:
+                           ready2Read, ready2Write = self.poller.poll(timeout)
+                     finally:
+                           stats.pollTime.tally(time.time() - start)
                else:
-                     # no timed events but we have file descriptors
-                     # to monitor so sleep until they have
-                     # activity.
-
-                     timeout = None 
-
-         try:
-               ready2Read, ready2Write, hadErrors =\
-                           select.select(self.readers.keys(), 
-                                         self.writers.keys(), 
-                                         [], timeout)
-         except (select.error, IOError), e:
+                     ready2Read, ready2Write = self.poller.poll(timeout)
+         except (select.error, IOError, OSError), e:
                if e.args[0] == errno.EINTR:
 
                      # a signal interupted our select, hopefully
@@ -1206,14 +3062,42 @@ class RunLoop(object):
                  return
                else:
                      raise
+         finally:
+               self.waker.sleeping = False
+               self.progress += 1
+
+         # descriptors we didn't get to last pass go first
+         if self.readyReads:
+               ready2Read = self._carryEvents(ready2Read, self.readyReads)
+         if self.readyWrites:
+               ready2Write = self._carryEvents(ready2Write, self.readyWrites)
+
+         dispatched = 0
+         deadline = self._sliceEnd(self.eventTimeSlice)
+         while ready2Read or ready2Write:
+               if dispatched and (
+                     (self.eventBatchSize is not None and
+                      dispatched >= self.eventBatchSize) or
+                     (deadline and time.time() >= deadline)):
+                     # out of budget, the rest wait for the next pass
+                     break
+               dispatched += 1
 
-         while ready2Read or ready2Write or hadErrors:
                # note the popping alows us not get hung up doing all reads all writes
                # at once, not sure how useful this is.
                if ready2Read:
                      fileno = ready2Read.pop()
-                     stream = self.readers.pop(fileno)
-                     stream.canRead(stream)
+                     # stream will be none if a method called earlier
+                     # in this pass removed it
+                     if fileno in self.persistentReaders:
+                       stream = self.readers.get(fileno)
+                     else:
+                       stream = self.readers.pop(fileno, None)
+                       self._changed.add(fileno)
+                     if stream and stats:
+                       stats.call('read', stream.canRead, stream)
+                     elif stream:
+                       stream.canRead(stream)
                      #stream.handleEvent(stream,Stream.HAS_BYTES_AVAILABLE)
 
                if ready2Write:
@@ -1222,35 +3106,113 @@ class RunLoop(object):
                      # avoid an infinite loop an app that wishes to
                      # read the data they must call addWriter()
                      # again
-                     stream = self.writers.pop(writer, None)
+                     if writer in self.persistentWriters:
+                       stream = self.writers.get(writer)
+                     else:
+                       stream = self.writers.pop(writer, None)
+                       self._changed.add(writer)
                      # stream will be none if a method called during ready2read removed
                      # it prior to checking the writers.
-                     if stream: 
+                     if stream and stats:
+                       stats.call('write', stream.canWrite, stream)
+                     elif stream: 
                        stream.canWrite(stream)
                         #stream.handleEvent(stream, Stream.HAS_SPACE_AVAILABLE)
+
+         self.readyReads = ready2Read
+         self.readyWrites = ready2Write
+
+      def _sliceEnd(self, seconds):
+            # when a time slice starting now ends, None for no limit
+            if seconds is not None:
+                  return time.time() + seconds
+
+      def _carryTimers(self, timers):
+            # Internal method, puts expired timers we didn't get to
+            # back on the wheel. They're overdue so they'll be the
+            # first ones handed back next pass.
+            for timer in timers:
+                  self.timers.add(timer)
+            self.timers.firedCount -= len(timers)
+
+      def _carryEvents(self, ready, carried):
+            # Internal method, returns the descriptors the poller just
+            # reported with the ones carried over from the last pass on
+            # the end, where they're popped from first, each only once.
+            carried = [fd for fd in carried
+                       if fd in self.readers or fd in self.writers]
+            seen = set(carried)
+            return [fd for fd in ready if fd not in seen] + carried
+
       def stop(self):
             self.running = False # this will drop us out of the runLoop on it's next pass
             self.wakeup()
 
       def addTimer(self, timer):
-            heapq.heappush(self.timers, timer)
+            """Schedules the timer. Timers belong to the RunLoop's
+            thread, one added from another thread is handed over with
+            callFromThread(). Cancel or push back timers from the
+            RunLoop's thread only."""
+            if thread.get_ident() != self.threadCallQueue.owner:
+                  self.callFromThread(self.timers.add, timer)
+                  return timer
+            self.timers.add(timer)
             self.wakeup()
             # we return the timer for convienance sake
             return timer
 
       def wakeup(self):
-            os.write(self.waker, 'x') # write one byte to wake up the runLoop
+            self.waker.wakeup()
 
-      def onRead(self, stream, data):
-
-            # we've been woken up, ignore the data and readAgain which
-            # should schedule us once more back in the runLoop
-            stream.read(1)
+      def enableStats(self, slowCallback=0.1):
+            """Starts recording where the RunLoop spends it's time,
+            logging callbacks that take longer than slowCallback
+            seconds. Returns the LoopStats the figures are kept in."""
+            try:
+                  log = self.log
+            except AttributeError:
+                  log = None
+            self.stats = LoopStats(slowCallback, log)
+            self.stats.lag = self.lag
+            return self.stats
+
+      def disableStats(self):
+            self.stats = None
+
+      def acceptsLeft(self):
+            """Returns how many more connections listening ports can
+            accept in this pass."""
+            if self.acceptBudget is None:
+                  return sys.maxint
+            return max(self.acceptBudget - self.acceptsThisPass, 0)
 
       def callFromThread(self, f, *args, **kw):
+            """Schedules f(*args, **kw) to be called from the RunLoop's
+            thread on it's next pass. Safe to call from any thread.
+
+            If the queue is full the RunLoop's callQueuePolicy decides
+            whether the caller waits, the call is dropped or Queue.Full
+            is raised. Returns False if the call was dropped.
+            """
             assert callable(f), "%s is not callable" % f
-            self.threadCallQueue.append((f, args, kw))
+            queued = self.threadCallQueue.put(f, args, kw)
             self.wakeup()
+            return queued
+
+      def callFromThreadOnce(self, key, f, *args, **kw):
+            """Like callFromThread() but f isn't queued again while a
+            call made with the same key is still waiting to be made.
+            For coalescing notifications, like signals, that only
+            need handling once however often they arrive.
+
+            The key is forgotten when the call is taken off the queue
+            or the queue is cleared, as it is when the RunLoop is
+            reset or forks.
+            """
+            assert callable(f), "%s is not callable" % f
+            queued = self.threadCallQueue.put(f, args, kw, key)
+            self.wakeup()
+            return queued
 
       def waitBeforeCalling(self, seconds, method, *args,  **kw):
             # Create a non repeating event
@@ -1278,22 +3240,24 @@ class RunLoop(object):
          return dc
          
       def clear_bad_descriptor(self):
-        # ugh not pretty when this happens
+        # ugh not pretty when this happens, find the descriptors that
+        # were closed without being removed from the runLoop and
+        # drop them.
         
-        for key in self.readers.keys():
+        for key in set(self.readers.keys() + self.writers.keys()):
           try:
-            select.select([key],[],[], 0)
-          except Exception, e:
-            bad = self.readers.pop(key)
-            bad.onError(e)
+            os.fstat(key)
+          except OSError, e:
+            reader = self.readers.pop(key, None)
+            writer = self.writers.pop(key, None)
+            self.persistentReaders.discard(key)
+            self.persistentWriters.discard(key)
+            for bad in set([reader, writer]) - set([None]):
+              bad.onError(e)
+            self._interest.pop(key, None)
+            self._changed.discard(key)
+            self.poller.unregister(key)
 
-        for key in self.writers.keys():
-          try:
-            select.select([],[key],[], 0)
-          except Exception, e:
-            bad = self.writers.pop(key)
-            bad.onError(e)
-        
             
 
 
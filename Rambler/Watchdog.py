@@ -0,0 +1,141 @@
+"""Notices when a RunLoop stops making progress.
+
+A component that makes a synchronous database call or spins in a long
+loop on a RunLoop's thread stalls every port and timer the RunLoop
+services. The Watchdog's thread keeps an eye on each RunLoop it's
+given, when one has been busy in the same pass for longer than
+threshold seconds it grabs the stack of the RunLoop's thread, logs it
+and counts the stall.
+
+  >>> import thread
+  >>> from Rambler.RunLoop import RunLoop
+  >>> watchdog = Watchdog(threshold=.5)
+  >>> watchdog.watch(RunLoop.currentRunLoop(), thread.get_ident())
+  >>> watchdog.start()
+  >>> watchdog.stop()
+
+A RunLoop waiting for something to do isn't stalled, no matter how
+long it waits, and neither is one that isn't running, because it's
+yet to start or has stopped.
+"""
+
+import sys
+import thread
+import threading
+import time
+from collections import deque
+
+from Rambler.services.DebugService import formatStack
+
+
+class Watch(object):
+  """What the Watchdog knows about one RunLoop."""
+
+  def __init__(self, runLoop, threadId):
+    self.runLoop = runLoop
+    self.threadId = threadId
+    # RunLoop.progress when we last saw it move and when that was
+    self.progress = runLoop.progress
+    self.since = time.time()
+    # True once the current stall has been reported
+    self.reported = False
+    self.stalls = 0
+
+
+class Watchdog(threading.Thread):
+  """Logs the stack of any watched RunLoop that's been busy with one
+  pass for threshold seconds or more.
+
+  The RunLoops are checked every interval seconds, by default a
+  quarter of the threshold, so a stall is reported between threshold
+  and threshold + interval seconds after it started. Each stall is
+  reported once no matter how long it lasts.
+  """
+
+  # stalls kept in reports
+  keepReports = 20
+
+  def __init__(self, threshold=1.0, interval=None, log=None):
+    threading.Thread.__init__(self, name="Watchdog")
+    self.setDaemon(True)
+    self.threshold = threshold
+    self.interval = interval or threshold / 4.0
+    self.log = log
+    self.watches = {}
+    self.lock = threading.Lock()
+    self.stopped = threading.Event()
+
+    self.stalls = 0
+    # (thread id, seconds stalled so far, stack) of recent stalls
+    self.reports = deque(maxlen=self.keepReports)
+
+  def watch(self, runLoop, threadId=None):
+    """Starts watching the RunLoop run by the given thread, which
+    defaults to the calling thread."""
+    if threadId is None:
+      threadId = thread.get_ident()
+    self.lock.acquire()
+    try:
+      self.watches[id(runLoop)] = Watch(runLoop, threadId)
+    finally:
+      self.lock.release()
+
+  def unwatch(self, runLoop):
+    self.lock.acquire()
+    try:
+      self.watches.pop(id(runLoop), None)
+    finally:
+      self.lock.release()
+
+  def stallsFor(self, runLoop):
+    """Returns the number of times the RunLoop has stalled."""
+    watch = self.watches.get(id(runLoop))
+    return watch and watch.stalls or 0
+
+  def run(self):
+    while not self.stopped.isSet():
+      self.check()
+      self.stopped.wait(self.interval)
+
+  def stop(self, timeout=None):
+    self.stopped.set()
+    if self.isAlive():
+      self.join(timeout)
+
+  def check(self, now=None):
+    """Looks over every watched RunLoop, reporting new stalls."""
+    if now is None:
+      now = time.time()
+
+    self.lock.acquire()
+    try:
+      watches = self.watches.values()
+    finally:
+      self.lock.release()
+
+    for watch in watches:
+      runLoop = watch.runLoop
+      progress = runLoop.progress
+      if (progress != watch.progress or runLoop.waker.sleeping or
+          not runLoop.active):
+        # moving along, waiting on the poller or not running at all,
+        # all of which are fine
+        watch.progress = progress
+        watch.since = now
+        watch.reported = False
+      elif not watch.reported and now - watch.since >= self.threshold:
+        watch.reported = True
+        self.onStall(watch, now - watch.since)
+
+  def onStall(self, watch, seconds):
+    watch.stalls += 1
+    self.stalls += 1
+
+    frame = sys._current_frames().get(watch.threadId)
+    stack = formatStack(frame)
+    del frame
+    self.reports.append((watch.threadId, seconds, stack))
+
+    if self.log is not None:
+      self.log.warn("RunLoop in thread %s has been blocked for %.3fs:\n%s"
+                    % (watch.threadId, seconds, stack))
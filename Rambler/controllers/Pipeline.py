@@ -0,0 +1,150 @@
+from __future__ import with_statement
+import os
+import sys
+
+from Rambler import component
+
+
+class Pipeline(component('Operation')):
+  """Runs Tasks like a shell pipeline, each Task's stdout is connected
+  straight to the next one's stdin with an OS pipe so the data passed
+  between them never goes through python.
+
+  The delegate sees the pipeline rather than the Tasks. What's written
+  to the pipeline goes to the first Task's stdin, on_stdout() gets the
+  last Task's output and on_stderr() gets what any of them write to
+  stderr. on_exit() is called once every Task has exited.
+
+  >> gzip = Task()
+  >> gzip.launch_path = 'gzip'
+  >> gzip.args = ['-dc', 'access.log.gz']
+  >> grep = Task()
+  >> grep.launch_path = 'grep'
+  >> grep.args = ['GET']
+  >> pipeline = Pipeline.new(gzip, grep)
+  >> pipeline.delegate = delegate
+  >> queue.add_operation(pipeline)
+  """
+  is_concurrent = True
+
+  @classmethod
+  def new(cls, *tasks):
+    pipeline = cls()
+    pipeline.tasks = list(tasks)
+    return pipeline
+
+  def __init__(self):
+    super(Pipeline, self).__init__()
+    self.tasks = []
+    self.delegate = None
+    self.exited = 0
+
+  def __repr__(self):
+    return "Pipeline(%s)" % ' | '.join([task.launch_path or '' for task in self.tasks])
+
+  def start(self):
+    """Begins execution of the Operation."""
+    if self.is_cancelled:
+      with self.changing('is_finished'):
+        self.finished = True
+      return
+
+    with self.changing('is_executing'):
+      self.executing = True
+      self.launch()
+
+  def launch(self):
+    """Launches every Task, connecting each one's stdout to the next
+    one's stdin.
+
+    If a Task fails to launch the pipe ends no Task took are closed
+    and the Tasks already running are killed before the error is
+    raised.
+    """
+    last = len(self.tasks) - 1
+    read = None
+    # pipe ends made but not yet handed to a launched Task
+    pending = []
+    try:
+      for i, task in enumerate(self.tasks):
+        task.delegate = self
+        task.standard_input = read
+        if i < last:
+          read, task.standard_output = os.pipe()
+          pending.extend([read, task.standard_output])
+        # the Task closes the ends it was given once it's launched
+        task.launch()
+        pending = [fd for fd in pending
+                   if fd not in (task.standard_input, task.standard_output)]
+    except:
+      exc_info = sys.exc_info()
+      for fd in pending:
+        try:
+          os.close(fd)
+        except OSError:
+          pass
+      self.terminate()
+      raise exc_info[0], exc_info[1], exc_info[2]
+
+  def write(self, data):
+    """Writes data to the first Task's stdin."""
+    self.tasks[0].write(data)
+
+  def close(self):
+    """Closes the first Task's stdin once everything written has been
+    sent."""
+    self.tasks[0].close()
+
+  def terminate(self):
+    """Kills every Task that's still running."""
+    for task in self.tasks:
+      if task.process_id and task._rc is None:
+        try:
+          task.terminate()
+        except OSError:
+          pass
+
+  @property
+  def termination_statuses(self):
+    return [task.termination_status for task in self.tasks]
+
+  @property
+  def termination_status(self):
+    """The status of the last Task that failed, 0 if they all
+    succeeded. None until they've all exited."""
+    statuses = self.termination_statuses
+    if None in statuses:
+      return None
+    failed = [status for status in statuses if status]
+    return failed and failed[-1] or 0
+  result = termination_status
+
+  # Task delegate methods
+
+  def on_stdout(self, task, data):
+    if self.delegate:
+      self.delegate.on_stdout(self, data)
+
+  def on_stderr(self, task, data):
+    if self.delegate and hasattr(self.delegate, 'on_stderr'):
+      self.delegate.on_stderr(self, data)
+
+  def on_stdin(self, task, bytes):
+    if self.delegate:
+      self.delegate.on_stdin(self, bytes)
+
+  def on_close(self, task, stream):
+    if self.delegate:
+      self.delegate.on_close(self, stream)
+
+  def on_exit(self, task):
+    self.exited += 1
+    if self.exited < len(self.tasks):
+      return
+
+    with self.changing('is_finished', 'is_executing'):
+      self.executing = False
+      self.finished = True
+      if self.delegate:
+        self.delegate.on_exit(self)
+        self.delegate = None
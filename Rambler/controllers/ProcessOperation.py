@@ -0,0 +1,64 @@
+from __future__ import with_statement
+from Rambler import component, outlet
+
+from Rambler.controllers.InvocationOperation import OperationCancelled
+
+
+class ProcessOperation(component('Operation')):
+  """Operation that runs a picklable callable in one of the ProcessPool's
+  worker processes, for CPU bound work that would otherwise hold the GIL.
+
+  Added to an OperationQueue it's started like any concurrent operation,
+  it finishes once the worker sends back the result.
+  """
+  ProcessPool = outlet('ProcessPool')
+  is_concurrent = True
+
+  @classmethod
+  def new(cls, function, *args, **kw):
+    op = cls()
+    op.function = function
+    op.args = args
+    op.kw = kw
+    return op
+
+  def __init__(self):
+    self._result = None
+    self.function = None
+    self.args = ()
+    self.kw = {}
+    super(ProcessOperation, self).__init__()
+
+  def __repr__(self):
+    return "ProcessOperation(%s)" % getattr(self.function, '__name__', self.function)
+
+  def start(self):
+    if self.is_cancelled:
+      with self.changing('is_finished'):
+        self._result = OperationCancelled()
+        self.finished = True
+      return
+
+    with self.changing('is_executing'):
+      self.executing = True
+    deferred = self.ProcessPool.submit(self.function, *self.args, **self.kw)
+    deferred.addCallbacks(self.succeeded, self.failed)
+
+  def succeeded(self, result):
+    self.finish(result)
+
+  def failed(self, failure):
+    self.finish(failure.value)
+
+  def finish(self, result):
+    with self.changing('is_finished', 'is_executing'):
+      self._result = result
+      self.executing = False
+      self.finished = True
+
+  @property
+  def result(self):
+    if isinstance(self._result, Exception):
+      raise self._result
+    else:
+      return self._result
@@ -3,13 +3,65 @@ import sys
 import traceback
 import signal
 import errno
+import time
 
 from Rambler import outlet, component
+from Rambler.controllers.Stat import Stat
 
 #TODO: Move Stream to a component
 from Rambler.RunLoop import Stream
 
 
+class RingBuffer(object):
+  """Keeps the last capacity bytes written to it, in a buffer that's
+  allocated once.
+  
+  >>> ring = RingBuffer(8)
+  >>> ring.write('hello ')
+  >>> ring.getvalue(), ring.truncated
+  ('hello ', False)
+  >>> ring.write('world')
+  >>> ring.getvalue(), ring.truncated
+  ('lo world', True)
+  """
+  
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self.data = bytearray(capacity)
+    # where the next byte goes
+    self.end = 0
+    self.size = 0
+    # True once older bytes have been dropped to make room
+    self.truncated = False
+    
+  def __len__(self):
+    return self.size
+    
+  def write(self, data):
+    count = len(data)
+    if self.size + count > self.capacity:
+      self.truncated = True
+      
+    if count >= self.capacity:
+      self.data[:] = data[count - self.capacity:]
+      self.end = 0
+      self.size = self.capacity
+      return
+      
+    first = min(count, self.capacity - self.end)
+    self.data[self.end:self.end + first] = data[:first]
+    # whatever didn't fit before the end wraps around to the front
+    self.data[:count - first] = data[first:]
+    self.end = (self.end + count) % self.capacity
+    self.size = min(self.size + count, self.capacity)
+    
+  def getvalue(self):
+    start = (self.end - self.size) % self.capacity
+    if start + self.size <= self.capacity:
+      return str(self.data[start:start + self.size])
+    return str(self.data[start:] + self.data[:self.end])
+
+
 
 class Task(component('Operation')):
   """Used to launch and interact with a subprocess asynchronously. 
@@ -104,7 +156,20 @@ class Task(component('Operation')):
   except:
       MAXFD = 256
 
+  # lists the descriptors a process has open, see _close_fds()
+  FD_DIR = '/proc/self/fd'
+
+  # how long launch() takes to fork the child and set up the pipes
+  launch_time = Stat('task launch time')
+
+  # reads start at byte_size, doubling while they come back full up to
+  # max_byte_size and halving again when they come back mostly empty
   byte_size = 1024 * 8
+  max_byte_size = 1024 * 1024
+  
+  # when set the last capture_limit bytes of stdout and stderr are kept
+  # in stdout_capture and stderr_capture, see RingBuffer
+  capture_limit = None
   
   @classmethod
   def assembled(cls):
@@ -116,35 +181,56 @@ class Task(component('Operation')):
   @classmethod
   def on_sig_child(cls, signum, frame):
     """A child has died, we'll figure out which on the next pass through the runLoop"""
-    cls.mainRunLoop.callFromThread(cls.reap_child,signum,frame)
+    # signals that arrive before the queued reap_child runs are
+    # coalesced into it, it reaps every child that's exited
+    cls.mainRunLoop.callFromThreadOnce('Task.reap_child', cls.reap_child,signum,frame)
     del frame
     
   @classmethod
   def reap_child(cls, signum, frame):
+    """Reaps every child that has exited, several children exiting
+    together only raise one SIGCHLD."""
     try:
-      try:
-        pid, sts = os.waitpid(0,os.WNOHANG)
-      except OSError, e:
-        if e.errno != errno.ECHILD:
-          raise
-        pid = 0
-        
-      if pid == 0:
-        cls.log.warn('reap_child called with sig %s but there is no dead child', signum)
-      else:
-        task = cls.__tasks.pop(pid, None)
-  
-        if task:
-          with task.changing('is_finished', 'is_executing'):
-            task.finished = True
-            task.executing = False
-    
-            task._handle_exitstatus(sts)
-            if task.delegate:
-              task.delegate.on_exit(task)
-              task.delegate = None
+      reaped = 0
+      while True:
+        try:
+          pid, sts = os.waitpid(0,os.WNOHANG)
+        except OSError, e:
+          if e.errno != errno.ECHILD:
+            raise
+          pid = 0
+        if pid == 0:
+          break
+
+        reaped += 1
+        try:
+          cls.child_exited(pid, sts)
+        except:
+          # keep reaping, the other children's delegates still need
+          # to hear about it
+          cls.log.exception('Error notifying the task for child %s', pid)
+
+      if not reaped:
+        # expected now and then, a child that exits while we're
+        # reaping gets reaped before it's signal is handled
+        cls.log.debug('reap_child called with sig %s but there is no dead child', signum)
     finally:
       del frame
+
+  @classmethod
+  def child_exited(cls, pid, sts):
+    task = cls.__tasks.pop(pid, None)
+
+    if task:
+      with task.changing('is_finished', 'is_executing'):
+        task.finished = True
+        task.executing = False
+
+        task._handle_exitstatus(sts)
+        task._drain_output()
+        if task.delegate:
+          task.delegate.on_exit(task)
+          task.delegate = None
       
     
   def __init__(self):
@@ -159,9 +245,27 @@ class Task(component('Operation')):
     self._rc = None
     self.descriptors = set()
 
+    # descriptors to use as the child's stdin and stdout rather than
+    # pipes read and written through the RunLoop, see Pipeline. The
+    # Task closes it's copy once the child is launched.
+    self.standard_input = None
+    self.standard_output = None
+
     # number of bytes waiting to be writtent/read by the child. 
     self.bytes_buffered = 0
     self.should_close = False
+
+    # stream -> bytes asked for by the next read
+    self.read_sizes = {}
+    self.stdout_capture = None
+    self.stderr_capture = None
+
+    self.stdin_bytes = 0
+    self.stdout_bytes = 0
+    self.stderr_bytes = 0
+    self.reads = 0
+    self.launched_at = None
+    self.exited_at = None
     
   def start(self):
     """Begins execution of the Operation."""
@@ -189,14 +293,24 @@ class Task(component('Operation')):
     """
 
     self.log.info(self.launch_path)    
+    started = self.launched_at = time.time()
+    if self.capture_limit:
+      self.stdout_capture = RingBuffer(self.capture_limit)
+      self.stderr_capture = RingBuffer(self.capture_limit)
     
-    self.read_stdin, self.stdin = os.pipe()
-    #self.log.info('\tstdin opened %s %s',self.read_stdin, self.stdin)
-    self.stdin = Stream(self.stdin, self)
+    if self.standard_input is None:
+      self.read_stdin, self.stdin = os.pipe()
+      #self.log.info('\tstdin opened %s %s',self.read_stdin, self.stdin)
+      self.stdin = Stream(self.stdin, self)
+    else:
+      self.read_stdin, self.stdin = self.standard_input, None
     
-    self.stdout, self.write_stdout = os.pipe()
-    #self.log.info('\tstdout opened %s %s',self.stdout, self.write_stdout)
-    self.stdout = Stream(self.stdout, self)
+    if self.standard_output is None:
+      self.stdout, self.write_stdout = os.pipe()
+      #self.log.info('\tstdout opened %s %s',self.stdout, self.write_stdout)
+      self.stdout = Stream(self.stdout, self)
+    else:
+      self.stdout, self.write_stdout = None, self.standard_output
     
     self.stderr, self.write_stderr = os.pipe()
     #self.log.info('\tstdout opened %s %s',self.stdout, self.write_stdout)
@@ -213,8 +327,10 @@ class Task(component('Operation')):
       os.close(self.read_stdin)
       os.close(self.write_stdout)
       os.close(self.write_stderr)
-      self.stdout.read(self.byte_size)
+      if self.stdout is not None:
+        self.stdout.read(self.byte_size)
       self.stderr.read(self.byte_size)
+      Task.launch_time.tally(time.time() - started)
       
  
   @property
@@ -229,6 +345,32 @@ class Task(component('Operation')):
     """Kill the process prematuraly"""
     os.kill(self.process_id, signal.SIGKILL)
 
+  def wait(self, timeout=None):
+    """Blocks until the process exits, or timeout seconds have passed,
+    reaping it as the SIGCHLD handler would. Returns the
+    termination_status, None if it's still running."""
+    expires = timeout is not None and time.time() + timeout
+    while self._rc is None:
+      try:
+        pid, sts = os.waitpid(self.process_id, timeout is not None and os.WNOHANG)
+      except OSError, e:
+        if e.errno == errno.EINTR:
+          continue
+        if e.errno != errno.ECHILD:
+          raise
+        # somebody else reaped it
+        break
+
+      if pid:
+        Task.child_exited(pid, sts)
+        if self._rc is None:
+          self._handle_exitstatus(sts)
+      elif time.time() >= expires:
+        break
+      else:
+        time.sleep(0.01)
+    return self._rc
+
 
   # Process checking code copied from Python's subprocess module
   @property
@@ -243,7 +385,19 @@ class Task(component('Operation')):
           self._rc = _deadstate
     return self._rc
   result = termination_status
+  @property
+  def throughput(self):
+    """Bytes per second read from the child's stdout and stderr while
+    it was running."""
+    if self.launched_at is None:
+      return 0.0
+    elapsed = (self.exited_at or time.time()) - self.launched_at
+    if elapsed <= 0:
+      return 0.0
+    return (self.stdout_bytes + self.stderr_bytes) / elapsed
+
   def _handle_exitstatus(self, sts):
+    self.exited_at = time.time()
     if os.WIFSIGNALED(sts):
       self._rc = -os.WTERMSIG(sts)
     elif os.WIFEXITED(sts):
@@ -259,10 +413,21 @@ class Task(component('Operation')):
     method.
     """
 
-    self.stdout.read(bytes)
+    if self.stdout is not None:
+      self.stdout.read(bytes)
     self.stderr.read(bytes)
     
   def onRead(self, stream, data):
+    count = len(data)
+    self.reads += 1
+    if stream == self.stdout:
+      self.stdout_bytes += count
+      capture = self.stdout_capture
+    else:
+      self.stderr_bytes += count
+      capture = self.stderr_capture
+    if capture is not None:
+      capture.write(data)
 
     if self.delegate:
       if stream == self.stdout:
@@ -270,14 +435,50 @@ class Task(component('Operation')):
       elif stream == self.stderr:
         if hasattr(self.delegate, 'on_stderr'):
           self.delegate.on_stderr(self, data)
-    stream.read(self.byte_size)
+    stream.read(self.next_read_size(stream, count))
+
+  def _drain_output(self):
+    """Reads what the exited child left in it's pipes, so the delegate
+    and the captures see all of it before on_exit()."""
+    for stream in (self.stdout, self.stderr):
+      if stream is None:
+        continue
+      try:
+        while stream.readRequests:
+          reads = self.reads
+          stream.canRead(stream)
+          if self.reads == reads:
+            # nothing more to read, or the end of the pipe
+            break
+      except OSError:
+        # the stream's been closed
+        pass
+
+  def next_read_size(self, stream, count):
+    """Returns how much to ask for with the stream's next read, given
+    the last one returned count bytes."""
+    size = self.read_sizes.get(stream, self.byte_size)
+    if count >= size:
+      # a full read, there's likely more waiting
+      size = min(size * 2, self.max_byte_size)
+    elif count < size // 4:
+      size = max(size // 2, self.byte_size)
+    self.read_sizes[stream] = size
+    return size
       
   def onClose(self, stream):
     if self.delegate:
       self.delegate.on_close(self, stream)
+
+  def end_of_data_for(self, stream):
+    """The child closed stdout or stderr, delegates that want to know
+    implement on_eof(task, stream)."""
+    if self.delegate and hasattr(self.delegate, 'on_eof'):
+      self.delegate.on_eof(self, stream)
       
   def onWrite(self, stream, bytes):
     self.bytes_buffered -= bytes
+    self.stdin_bytes += bytes
     
     if self.should_close and self.bytes_buffered == 0:
       self.stdin.close()
@@ -290,8 +491,16 @@ class Task(component('Operation')):
 
      
   def write(self, data):
-    """Writes data to the Child's standard input."""
-    if self.should_close or self._rc is not None:
+    """Writes data to the Child's standard input. Raises RuntimeError
+    if the Task hasn't been launched or it's stdin was redirected with
+    standard_input, there's nothing for us to write to."""
+    if self.stdin is None:
+      if self.standard_input is not None:
+        raise RuntimeError("stdin of %s was redirected to descriptor %s "
+                           "with standard_input" %
+                           (self.launch_path, self.standard_input))
+      raise RuntimeError("%s hasn't been launched" % self.launch_path)
+    elif self.should_close or self._rc is not None:
       self.log.error('Write after close to script %s', self.launch_path)
     else:
       self.bytes_buffered += len(data)
@@ -300,7 +509,7 @@ class Task(component('Operation')):
   def close(self):
     """Flags stdin for closure when all outstanding bytes have been written"""
     self.should_close = True
-    if self.bytes_buffered == 0:
+    if self.bytes_buffered == 0 and self.stdin is not None:
        self.stdin.close()
 
   def add_fd(self, fd):
@@ -315,10 +524,13 @@ class Task(component('Operation')):
     process running. Not good.    
     """
     try:
-      os.chdir(self.current_directory)
+      if self._current_directory is not None:
+        os.chdir(self._current_directory)
       # Close handles not used by the child
-      self.stdin.close()
-      self.stdout.close()
+      if self.stdin is not None:
+        self.stdin.close()
+      if self.stdout is not None:
+        self.stdout.close()
     
       # Move the write end of the pipe to descriptor 0
       os.dup2(self.read_stdin, 0)
@@ -351,14 +563,35 @@ class Task(component('Operation')):
     os._exit(255)
     
   def _close_fds(self):
-    """Closes all but the first 3 file handles, in the future we may expand 
-    Task to allow you to specify keeping open certain handles. 
+    """Closes all but the first 3 file handles and those added with add_fd().
+
+    MAXFD can be over a million, so rather than trying to close every
+    one of them only the descriptors listed in FD_DIR are closed. Where
+    that isn't available the gaps between the kept descriptors are
+    closed with os.closerange(), which at least makes the calls from C.
     """
-    for fd in range(3, self.MAXFD):
-      if fd not in self.descriptors:
+    fds = self._open_fds()
+    if fds is None:
+      start = 3
+      for fd in sorted(self.descriptors) + [self.MAXFD]:
+        if fd >= start:
+          os.closerange(start, fd)
+          start = fd + 1
+      return
+
+    for fd in fds:
+      if fd > 2 and fd not in self.descriptors:
         try:
           os.close(fd)
         except OSError:
+          # the descriptor listdir() used to read FD_DIR
           pass
+
+  def _open_fds(self):
+    """Returns the descriptors this process has open, None if we can't tell."""
+    try:
+      return [int(name) for name in os.listdir(self.FD_DIR)]
+    except (OSError, ValueError):
+      return None
         
         
\ No newline at end of file
@@ -11,8 +11,24 @@ try:
     from  threadframe import dict as getframes
     
 except ImportError:
-    def getframes():
-        return {}
+    # python 2.5 and up can do it on their own
+    getframes = getattr(sys, '_current_frames', lambda: {})
+
+
+def formatStack(f):
+    """Returns the stack ending with frame f as a string, innermost
+    call last like a traceback."""
+    trace = []
+    while f != None:
+        filename = f.f_code.co_filename
+        lineno = f.f_lineno
+        name =  f.f_code.co_name
+        line = linecache.getline(filename, lineno)
+        trace.append('File "%s", line %s, in %s\n\t %s' %
+                     (filename, lineno, name, line.strip()))
+        f = f.f_back
+    trace.reverse()
+    return "\n".join(trace)
 
 
 class DebugService(object):
@@ -76,16 +92,5 @@ class DebugService(object):
         return "\n".join(states)
 
     def getThreadStackTrace(self, threadId):
-        f = getframes().get(threadId)
-        trace = []
-        while f != None:
-            filename = f.f_code.co_filename
-            lineno = f.f_lineno
-            name =  f.f_code.co_name
-            line = linecache.getline(filename, lineno)
-            trace.append('File "%s", line %s, in %s\n\t %s' %
-                         (filename, lineno, name, line.strip()))
-            f = f.f_back
-        trace.reverse()
-        return "\n".join(trace)
+        return formatStack(getframes().get(threadId))
 
@@ -0,0 +1,267 @@
+import errno
+import socket
+import time
+from collections import deque
+
+from Rambler import outlet, nil
+from Rambler.defer import Deferred
+from Rambler.controllers.Stat import Stat
+
+
+class PoolTimeout(Exception):
+  """Raised when a checkout waits longer than the pool's waitTimeout."""
+
+
+class Connecting(object):
+  """Delegate of a Port the pool is connecting, hands the port to the
+  checkout that asked for it."""
+
+  def __init__(self, pool, deferred):
+    self.pool = pool
+    self.deferred = deferred
+
+  def onConnect(self, port):
+    # the pool looks after the port until it's new owner sets their
+    # own delegate
+    port.delegate = self.pool
+    self.deferred.callback(port)
+
+  def onError(self, port, error):
+    self.pool.connectFailed(port, self.deferred, error)
+
+  def onClose(self, port):
+    self.pool.connectFailed(port, self.deferred,
+                            socket.error(errno.ECONNRESET, "Connection closed"))
+
+  def onWrite(self, port, bytes):
+    pass
+
+
+class PortPool(object):
+  """Keeps connected client Ports around for reuse, keyed by address.
+
+  checkout(address) returns a Deferred that fires with a connected
+  Port, an idle one if there is one that passes the health check,
+  otherwise a new connection. Once at maxPerAddress ports for an
+  address, checkouts wait in line until a port is checked in or
+  discarded, or fail with PoolTimeout after waitTimeout seconds.
+
+  Set the port's delegate to your own once you have it and when you're
+  done call checkin(port), or discard(port) if the connection is no
+  longer usable, so the pool can count it. Ports that sit idle for
+  idleTimeout seconds are closed.
+
+  The pool counts hits, misses (new connections), waits and how long
+  they took, see stats().
+  """
+  log = outlet('LogService', missing=nil)
+  RunLoop = outlet('RunLoop')
+  PortFactory = outlet('PortFactory')
+
+  maxPerAddress = 8
+  idleTimeout = 60
+  waitTimeout = 30
+  # how often idle ports and waiting checkouts are checked on
+  sweepInterval = 1.0
+
+  # optional callable(port) returning False if an idle port shouldn't
+  # be handed out, called after the pool's own checks pass
+  healthCheck = None
+
+  def __init__(self):
+    # address -> [(port, time checked in)], most recent last
+    self.idle = {}
+    # address -> ports checked out or connecting
+    self.busy = {}
+    # address -> deque of (Deferred, time queued)
+    self.waiters = {}
+    self.timer = None
+
+    self.hits = 0
+    self.misses = 0
+    self.waits = 0
+    self.timeouts = 0
+    self.evictions = 0
+    self.failures = 0
+    self.waitTime = Stat('port pool wait time')
+
+  def checkout(self, address):
+    """Returns a Deferred that fires with a connected Port."""
+    deferred = Deferred()
+    idle = self.idle.get(address)
+    while idle:
+      # the most recently used port is the least likely to have
+      # been dropped by the other end
+      port, since = idle.pop()
+      if self.isHealthy(port):
+        self.hits += 1
+        self.busy[address] = self.busy.get(address, 0) + 1
+        deferred.callback(port)
+        return deferred
+      self.evictions += 1
+      self.closePort(port)
+
+    if self.busy.get(address, 0) < self.maxPerAddress:
+      self.connect(address, deferred)
+    else:
+      self.waits += 1
+      self.waiters.setdefault(address, deque()).append((deferred, time.time()))
+      self.schedule()
+    return deferred
+
+  def checkin(self, port):
+    """Returns a port to the pool, handing it straight to the next
+    checkout waiting on it's address."""
+    address = port.address
+    self.release(address)
+    if not self.isHealthy(port):
+      self.evictions += 1
+      self.closePort(port)
+      self.replace(address)
+      return
+
+    port.delegate = self
+    waiters = self.waiters.get(address)
+    if waiters:
+      deferred, queued = waiters.popleft()
+      self.waitTime.tally(time.time() - queued)
+      self.busy[address] = self.busy.get(address, 0) + 1
+      deferred.callback(port)
+    else:
+      self.idle.setdefault(address, []).append((port, time.time()))
+      self.schedule()
+
+  def discard(self, port):
+    """Tells the pool a checked out port won't be coming back, it's
+    closed if it isn't already."""
+    self.release(port.address)
+    self.closePort(port)
+    self.replace(port.address)
+
+  def isHealthy(self, port):
+    """Returns True if the port is connected with nothing waiting to
+    be read or written."""
+    if port._socket is None or port.closing or not port.connected:
+      return False
+    if port.readrequests or port.bufferedBytes() or port.transfers:
+      return False
+    try:
+      # a closed connection reads as '', and an idle one shouldn't
+      # have anything to read at all
+      port._socket.recv(1, socket.MSG_PEEK)
+    except socket.error, e:
+      if e[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+        return False
+    else:
+      return False
+    return self.healthCheck is None or self.healthCheck(port)
+
+  def connect(self, address, deferred):
+    self.misses += 1
+    self.busy[address] = self.busy.get(address, 0) + 1
+    port = self.PortFactory(address, Connecting(self, deferred))
+    port.connect()
+
+  def connectFailed(self, port, deferred, error):
+    self.failures += 1
+    port.delegate = self
+    self.release(port.address)
+    deferred.errback(error)
+    self.replace(port.address)
+
+  def release(self, address):
+    count = self.busy.get(address, 0) - 1
+    if count > 0:
+      self.busy[address] = count
+    else:
+      self.busy.pop(address, None)
+
+  def replace(self, address):
+    # a port for address went away, make a new one for whoever's
+    # waiting
+    waiters = self.waiters.get(address)
+    if waiters and self.busy.get(address, 0) < self.maxPerAddress:
+      deferred, queued = waiters.popleft()
+      self.waitTime.tally(time.time() - queued)
+      self.connect(address, deferred)
+
+  def closePort(self, port):
+    port.delegate = self
+    if port._socket is not None and not port.closing:
+      port.close()
+
+  def schedule(self):
+    if self.timer is None:
+      runLoop = self.RunLoop.currentRunLoop()
+      self.timer = runLoop.waitBeforeCalling(self.sweepInterval, self.sweep)
+
+  def sweep(self):
+    """Closes ports that have been idle too long and fails checkouts
+    that have waited too long."""
+    self.timer = None
+    now = time.time()
+
+    for address, idle in self.idle.items():
+      expired = [port for port, since in idle
+                 if now - since >= self.idleTimeout]
+      idle[:] = [(port, since) for port, since in idle
+                 if now - since < self.idleTimeout]
+      if not idle:
+        del self.idle[address]
+      for port in expired:
+        self.evictions += 1
+        self.closePort(port)
+
+    for address, waiters in self.waiters.items():
+      while waiters and now - waiters[0][1] >= self.waitTimeout:
+        deferred, queued = waiters.popleft()
+        self.timeouts += 1
+        self.waitTime.tally(now - queued)
+        deferred.errback(PoolTimeout("Waited %.1fs for a connection to %s"
+                                     % (now - queued, address)))
+      if not waiters:
+        del self.waiters[address]
+
+    if self.idle or self.waiters:
+      self.schedule()
+
+  def stats(self):
+    """Returns the pool's counters and how many ports it has."""
+    return {
+      'hits': self.hits,
+      'misses': self.misses,
+      'waits': self.waits,
+      'timeouts': self.timeouts,
+      'evictions': self.evictions,
+      'failures': self.failures,
+      'waitTime': self.waitTime.mean,
+      'maxWaitTime': self.waitTime.max,
+      'idle': sum([len(idle) for idle in self.idle.values()]),
+      'busy': sum(self.busy.values()),
+      'waiting': sum([len(waiters) for waiters in self.waiters.values()]),
+    }
+
+  # Port delegate methods, the pool is the delegate of idle ports and
+  # ports it's closing
+
+  def onWrite(self, port, bytes):
+    pass
+
+  def onRead(self, port, data):
+    pass
+
+  def onClose(self, port):
+    self.forget(port)
+
+  def onError(self, port, error):
+    self.forget(port)
+
+  def onTimeOut(self, port):
+    pass
+
+  def forget(self, port):
+    idle = self.idle.get(port.address)
+    if idle:
+      idle[:] = [(p, since) for p, since in idle if p is not port]
+      if not idle:
+        del self.idle[port.address]
@@ -0,0 +1,318 @@
+"""Runs CPU bound work in long lived worker processes.
+
+Threads take turns holding the GIL, so pure python work handed to an
+OperationQueue's threads doesn't go any faster than running it on the
+RunLoop. A ProcessPool keeps worker processes, launched with Task,
+that each run one job at a time so the work can use every core.
+
+Jobs are picklable callables and their arguments. They're sent to the
+worker over it's stdin and the result comes back over it's stdout, each
+as a pickle with a 4 byte length in front of it.
+
+Run this module to be a worker, the pool does that for you.
+"""
+
+import cPickle as pickle
+import os
+import struct
+import sys
+import time
+import traceback
+from collections import deque
+
+from Rambler import outlet, nil
+from Rambler.defer import Deferred
+from Rambler.Framing import LengthPrefixFramer, FrameBuffer, FrameError
+
+
+HEADER = struct.Struct('!I')
+
+
+class WorkerDied(Exception):
+  """Raised for a job that was running when it's worker exited."""
+
+
+class Worker(object):
+  """Task delegate for one of the pool's worker processes."""
+
+  def __init__(self, pool, task):
+    self.pool = pool
+    self.task = task
+    # only used to split stdout into results
+    self.framer = LengthPrefixFramer(self)
+    self.framer.maxFrameSize = pool.maxResultSize
+    self.framer.buffers[task] = FrameBuffer()
+    # number of jobs finished
+    self.jobs = 0
+    # Deferred for the job that's running
+    self.deferred = None
+    self.dead = False
+
+  def send(self, payload, deferred):
+    self.deferred = deferred
+    self.task.write(HEADER.pack(len(payload)))
+    self.task.write(payload)
+
+  def retire(self):
+    # the worker exits once it reads the end of stdin
+    self.task.close()
+
+  def died(self):
+    if self.dead:
+      return
+    self.dead = True
+    self.framer.buffers.pop(self.task, None)
+    deferred, self.deferred = self.deferred, None
+    self.pool.workerDied(self)
+    if deferred is not None:
+      deferred.errback(WorkerDied("Worker %s exited while running a job"
+                                  % self.task.process_id))
+
+  # Framer delegate methods
+
+  def onFrame(self, task, frame):
+    deferred, self.deferred = self.deferred, None
+    self.jobs += 1
+    try:
+      succeeded, value, trace = pickle.loads(frame)
+    except Exception, e:
+      succeeded, value, trace = False, e, None
+
+    self.pool.jobFinished(self, succeeded)
+    if succeeded:
+      deferred.callback(value)
+    else:
+      # like subprocess, the child's traceback rides on the exception
+      value.child_traceback = trace
+      deferred.errback(value)
+
+  # Task delegate methods
+
+  def on_stdout(self, task, data):
+    buffer = self.framer.buffers.get(task)
+    if buffer is None:
+      return
+    buffer.data += data
+    try:
+      self.framer.parse(task, buffer)
+    except FrameError, e:
+      self.pool.log.error('Worker %s sent a bad result: %s',
+                          task.process_id, e)
+      task.terminate()
+      self.died()
+      return
+    buffer.compact()
+
+  def on_stderr(self, task, data):
+    self.pool.log.warn('Worker %s: %s', task.process_id, data.rstrip())
+
+  def on_stdin(self, task, bytes):
+    pass
+
+  def on_close(self, task, stream):
+    pass
+
+  def on_eof(self, task, stream):
+    if stream is task.stdout:
+      self.died()
+
+  def on_exit(self, task):
+    self.died()
+
+
+class ProcessPool(object):
+  """Runs picklable callables in a pool of worker processes.
+
+  submit(f, *args, **kw) returns a Deferred that fires with what f
+  returned in the worker, or errbacks with what it raised. The child's
+  formatted traceback is attached to exceptions as child_traceback.
+  Workers are started as they're needed, up to size.
+
+  Each worker is replaced after maxJobsPerWorker jobs, so leaks in the
+  code it runs don't build up. A worker that exits while running a job
+  fails it with WorkerDied and is replaced when there's more work.
+  The pool reaps the workers it lets go of, call close() then join()
+  to shut it down.
+
+  See ProcessOperation for running jobs from an OperationQueue.
+  """
+  log = outlet('LogService', missing=nil)
+  Task = outlet('Task')
+
+  # number of worker processes, None for one per cpu
+  size = None
+  # jobs a worker runs before it's replaced, 0 for no limit
+  maxJobsPerWorker = 1000
+  # largest pickled result a worker can send back
+  maxResultSize = 64 << 20
+  # interpreter used to run the workers
+  python = sys.executable
+
+  def __init__(self):
+    self.workers = set()
+    self.idle = []
+    # (pickled job, Deferred) waiting for a worker
+    self.queue = deque()
+    # workers that have left the pool but haven't been reaped
+    self.retired = []
+
+    self.submitted = 0
+    self.completed = 0
+    self.failed = 0
+    self.crashes = 0
+    self.recycled = 0
+
+  def workerCount(self):
+    if self.size is not None:
+      return self.size
+    try:
+      return max(os.sysconf('SC_NPROCESSORS_ONLN'), 1)
+    except (ValueError, OSError):
+      return 1
+
+  def submit(self, f, *args, **kw):
+    """Returns a Deferred that fires with the result of f(*args, **kw)
+    run in a worker."""
+    deferred = Deferred()
+    try:
+      payload = pickle.dumps((f, args, kw), pickle.HIGHEST_PROTOCOL)
+    except Exception, e:
+      deferred.errback(e)
+      return deferred
+
+    self.submitted += 1
+    self.queue.append((payload, deferred))
+    self.dispatch()
+    return deferred
+
+  def dispatch(self):
+    while self.queue:
+      if not self.idle:
+        if len(self.workers) >= self.workerCount():
+          break
+        self.idle.append(self.startWorker())
+      worker = self.idle.pop()
+      payload, deferred = self.queue.popleft()
+      worker.send(payload, deferred)
+
+  def startWorker(self):
+    task = self.Task()
+    worker = Worker(self, task)
+    task.delegate = worker
+    task.launch_path = self.python
+    task.args = ['-m', __name__]
+    # so the worker can import whatever the jobs need
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join([path or os.getcwd()
+                                                 for path in sys.path])
+    task.environment = environment
+    task.launch()
+    self.workers.add(worker)
+    return worker
+
+  def jobFinished(self, worker, succeeded):
+    if succeeded:
+      self.completed += 1
+    else:
+      self.failed += 1
+
+    if self.maxJobsPerWorker and worker.jobs >= self.maxJobsPerWorker:
+      self.recycled += 1
+      self.workers.discard(worker)
+      self.retired.append(worker)
+      worker.retire()
+    else:
+      self.idle.append(worker)
+    self.dispatch()
+
+  def workerDied(self, worker):
+    # retired workers have already been forgotten
+    if worker in self.workers:
+      self.crashes += 1
+      self.workers.discard(worker)
+      self.retired.append(worker)
+      if worker in self.idle:
+        self.idle.remove(worker)
+    self.reap()
+    self.dispatch()
+
+  def reap(self):
+    """Reaps the workers that have left the pool and exited, without
+    waiting for the rest."""
+    for worker in list(self.retired):
+      # reaping tells the worker it's exited, which can land back here
+      if worker.task.wait(0) is not None and worker in self.retired:
+        self.retired.remove(worker)
+
+  def close(self):
+    """Lets every worker exit once it's finished it's job, jobs that
+    haven't started yet are still run by new workers. See join()."""
+    for worker in self.workers:
+      worker.retire()
+    self.retired.extend(self.workers)
+    self.workers.clear()
+    del self.idle[:]
+
+  def join(self, timeout=5):
+    """Waits for the workers that have left the pool, those close() let
+    go of included, to exit and reaps them. Those still running after
+    timeout seconds are killed, their results can't be read while we're
+    blocked here."""
+    expires = time.time() + timeout
+    for worker in list(self.retired):
+      task = worker.task
+      if task.wait(max(expires - time.time(), 0)) is None:
+        try:
+          task.terminate()
+        except OSError:
+          pass
+        task.wait()
+    del self.retired[:]
+
+  def stats(self):
+    """Returns the pool's counters and how many workers it has."""
+    return {
+      'submitted': self.submitted,
+      'completed': self.completed,
+      'failed': self.failed,
+      'crashes': self.crashes,
+      'recycled': self.recycled,
+      'workers': len(self.workers),
+      'idle': len(self.idle),
+      'queued': len(self.queue),
+    }
+
+
+def serve():
+  """Runs jobs read from stdin until it's closed, writing each result
+  to stdout. This is the worker's side of the pool."""
+  jobs = os.fdopen(os.dup(0), 'rb')
+  results = os.fdopen(os.dup(1), 'wb')
+  # anything the jobs print goes to stderr, stdout is for results
+  os.dup2(2, 1)
+
+  while True:
+    header = jobs.read(HEADER.size)
+    if len(header) < HEADER.size:
+      break
+    size, = HEADER.unpack(header)
+    payload = jobs.read(size)
+
+    try:
+      f, args, kw = pickle.loads(payload)
+      reply = (True, f(*args, **kw), None)
+    except Exception, e:
+      reply = (False, e, traceback.format_exc())
+
+    try:
+      data = pickle.dumps(reply, pickle.HIGHEST_PROTOCOL)
+    except Exception, e:
+      data = pickle.dumps((False, pickle.PicklingError(str(e)),
+                           traceback.format_exc()), pickle.HIGHEST_PROTOCOL)
+    results.write(HEADER.pack(len(data)))
+    results.write(data)
+    results.flush()
+
+
+if __name__ == '__main__':
+  serve()
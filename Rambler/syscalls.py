@@ -0,0 +1,129 @@
+"""Wrappers for the Linux system calls that python's os module doesn't
+expose. Each wrapper is None when the call isn't available on this
+platform, callers are expected to check and fall back to the portable
+way of doing things.
+
+  >>> from Rambler import syscalls
+  >>> if syscalls.eventfd:
+  ...   fd = syscalls.eventfd(0)
+"""
+
+import ctypes
+import ctypes.util
+import os
+
+try:
+  _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+except OSError:
+  _libc = None
+
+
+def _function(name, restype, *argtypes):
+  # Returns the libc function or None if libc doesn't have it
+  func = getattr(_libc, name, None)
+  if func is not None:
+    func.restype = restype
+    func.argtypes = argtypes
+  return func
+
+def _check(result):
+  if result < 0:
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err))
+  return result
+
+
+EFD_CLOEXEC  = 02000000
+EFD_NONBLOCK = 04000
+
+_eventfd = _function('eventfd', ctypes.c_int, ctypes.c_uint, ctypes.c_int)
+
+if _eventfd is not None:
+  def eventfd(initval=0, flags=EFD_NONBLOCK | EFD_CLOEXEC):
+    """Returns a new eventfd descriptor, a counter that can be written
+    and read from to signal another thread."""
+    return _check(_eventfd(initval, flags))
+else:
+  eventfd = None
+
+
+class iovec(ctypes.Structure):
+  _fields_ = [('iov_base', ctypes.c_void_p),
+              ('iov_len', ctypes.c_size_t)]
+
+# most buffers writev() accepts in one call on Linux
+IOV_MAX = 1024
+
+_writev = _function('writev', ctypes.c_ssize_t,
+                    ctypes.c_int, ctypes.POINTER(iovec), ctypes.c_int)
+
+if _writev is not None:
+  def writev(fd, chunks, offset=0):
+    """Writes a sequence of strings to fd in a single call, skipping
+    the first offset bytes of the first one. Returns the number of
+    bytes written, only the first IOV_MAX strings are considered.
+
+    Strings and bytearrays are handed to the kernel in place, anything
+    else, a memoryview or buffer say, is copied into a string first.
+    """
+    # keeps whatever the addresses point into alive until writev returns
+    strings = []
+    for chunk in chunks:
+      if type(chunk) is bytearray:
+        chunk = (ctypes.c_char * len(chunk)).from_buffer(chunk)
+      elif type(chunk) is memoryview:
+        chunk = chunk.tobytes()
+      elif type(chunk) is not str:
+        chunk = str(chunk)
+      strings.append(chunk)
+      if len(strings) == IOV_MAX:
+        break
+
+    vector = (iovec * len(strings))()
+    for i, chunk in enumerate(strings):
+      if type(chunk) is str:
+        address = ctypes.cast(ctypes.c_char_p(chunk), ctypes.c_void_p).value
+      else:
+        address = ctypes.addressof(chunk)
+      vector[i].iov_base = address
+      vector[i].iov_len = len(chunk)
+    if strings and offset:
+      vector[0].iov_base += offset
+      vector[0].iov_len -= offset
+    return _check(_writev(fd, vector, len(strings)))
+else:
+  writev = None
+
+
+_sendfile = _function('sendfile64', ctypes.c_ssize_t, ctypes.c_int,
+                      ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                      ctypes.c_size_t)
+
+if _sendfile is not None:
+  def sendfile(out_fd, in_fd, offset, count):
+    """Copies up to count bytes of in_fd starting at offset to out_fd
+    within the kernel. in_fd must be a regular file. Returns the number
+    of bytes copied, 0 at the end of the file."""
+    return _check(_sendfile(out_fd, in_fd,
+                            ctypes.byref(ctypes.c_int64(offset)), count))
+else:
+  sendfile = None
+
+
+SPLICE_F_MOVE     = 1
+SPLICE_F_NONBLOCK = 2
+SPLICE_F_MORE     = 4
+
+_splice = _function('splice', ctypes.c_ssize_t,
+                    ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                    ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                    ctypes.c_size_t, ctypes.c_uint)
+
+if _splice is not None:
+  def splice(fd_in, fd_out, count, flags=SPLICE_F_MOVE | SPLICE_F_NONBLOCK):
+    """Moves up to count bytes from fd_in to fd_out within the kernel,
+    one of them must be a pipe. Returns the number of bytes moved, 0
+    once the writing end of the pipe has been closed."""
+    return _check(_splice(fd_in, None, fd_out, None, count, flags))
+else:
+  splice = None
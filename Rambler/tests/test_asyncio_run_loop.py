@@ -0,0 +1,317 @@
+import heapq
+import os
+import select
+import socket
+import threading
+import time
+import unittest
+from collections import deque
+
+from Rambler.RunLoop import RunLoop, Port
+from Rambler.ThreadStorageService import ThreadStorageService
+from Rambler import AsyncioRunLoop as backend
+
+
+class Handle(object):
+  def __init__(self, f, args):
+    self.f = f
+    self.args = args
+    self.cancelled = False
+
+  def cancel(self):
+    self.cancelled = True
+
+  def run(self):
+    if not self.cancelled:
+      self.f(*self.args)
+
+
+class FakeLoop(object):
+  """Just enough of an asyncio event loop, polling with select(), for
+  the tests to run where neither asyncio nor trollius is installed."""
+
+  def __init__(self):
+    self.readers = {}
+    self.writers = {}
+    # (when, sequence, handle)
+    self.timers = []
+    self.sequence = 0
+    self.ready = deque()
+    self.lock = threading.Lock()
+    self.wakeReader, self.wakeWriter = os.pipe()
+    self.stopping = False
+
+  def time(self):
+    return time.time()
+
+  def call_at(self, when, f, *args):
+    handle = Handle(f, args)
+    self.sequence += 1
+    heapq.heappush(self.timers, (when, self.sequence, handle))
+    return handle
+
+  def call_soon_threadsafe(self, f, *args):
+    handle = Handle(f, args)
+    with self.lock:
+      self.ready.append(handle)
+    os.write(self.wakeWriter, 'x')
+    return handle
+
+  def add_reader(self, fd, f, *args):
+    self.readers[fd] = Handle(f, args)
+
+  def remove_reader(self, fd):
+    return self.readers.pop(fd, None) is not None
+
+  def add_writer(self, fd, f, *args):
+    self.writers[fd] = Handle(f, args)
+
+  def remove_writer(self, fd):
+    return self.writers.pop(fd, None) is not None
+
+  def stop(self):
+    self.stopping = True
+
+  def run_forever(self):
+    self.stopping = False
+    while not self.stopping:
+      self.runOnce()
+
+  def runOnce(self):
+    if self.ready:
+      timeout = 0
+    elif self.timers:
+      timeout = max(self.timers[0][0] - self.time(), 0)
+    else:
+      timeout = None
+    readable, writable, _ = select.select(
+      [self.wakeReader] + self.readers.keys(), self.writers.keys(), [],
+      timeout)
+
+    handles = []
+    for fd in readable:
+      if fd == self.wakeReader:
+        os.read(fd, 4096)
+      elif fd in self.readers:
+        handles.append(self.readers[fd])
+    handles.extend([self.writers[fd] for fd in writable
+                    if fd in self.writers])
+    now = self.time()
+    while self.timers and self.timers[0][0] <= now:
+      handles.append(heapq.heappop(self.timers)[2])
+    with self.lock:
+      handles.extend(self.ready)
+      self.ready.clear()
+    for handle in handles:
+      handle.run()
+
+  def close(self):
+    os.close(self.wakeReader)
+    os.close(self.wakeWriter)
+
+
+class Reader(object):
+  def __init__(self, sock):
+    self.sock = sock
+    self.data = []
+
+  def fileno(self):
+    return self.sock.fileno()
+
+  def canRead(self, source):
+    self.data.append(self.sock.recv(100))
+
+
+class Delegate(object):
+  def onAccept(self, port):
+    pass
+
+  def onWrite(self, port, bytes):
+    pass
+
+  def onClose(self, port):
+    pass
+
+
+class AsyncioTestCase(unittest.TestCase):
+
+  def setUp(self):
+    try:
+      self.saved = ThreadStorageService.getFromCurrent('RunLoop')
+    except KeyError:
+      self.saved = None
+    self.loop = self.newLoop()
+    self.run_loop = backend.AsyncioRunLoop(self.loop)
+    ThreadStorageService.addToCurrent('RunLoop', self.run_loop)
+
+  def newLoop(self):
+    return FakeLoop()
+
+  def tearDown(self):
+    self.run_loop.reset()
+    self.loop.close()
+    if self.saved is None:
+      ThreadStorageService.delFromCurrent('RunLoop')
+    else:
+      ThreadStorageService.addToCurrent('RunLoop', self.saved)
+
+
+class TestAsyncioRunLoop(AsyncioTestCase):
+
+  def test_reader(self):
+    ours, theirs = socket.socketpair()
+    reader = Reader(ours)
+    self.run_loop.addReader(reader)
+    theirs.send('hello')
+    self.run_loop.runOnce()
+    self.assertEqual(['hello'], reader.data)
+    # not persistent, it's up to the reader to add itself back
+    self.failIf(ours.fileno() in self.run_loop.readers)
+
+  def test_persistent_reader(self):
+    ours, theirs = socket.socketpair()
+    reader = Reader(ours)
+    self.run_loop.addReader(reader, True)
+    for data in ('one', 'two'):
+      theirs.send(data)
+      self.run_loop.runOnce()
+    self.assertEqual(['one', 'two'], reader.data)
+    self.run_loop.removeReader(reader)
+    self.assertRaises(KeyError, self.run_loop.removeReader, reader)
+
+  def test_timers(self):
+    fired = []
+    self.run_loop.waitBeforeCalling(0.02, fired.append, 'later')
+    self.run_loop.waitBeforeCalling(0, fired.append, 'now')
+    cancelled = self.run_loop.waitBeforeCalling(0.01, fired.append, 'never')
+    cancelled.cancel()
+    # run() returns once there's nothing left to wait on
+    self.run_loop.run()
+    self.assertEqual(['now', 'later'], fired)
+    self.assertEqual(2, self.run_loop.timers.firedCount)
+
+  def test_call_from_thread(self):
+    called = []
+    def call():
+      called.append(threading.currentThread())
+      self.run_loop.stop()
+    self.run_loop.waitBeforeCalling(10, lambda: None)
+    threading.Thread(target=self.run_loop.callFromThread,
+                     args=(call,)).start()
+    self.run_loop.run()
+    self.assertEqual([threading.currentThread()], called)
+
+  def test_call_from_thread_once(self):
+    called = []
+    for x in range(3):
+      self.run_loop.callFromThreadOnce('key', called.append, x)
+    self.run_loop.waitBeforeCalling(0.01, lambda: None)
+    self.run_loop.run()
+    self.assertEqual([0], called)
+    self.assertEqual(0, len(self.run_loop.threadCallQueue))
+    self.failIf(self.run_loop.threadCallQueue.keys)
+
+  def test_calls_are_queued(self):
+    called = []
+    def put():
+      for x in range(3):
+        self.run_loop.callFromThread(called.append, x)
+    thread = threading.Thread(target=put)
+    thread.start()
+    thread.join()
+    # on the RunLoop's queue, drained by a single callback
+    self.assertEqual(3, len(self.run_loop.threadCallQueue))
+    self.assertEqual(1, self.run_loop.waker.sent)
+    self.run_loop.runOnce()
+    self.assertEqual([0, 1, 2], called)
+    self.assertEqual(3, self.run_loop.threadCallQueue.latency.count)
+
+  def test_call_batch_size(self):
+    called = []
+    self.run_loop.callBatchSize = 2
+    for x in range(3):
+      self.run_loop.callFromThread(called.append, x)
+    self.run_loop.runOnce()
+    self.assertEqual([0, 1], called)
+    self.run_loop.runOnce()
+    self.assertEqual([0, 1, 2], called)
+
+  def test_timers_from_thread(self):
+    fired = []
+    before = len(self.run_loop.timers)
+    thread = threading.Thread(target=self.run_loop.waitBeforeCalling,
+                              args=(0, fired.append, 'thread'))
+    thread.start()
+    thread.join()
+    # handed to the loop's thread rather than added from this one
+    self.assertEqual(before, len(self.run_loop.timers))
+    self.run_loop.waitBeforeCalling(0.01, lambda: None)
+    self.run_loop.run()
+    self.assertEqual(['thread'], fired)
+
+  def test_ports(self):
+    # Ports only talk to the RunLoop interface
+    ours, theirs = socket.socketpair()
+    port = Port(None, Delegate())
+    port.connectionAccepted(ours)
+    port.write('hello')
+    self.run_loop.runOnce()
+    self.assertEqual('hello', theirs.recv(100))
+    port.close()
+
+  def test_callback_errors(self):
+    def fail():
+      raise ValueError()
+    self.run_loop.waitBeforeCalling(0, fail)
+    self.assertRaises(ValueError, self.run_loop.runOnce)
+
+  def test_waker_isnt_monitored(self):
+    # call_soon_threadsafe() wakes the loop, there's no descriptor
+    self.assertEqual({}, self.run_loop.readers)
+    self.run_loop.wakeup()
+    self.run_loop.wakeup()
+    self.assertEqual(2, self.run_loop.waker.requested)
+    self.assertEqual(1, self.run_loop.waker.sent)
+
+  def test_reset_replaces_sweeper(self):
+    ours, theirs = socket.socketpair()
+    port = Port(None, Delegate())
+    port.connectionAccepted(ours)
+    port.setTimeouts(idle=30)
+    self.assert_(self.run_loop.sweeper.timer)
+    self.run_loop.reset()
+    self.failIf(self.run_loop.sweeper.ports)
+    self.assertEqual(0, len(self.run_loop.timers))
+    # a port added after the reset gets swept again
+    ours, theirs = socket.socketpair()
+    port = Port(None, Delegate())
+    port.connectionAccepted(ours)
+    port.setTimeouts(idle=30)
+    self.assertEqual(1, len(self.run_loop.timers))
+
+
+class TestRealLoop(TestAsyncioRunLoop):
+  """The same tests against asyncio or trollius, where installed."""
+
+  def newLoop(self):
+    if backend.asyncio is None:
+      raise unittest.SkipTest("neither asyncio nor trollius is installed")
+    return backend.asyncio.new_event_loop()
+
+
+class TestImplementation(unittest.TestCase):
+
+  def test_current_run_loop(self):
+    class Other(RunLoop):
+      pass
+    RunLoop.implementation = Other
+    try:
+      def current():
+        result.append(RunLoop.currentRunLoop())
+      result = []
+      thread = threading.Thread(target=current)
+      thread.start()
+      thread.join()
+      self.assert_(isinstance(result[0], Other))
+    finally:
+      RunLoop.implementation = None
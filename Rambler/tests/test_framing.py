@@ -0,0 +1,153 @@
+import socket
+import struct
+import unittest
+
+from Rambler.RunLoop import RunLoop, Port
+from Rambler.Framing import LengthPrefixFramer, DelimiterFramer, ChunkedFramer
+from Rambler.ThreadStorageService import ThreadStorageService
+
+
+class Frames(object):
+  def __init__(self):
+    self.frames = []
+    self.errors = []
+    self.closed = False
+
+  def onFrame(self, port, frame):
+    self.frames.append(frame)
+
+  def onWrite(self, port, bytes):
+    pass
+
+  def onClose(self, port):
+    self.closed = True
+
+  def onError(self, port, error):
+    self.errors.append(error)
+
+
+class FramingTestCase(unittest.TestCase):
+
+  def setUp(self):
+    try:
+      self.saved = ThreadStorageService.getFromCurrent('RunLoop')
+    except KeyError:
+      self.saved = None
+    self.run_loop = RunLoop()
+    ThreadStorageService.addToCurrent('RunLoop', self.run_loop)
+
+  def tearDown(self):
+    if self.saved is None:
+      ThreadStorageService.delFromCurrent('RunLoop')
+    else:
+      ThreadStorageService.addToCurrent('RunLoop', self.saved)
+
+  def connect(self, framerClass, *args):
+    ours, self.theirs = socket.socketpair()
+    self.frames = Frames()
+    self.framer = framerClass(self.frames, *args)
+    self.port = Port(None, self.framer)
+    self.port.connectionAccepted(ours)
+
+  def send(self, *pieces):
+    # sends each piece in it's own pass so frames get split across reads
+    for piece in pieces:
+      self.theirs.send(piece)
+      self.run_loop.runOnce()
+
+  def disconnect(self):
+    self.theirs.close()
+
+
+class TestLengthPrefixFramer(FramingTestCase):
+
+  def test_frames(self):
+    self.connect(LengthPrefixFramer)
+    message = struct.pack('!I', 5) + 'hello' + struct.pack('!I', 0)
+    message += struct.pack('!I', 3) + 'bye'
+    self.send(message[:2], message[2:7], message[7:])
+    self.assertEqual(['hello', '', 'bye'], self.frames.frames)
+    self.assertEqual(0, len(self.framer.buffers[self.port]))
+    self.disconnect()
+
+  def test_close_without_on_close(self):
+    # delegates that only want frames don't need onClose()
+    class Delegate(object):
+      def onFrame(self, port, frame):
+        pass
+    ours, theirs = socket.socketpair()
+    framer = LengthPrefixFramer(Delegate())
+    port = Port(None, framer)
+    port.connectionAccepted(ours)
+    theirs.close()
+    self.run_loop.runOnce()
+    self.failIf(port in framer.buffers)
+
+  def test_too_large(self):
+    self.connect(LengthPrefixFramer)
+    self.framer.maxFrameSize = 10
+    self.send(struct.pack('!I', 11))
+    self.assertEqual([], self.frames.frames)
+    self.assertEqual(1, len(self.frames.errors))
+    self.failIf(self.port in self.framer.buffers)
+    self.disconnect()
+
+  def test_write_frame(self):
+    self.connect(LengthPrefixFramer, '!H')
+    self.framer.writeFrame(self.port, 'hello')
+    self.run_loop.runOnce()
+    self.assertEqual('\x00\x05hello', self.theirs.recv(100))
+    self.disconnect()
+
+  def test_delegate_passthrough(self):
+    self.connect(LengthPrefixFramer)
+    self.assertEqual(self.frames.onWrite, self.framer.onWrite)
+    self.failIf(hasattr(self.framer, 'pauseProducing'))
+    self.disconnect()
+
+
+class TestDelimiterFramer(FramingTestCase):
+
+  def test_lines(self):
+    self.connect(DelimiterFramer)
+    self.send('one\r', '\ntwo\r\nthr', 'ee\r\n\r\n')
+    self.assertEqual(['one', 'two', 'three', ''], self.frames.frames)
+    self.disconnect()
+
+  def test_long_delimiter(self):
+    self.connect(DelimiterFramer, '--')
+    self.send('a-b-', '-c--')
+    self.assertEqual(['a-b', 'c'], self.frames.frames)
+    self.disconnect()
+
+  def test_too_large(self):
+    self.connect(DelimiterFramer)
+    self.framer.maxFrameSize = 4
+    self.send('hello')
+    self.assertEqual(1, len(self.frames.errors))
+    self.disconnect()
+
+
+class TestChunkedFramer(FramingTestCase):
+
+  def test_chunks(self):
+    self.connect(ChunkedFramer)
+    self.send('5;ext=1\r\nhel', 'lo\r\na\r\n0123456789\r\n',
+              '0\r\nTrailer: x\r\n\r\n', '2\r\nhi\r\n0\r\n\r\n')
+    self.assertEqual(['hello', '0123456789', '', 'hi', ''],
+                     self.frames.frames)
+    self.disconnect()
+
+  def test_bad_size(self):
+    self.connect(ChunkedFramer)
+    self.send('zz\r\n')
+    self.assertEqual(1, len(self.frames.errors))
+    self.disconnect()
+
+  def test_write_frame(self):
+    self.connect(ChunkedFramer)
+    self.framer.writeFrame(self.port, 'hello')
+    self.framer.writeFrame(self.port, '')
+    self.run_loop.runOnce()
+    self.assertEqual('5\r\nhello\r\n0\r\n\r\n', self.theirs.recv(100))
+    self.disconnect()
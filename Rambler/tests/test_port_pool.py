@@ -0,0 +1,125 @@
+import socket
+import time
+import unittest
+
+from Rambler.RunLoop import RunLoop, Port
+from Rambler.ThreadStorageService import ThreadStorageService
+from Rambler.services.PortPool import PortPool, PoolTimeout
+
+
+class Server(object):
+  def __init__(self):
+    self.accepted = []
+
+  def onAccept(self, port):
+    self.accepted.append(port)
+
+  def onClose(self, port):
+    pass
+
+
+class TestPortPool(unittest.TestCase):
+
+  def setUp(self):
+    try:
+      self.saved = ThreadStorageService.getFromCurrent('RunLoop')
+    except KeyError:
+      self.saved = None
+    self.run_loop = RunLoop()
+    ThreadStorageService.addToCurrent('RunLoop', self.run_loop)
+
+    self.server = Server()
+    self.listener = Port(('127.0.0.1', 0), self.server)
+    self.listener.listen(5)
+    self.address = self.listener._socket.getsockname()
+
+    # binding replaces the outlets, put them back when we're done
+    self.outlets = dict([(name, PortPool.__dict__[name])
+                         for name in ('RunLoop', 'PortFactory')])
+    PortPool.RunLoop = RunLoop
+    PortPool.PortFactory = Port
+    self.pool = PortPool()
+
+  def tearDown(self):
+    for name, outlet in self.outlets.items():
+      setattr(PortPool, name, outlet)
+    self.listener.close()
+    if self.saved is None:
+      ThreadStorageService.delFromCurrent('RunLoop')
+    else:
+      ThreadStorageService.addToCurrent('RunLoop', self.saved)
+
+  def wait(self, deferred, limit=2):
+    # runs the RunLoop until the deferred fires, returns it's result
+    results = []
+    deferred.addBoth(results.append)
+    expires = time.time() + limit
+    while not results and time.time() < expires:
+      self.run_loop.runOnce()
+    self.assert_(results, "Deferred never fired")
+    return results[0]
+
+  def test_reuse(self):
+    port = self.wait(self.pool.checkout(self.address))
+    self.assert_(port.connected)
+    self.pool.checkin(port)
+    self.assertEqual(port, self.wait(self.pool.checkout(self.address)))
+    stats = self.pool.stats()
+    self.assertEqual((1, 1, 1, 0), (stats['hits'], stats['misses'],
+                                    stats['busy'], stats['idle']))
+
+  def test_waiters(self):
+    self.pool.maxPerAddress = 1
+    port = self.wait(self.pool.checkout(self.address))
+    waiting = self.pool.checkout(self.address)
+    self.assertEqual(1, self.pool.stats()['waiting'])
+
+    self.pool.checkin(port)
+    self.assertEqual(port, self.wait(waiting))
+    self.assertEqual(1, self.pool.waits)
+    self.assertEqual(1, self.pool.waitTime.count)
+
+  def test_wait_timeout(self):
+    self.pool.maxPerAddress = 1
+    self.pool.waitTimeout = 0
+    self.wait(self.pool.checkout(self.address))
+    waiting = self.pool.checkout(self.address)
+    self.pool.sweep()
+    self.assert_(self.wait(waiting).check(PoolTimeout))
+    self.assertEqual(1, self.pool.timeouts)
+
+  def test_discard_makes_room(self):
+    self.pool.maxPerAddress = 1
+    port = self.wait(self.pool.checkout(self.address))
+    waiting = self.pool.checkout(self.address)
+    self.pool.discard(port)
+    replacement = self.wait(waiting)
+    self.failIf(replacement is port)
+    self.assertEqual(2, self.pool.misses)
+
+  def test_health_check(self):
+    port = self.wait(self.pool.checkout(self.address))
+    self.pool.checkin(port)
+    # the server hangs up on the idle connection
+    self.server.accepted[0]._reset()
+    replacement = self.wait(self.pool.checkout(self.address))
+    self.failIf(replacement is port)
+    self.assertEqual(1, self.pool.evictions)
+
+  def test_idle_timeout(self):
+    self.pool.idleTimeout = 0
+    self.pool.checkin(self.wait(self.pool.checkout(self.address)))
+    self.assertEqual(1, self.pool.stats()['idle'])
+    self.pool.sweep()
+    self.assertEqual(0, self.pool.stats()['idle'])
+    self.assertEqual(1, self.pool.evictions)
+
+  def test_connect_failure(self):
+    # nobody listening
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    address = s.getsockname()
+    s.close()
+    self.assert_(self.wait(self.pool.checkout(address)).check(socket.error))
+    self.assertEqual(1, self.pool.failures)
+    self.assertEqual(0, self.pool.stats()['busy'])
@@ -0,0 +1,97 @@
+import os
+import shutil
+import signal
+import tempfile
+import time
+import unittest
+
+from Rambler import Bundle
+from Rambler.Application import Application, Config
+from Rambler.ciConfigService import DictConfigSource
+from Rambler.RunLoop import RunLoop
+
+
+class TestSupervisor(unittest.TestCase):
+
+  def setUp(self):
+    # loading a real app needs it's bundle installed as a package, the
+    # supervisor only needs the pre-fork state
+    self.app = Application.__new__(Application)
+    self.app.mainRunLoop = RunLoop()
+    self.app.workers = {}
+    self.app.draining = False
+    self.app.previousSigChild = None
+    # keep handlers other tests installed from reaping our children
+    self.previous = signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    self.pids = []
+
+  def tearDown(self):
+    for pid in self.pids:
+      try:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+      except OSError:
+        pass
+    signal.signal(signal.SIGCHLD, self.previous)
+
+  def fork(self, status=None):
+    pid = os.fork()
+    if not pid:
+      if status is None:
+        time.sleep(10)
+      os._exit(status or 0)
+    self.pids.append(pid)
+    return pid
+
+  def wait_for_zombie(self, pid):
+    expires = time.time() + 5
+    while time.time() < expires:
+      if open('/proc/%s/stat' % pid).read().split()[2] == 'Z':
+        break
+      time.sleep(0.01)
+
+  def test_reaps_only_workers(self):
+    live = self.fork()
+    worker = self.fork(0)
+    other = self.fork(3)
+    self.wait_for_zombie(worker)
+    self.wait_for_zombie(other)
+
+    self.app.draining = True
+    self.app.workers = {live: time.time(), worker: time.time()}
+    self.app.reapChildren()
+    self.assertEqual([live], self.app.workers.keys())
+    # the child that isn't a worker is left for it's owner
+    self.assertEqual((other, 3 << 8), os.waitpid(other, 0))
+
+  def test_chains_sig_child(self):
+    called = []
+    self.app.previousSigChild = lambda signum, frame: called.append(signum)
+    self.app.onSigChild(signal.SIGCHLD, None)
+    self.assertEqual([signal.SIGCHLD], called)
+
+  def test_hup_is_passed_to_workers(self):
+    worker = self.fork()
+    self.app.workers = {worker: time.time()}
+    self.app.onSigHUP(signal.SIGHUP, None)
+    self.app.mainRunLoop.runOnce()
+    self.assertEqual(signal.SIGHUP, os.waitpid(worker, 0)[1])
+
+  def test_reload(self):
+    # a worker, or an app that isn't pre-forked, applies the new config
+    bundle = tempfile.mkdtemp('.app')
+    try:
+      open(os.path.join(bundle, 'app.conf'), 'w').write('<app></app>')
+      os.makedirs(os.path.join(bundle, 'extensions', 'extra'))
+      self.app.appBundle = Bundle(bundle)
+      self.app.configFile = os.path.join(bundle, 'app.conf')
+      self.app.digest = ''
+      self.app.configError = ''
+      self.app.config = Config(['extra'])
+      self.app.configSource = DictConfigSource({})
+
+      self.app.reload()
+      self.assertEqual(['Rambler', 'extra'],
+                       sorted(self.app.configSource.data.keys()))
+    finally:
+      shutil.rmtree(bundle)
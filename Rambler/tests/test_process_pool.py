@@ -0,0 +1,136 @@
+import cPickle as pickle
+import logging
+import os
+import time
+import unittest
+
+from Rambler.RunLoop import RunLoop
+from Rambler.ThreadStorageService import ThreadStorageService
+from Rambler.controllers.Operation import Operation
+from Rambler.controllers.ProcessOperation import ProcessOperation
+from Rambler.controllers.Task import Task
+from Rambler.services.ProcessPool import ProcessPool, WorkerDied
+
+
+# jobs have to be importable by the workers
+
+def square(x):
+  return x * x
+
+def pid():
+  return os.getpid()
+
+def fail():
+  raise ValueError('failed')
+
+def crash():
+  os._exit(3)
+
+
+class OperationTask(Task, Operation):
+  # Task's Operation base is only filled in once it's assembled
+  pass
+
+
+class PooledOperation(ProcessOperation, Operation):
+  pass
+
+
+class TestProcessPool(unittest.TestCase):
+
+  def setUp(self):
+    try:
+      self.saved = ThreadStorageService.getFromCurrent('RunLoop')
+    except KeyError:
+      self.saved = None
+    self.run_loop = RunLoop()
+    ThreadStorageService.addToCurrent('RunLoop', self.run_loop)
+
+    self.log = Task.__dict__['log']
+    Task.log = logging.getLogger('Task')
+    self.task = ProcessPool.__dict__['Task']
+    ProcessPool.Task = OperationTask
+    self.pool = ProcessPool()
+    self.pool.size = 2
+
+  def tearDown(self):
+    self.pool.close()
+    self.pool.join()
+    # close the workers' pipes
+    expires = time.time() + 5
+    while len(self.run_loop.readers) > 1 and time.time() < expires:
+      self.run_loop.runOnce()
+    ProcessPool.Task = self.task
+    if 'ProcessPool' in PooledOperation.__dict__:
+      del PooledOperation.ProcessPool
+    Task.log = self.log
+    if self.saved is None:
+      ThreadStorageService.delFromCurrent('RunLoop')
+    else:
+      ThreadStorageService.addToCurrent('RunLoop', self.saved)
+
+  def wait(self, *deferreds):
+    # runs the RunLoop until the deferreds fire, returns their results
+    results = {}
+    for i, deferred in enumerate(deferreds):
+      deferred.addBoth(lambda result, i=i: results.__setitem__(i, result))
+    expires = time.time() + 10
+    while len(results) < len(deferreds) and time.time() < expires:
+      self.run_loop.runOnce()
+    self.assertEqual(len(deferreds), len(results), "Deferred never fired")
+    return [results[i] for i in range(len(deferreds))]
+
+  def test_submit(self):
+    results = self.wait(*[self.pool.submit(square, x) for x in range(10)])
+    self.assertEqual([x * x for x in range(10)], results)
+    self.assertEqual(2, len(self.pool.workers))
+    self.assertEqual(10, self.pool.completed)
+
+  def test_errors(self):
+    failure, = self.wait(self.pool.submit(fail))
+    self.assert_(failure.check(ValueError))
+    self.assert_('failed' in failure.value.child_traceback)
+    # the worker carries on
+    self.assertEqual([4], self.wait(self.pool.submit(square, 2)))
+
+  def test_unpicklable(self):
+    failure, = self.wait(self.pool.submit(lambda: 1))
+    self.assert_(isinstance(failure.value, pickle.PicklingError))
+    # it never got as far as a worker
+    self.failIf(self.pool.workers)
+
+  def test_recycling(self):
+    self.pool.size = 1
+    self.pool.maxJobsPerWorker = 2
+    pids = self.wait(*[self.pool.submit(pid) for x in range(4)])
+    self.assertEqual(2, len(set(pids)))
+    self.assertEqual(2, self.pool.recycled)
+    self.pool.join()
+    self.failIf(self.pool.retired)
+
+  def test_crash(self):
+    self.pool.size = 1
+    failure, result = self.wait(self.pool.submit(crash),
+                                self.pool.submit(square, 3))
+    self.assert_(failure.check(WorkerDied))
+    self.assertEqual(9, result)
+    self.assertEqual(1, self.pool.crashes)
+
+  def test_join(self):
+    self.wait(*[self.pool.submit(square, x) for x in range(4)])
+    tasks = [worker.task for worker in self.pool.workers]
+    self.pool.close()
+    self.pool.join()
+    self.assertEqual([0, 0], [task.termination_status for task in tasks])
+    for task in tasks:
+      self.assertRaises(OSError, os.waitpid, task.process_id, os.WNOHANG)
+    self.failIf(self.pool.retired)
+
+  def test_operation(self):
+    PooledOperation.ProcessPool = self.pool
+    operation = PooledOperation.new(square, 5)
+    operation.start()
+    expires = time.time() + 10
+    while not operation.is_finished and time.time() < expires:
+      self.run_loop.runOnce()
+    self.assertEqual(25, operation.result)
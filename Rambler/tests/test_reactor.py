@@ -0,0 +1,76 @@
+import socket
+import unittest
+
+from Rambler.Reactor import Reactor
+
+
+class Echo(object):
+  def __init__(self):
+    self.closed = []
+
+  def onAccept(self, port):
+    port.read(1024)
+
+  def onRead(self, port, data):
+    port.write(data)
+    port.read(1024)
+
+  def onWrite(self, port, bytes):
+    pass
+
+  def onClose(self, port):
+    self.closed.append(port)
+
+
+class TestReactor(unittest.TestCase):
+
+  def setUp(self):
+    self.reactor = Reactor(('127.0.0.1', 0), Echo, loops=3)
+    self.reactor.start()
+
+  def tearDown(self):
+    self.reactor.stop(5)
+
+  def test_loops_share_an_address(self):
+    addresses = [w.port._socket.getsockname() for w in self.reactor.workers]
+    self.assertEqual(3, len(addresses))
+    self.assertEqual([self.reactor.address] * 3, addresses)
+
+  def test_echo_across_loops(self):
+    clients = []
+    for x in range(20):
+      client = socket.create_connection(self.reactor.address, 5)
+      client.sendall('ping %s' % x)
+      clients.append(client)
+
+    for x, client in enumerate(clients):
+      self.assertEqual('ping %s' % x, client.recv(1024))
+      client.close()
+
+    load = self.reactor.load()
+    self.assertEqual(20, sum([l['accepted'] for l in load]))
+
+  def test_stop(self):
+    workers = self.reactor.workers
+    self.reactor.stop(5)
+    for worker in workers:
+      self.failIf(worker.isAlive())
+    self.assertRaises(socket.error, socket.create_connection,
+                      self.reactor.address, 1)
+
+  def test_stop_closes_connections(self):
+    client = socket.create_connection(self.reactor.address, 5)
+    client.sendall('ping')
+    self.assertEqual('ping', client.recv(1024))
+    workers = self.reactor.workers
+    self.reactor.stop(5)
+    # the other end was closed rather than left open
+    self.assertEqual('', client.recv(1024))
+    client.close()
+
+    # and every delegate heard about it before the RunLoops stopped
+    closed = []
+    for worker in workers:
+      self.assert_(worker.port in worker.port.delegate.closed)
+      closed.extend(worker.port.delegate.closed)
+    self.assertEqual(4, len(closed))
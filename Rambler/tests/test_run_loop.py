@@ -0,0 +1,1001 @@
+import os
+import Queue
+import select
+import signal
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from Rambler.RunLoop import RunLoop, Stream, Port, SelectPoller, PollPoller, EPollPoller
+from Rambler.RunLoop import DelayedCall, TimingWheel, CallQueue, WriteBuffer
+from Rambler.RunLoop import DatagramPort
+from Rambler import syscalls
+from Rambler.ThreadStorageService import ThreadStorageService
+
+
+class Collector(object):
+  def __init__(self):
+    self.data = []
+    self.written = 0
+
+  def onRead(self, stream, data):
+    self.data.append(data)
+
+  def onWrite(self, stream, bytes):
+    self.written += bytes
+
+
+class RunLoopTestCase(unittest.TestCase):
+  # poller the run loop under test should use, None for the default
+  pollerClass = None
+
+  def setUp(self):
+    try:
+      self.saved = ThreadStorageService.getFromCurrent('RunLoop')
+    except KeyError:
+      self.saved = None
+
+    self.defaultPoller = RunLoop.pollerClass
+    if self.pollerClass:
+      RunLoop.pollerClass = self.pollerClass
+
+    self.run_loop = RunLoop()
+    ThreadStorageService.addToCurrent('RunLoop', self.run_loop)
+
+  def tearDown(self):
+    RunLoop.pollerClass = self.defaultPoller
+    if self.saved is None:
+      ThreadStorageService.delFromCurrent('RunLoop')
+    else:
+      ThreadStorageService.addToCurrent('RunLoop', self.saved)
+
+  def pipe(self):
+    reader, writer = os.pipe()
+    collector = Collector()
+    return Stream(reader, collector), Stream(writer, collector), collector
+
+  def connect(self, delegate=None):
+    # returns a connected Port and the socket on the other end
+    ours, theirs = socket.socketpair()
+    theirs.setblocking(0)
+    delegate = delegate or Receiver()
+    port = Port(None, delegate)
+    port.connectionAccepted(ours)
+    return port, theirs, delegate
+
+  def receive(self, sock, size):
+    received = []
+    while sum(map(len, received)) < size:
+      self.run_loop.runOnce()
+      try:
+        received.append(sock.recv(1 << 20))
+      except socket.error:
+        pass
+    return ''.join(received)
+
+
+class TestSelectPoller(RunLoopTestCase):
+  pollerClass = SelectPoller
+
+  def test_read(self):
+    reader, writer, collector = self.pipe()
+    reader.read(5)
+    writer.write('hello')
+    self.run_loop.runOnce()
+    self.run_loop.runOnce()
+    self.assertEqual(['hello'], collector.data)
+    reader.close()
+    writer.close()
+
+  def test_interest_is_synced_lazily(self):
+    reader, writer, collector = self.pipe()
+    reader.read(5)
+    self.assert_(reader.fileno() in self.run_loop._changed)
+    writer.write('hello')
+    self.run_loop.runOnce()
+    self.assertEqual(self.run_loop.readers.get(reader.fileno()), reader)
+    self.assertEqual(self.run_loop._interest[reader.fileno()][1], reader)
+
+    reader.close()
+    self.failIf(reader in [s for m, s in self.run_loop._interest.values()])
+    writer.close()
+
+  def test_persistent_reader(self):
+    reader, writer, collector = self.pipe()
+    reader.persistent = True
+    reader.read(2)
+    reader.read(2)
+    writer.write('hi')
+    self.run_loop.runOnce()
+    self.run_loop.runOnce()
+
+    # still registered with one read outstanding
+    self.assertEqual(['hi'], collector.data)
+    self.assert_(reader.fileno() in self.run_loop.persistentReaders)
+    self.assertEqual(reader, self.run_loop.readers[reader.fileno()])
+
+    writer.write('yo')
+    self.run_loop.runOnce()
+    self.run_loop.runOnce()
+    self.assertEqual(['hi', 'yo'], collector.data)
+    # nothing left to read so the stream unregisters itself
+    self.failIf(reader.fileno() in self.run_loop.readers)
+    self.failIf(reader.fileno() in self.run_loop.persistentReaders)
+    reader.close()
+    writer.close()
+
+  def test_wakeups_coalesce(self):
+    waker = self.run_loop.waker
+    # nobody needs waking while the loop is busy
+    self.run_loop.wakeup()
+    self.assertEqual(0, waker.sent)
+
+    waker.sleeping = True
+    for x in range(100):
+      self.run_loop.wakeup()
+    waker.sleeping = False
+    self.assertEqual(101, waker.requested)
+    self.assertEqual(1, waker.sent)
+
+    # the pending signal wakes the loop, which drains and rearms it
+    self.run_loop.waitBeforeCalling(5, lambda: None)
+    start = time.time()
+    self.run_loop.runOnce()
+    self.assert_(time.time() - start < 1)
+    self.failIf(waker.signaled)
+
+  def test_call_from_thread(self):
+    calls = []
+    def call():
+      calls.append(threading.currentThread())
+      self.run_loop.stop()
+    self.run_loop.waitBeforeCalling(5, lambda: None)
+    threading.Timer(.05, self.run_loop.callFromThread, (call,)).start()
+    start = time.time()
+    self.run_loop.run()
+    self.assert_(time.time() - start < 1)
+    self.assertEqual([threading.currentThread()], calls)
+
+  def test_after_fork(self):
+    reader, writer = os.pipe()
+    collector = Collector()
+    stream = Stream(reader, collector)
+    stream.read(5)
+    self.run_loop.callFromThread(len, '')
+    waker = self.run_loop.waker
+
+    pid = os.fork()
+    if pid == 0:
+      status = 1
+      try:
+        self.run_loop.afterFork()
+        if self.run_loop.waker is not waker and not self.run_loop.threadCallQueue:
+          self.run_loop.runOnce()
+          if collector.data == ['hello']:
+            status = 0
+      finally:
+        os._exit(status)
+
+    # the child services the stream we set up
+    os.write(writer, 'hello')
+    pid, status = os.waitpid(pid, 0)
+    self.assertEqual(0, status)
+    stream.close()
+    os.close(writer)
+
+
+class TestPollPoller(TestSelectPoller):
+  pollerClass = PollPoller
+
+
+if hasattr(select, 'epoll'):
+  class TestEPollPoller(TestSelectPoller):
+    pollerClass = EPollPoller
+
+    def test_beyond_fd_setsize(self):
+      # select() can't handle descriptors above FD_SETSIZE, epoll can
+      import resource
+      soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+      if hard != resource.RLIM_INFINITY and hard < 1100:
+        return
+      resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, 1100), hard))
+      try:
+        reader, writer = os.pipe()
+        high = os.dup2(reader, 1090) or 1090
+        os.close(reader)
+        collector = Collector()
+        stream = Stream(high, collector)
+        stream.read(2)
+        os.write(writer, 'hi')
+        self.run_loop.runOnce()
+        self.assertEqual(['hi'], collector.data)
+        stream.close()
+        os.close(writer)
+      finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+
+class TestCallQueue(RunLoopTestCase):
+
+  def test_full_queue_blocks_other_threads(self):
+    self.run_loop.threadCallQueue = CallQueue(2)
+    calls = []
+    def producer():
+      for x in range(10):
+        self.run_loop.callFromThread(calls.append, x)
+    t = threading.Thread(target=producer)
+    t.start()
+    while t.isAlive() or self.run_loop.threadCallQueue:
+      self.assert_(len(self.run_loop.threadCallQueue) <= 2)
+      self.run_loop.runOnce()
+    self.assertEqual(range(10), calls)
+    self.assertEqual(2, self.run_loop.threadCallQueue.highWater)
+    self.assertEqual(10, self.run_loop.threadCallQueue.latency.count)
+
+  def test_full_queue_raises(self):
+    self.run_loop.threadCallQueue = CallQueue(1, CallQueue.RAISE, owner=-1)
+    self.run_loop.callFromThread(len, '')
+    self.assertRaises(Queue.Full, self.run_loop.callFromThread, len, '')
+
+  def test_owner_is_never_refused(self):
+    self.run_loop.threadCallQueue = CallQueue(1, CallQueue.DROP)
+    self.assert_(self.run_loop.callFromThread(len, ''))
+    self.assert_(self.run_loop.callFromThread(len, ''))
+    self.assertEqual(0, self.run_loop.threadCallQueue.dropped)
+
+  def test_keyed_calls_coalesce(self):
+    calls = []
+    self.run_loop.callFromThreadOnce('key', calls.append, 1)
+    self.run_loop.callFromThreadOnce('key', calls.append, 2)
+    self.assertEqual(1, len(self.run_loop.threadCallQueue))
+    self.run_loop.runOnce()
+    self.assertEqual([1], calls)
+    # the key is forgotten once the call's made, or the queue's cleared
+    self.run_loop.callFromThreadOnce('key', calls.append, 3)
+    self.run_loop.threadCallQueue.clear()
+    self.run_loop.callFromThreadOnce('key', calls.append, 4)
+    self.run_loop.runOnce()
+    self.assertEqual([1, 4], calls)
+
+  def test_signal_while_locked(self):
+    # a signal handler calling callFromThread while the RunLoop's
+    # thread holds the queue's lock mustn't deadlock, fork so a hang
+    # can be killed
+    pid = os.fork()
+    if pid == 0:
+      try:
+        queue = self.run_loop.threadCallQueue = CallQueue(1)
+        signal.signal(signal.SIGUSR1,
+                      lambda signum, frame: self.run_loop.callFromThread(len, ''))
+        # the thread that drains the queue holds the lock while it
+        # wakes threads waiting for room
+        queue.waiting = 1
+        queue.notFull.acquire()
+        try:
+          os.kill(os.getpid(), signal.SIGUSR1)
+          os.kill(os.getpid(), signal.SIGUSR1)
+        finally:
+          queue.notFull.release()
+        queue.drain()
+        os._exit(len(queue))
+      except:
+        os._exit(255)
+
+    expires = time.time() + 5
+    while time.time() < expires:
+      done, status = os.waitpid(pid, os.WNOHANG)
+      if done:
+        break
+      time.sleep(0.01)
+    else:
+      os.kill(pid, signal.SIGKILL)
+      os.waitpid(pid, 0)
+      self.fail("callFromThread deadlocked in a signal handler")
+    self.assertEqual(0, os.WEXITSTATUS(status))
+
+  def test_untried_calls_are_requeued(self):
+    calls = []
+    def fail():
+      raise ValueError
+    self.run_loop.callFromThread(calls.append, 1)
+    self.run_loop.callFromThread(fail)
+    self.run_loop.callFromThread(calls.append, 1)
+    self.assertRaises(ValueError, self.run_loop.runOnce)
+    self.assertEqual([1], calls)
+    self.assertEqual(1, len(self.run_loop.threadCallQueue))
+    self.run_loop.runOnce()
+    self.assertEqual([1, 1], calls)
+
+
+class TestWriteBuffer(RunLoopTestCase):
+
+  def check_large_write(self):
+    reader, writer, collector = self.pipe()
+    chunks = ['%06d' % x for x in range(50000)]
+    for chunk in chunks:
+      writer.write(chunk)
+
+    # more than a pipe holds, so the writes come up short
+    received = []
+    while len(''.join(received)) < 300000:
+      self.run_loop.runOnce()
+      received.append(os.read(reader.fileno(), 1 << 20))
+
+    self.assertEqual(''.join(chunks), ''.join(received))
+    self.assertEqual(300000, collector.written)
+    self.assertEqual(0, len(writer.writeBuffer))
+    reader.close()
+    writer.close()
+
+  def test_large_write(self):
+    self.check_large_write()
+
+  def test_large_write_without_writev(self):
+    writev = syscalls.writev
+    syscalls.writev = None
+    try:
+      self.check_large_write()
+    finally:
+      syscalls.writev = writev
+
+  def test_writev_buffer_types(self):
+    if syscalls.writev is None:
+      return
+    r, w = os.pipe()
+    try:
+      chunks = ['hello', bytearray(' there'), memoryview(' big'),
+                buffer(' world')]
+      self.assertEqual(20, syscalls.writev(w, chunks, 1))
+      self.assertEqual('ello there big world', os.read(r, 100))
+    finally:
+      os.close(r)
+      os.close(w)
+
+  def test_consume(self):
+    buffer = WriteBuffer()
+    for chunk in ('abc', 'de', 'fgh'):
+      buffer.append(chunk)
+    buffer.consume(4)
+    # 'abc' is gone and we're one byte into 'de'
+    self.assertEqual(['de', 'fgh'], list(buffer.chunks))
+    self.assertEqual((1, 4), (buffer.offset, len(buffer)))
+    buffer.consume(4)
+    self.assertEqual([], list(buffer.chunks))
+    self.assertEqual((0, 0), (buffer.offset, len(buffer)))
+
+
+class Copier(Collector):
+  # keeps a copy of what a readInto port or stream hands it
+  def __init__(self):
+    Collector.__init__(self)
+    self.types = set()
+
+  def onAccept(self, port):
+    pass
+
+  def onRead(self, stream, data):
+    self.types.add(type(data))
+    self.data.append(data.tobytes())
+
+
+class TestReadInto(RunLoopTestCase):
+
+  def test_stream(self):
+    reader, writer = os.pipe()
+    copier = Copier()
+    stream = Stream(reader, copier)
+    stream.readInto = True
+    stream.read(3)
+    stream.read(100)
+    os.write(writer, 'abcdefgh')
+    self.run_loop.runOnce()
+    self.assertEqual(['abc', 'defgh'], copier.data)
+    self.assertEqual(set([memoryview]), copier.types)
+    # the same buffer served both reads
+    self.assertEqual(1, self.run_loop.buffers.allocated)
+    stream.close()
+    os.close(writer)
+
+  def test_stream_errors_release_buffer(self):
+    # FileIO raises IOError rather than OSError on python 2, reading
+    # the write end of a pipe fails with EBADF
+    reader, writer = os.pipe()
+    stream = Stream(writer, Copier())
+    stream.readInto = True
+    stream.readRequests.append(100)
+    try:
+      self.assertRaises(IOError, stream.canRead, stream)
+    finally:
+      os.close(reader)
+      os.close(writer)
+    self.assertEqual(1, len(self.run_loop.buffers.free))
+
+  def test_port(self):
+    ours, theirs = socket.socketpair()
+    copier = Copier()
+    port = Port(None, copier)
+    port.readInto = True
+    port.connectionAccepted(ours)
+    port.read(1024)
+    theirs.sendall('hello')
+    self.run_loop.runOnce()
+    self.assertEqual(['hello'], copier.data)
+    self.assertEqual(1, len(self.run_loop.buffers.free))
+    theirs.close()
+
+
+class Receiver(Collector):
+  def __init__(self):
+    Collector.__init__(self)
+    self.transferred = []
+
+  def onAccept(self, port):
+    pass
+
+  def onTransferred(self, port, transfer):
+    self.transferred.append(transfer)
+
+
+class TestTransfer(RunLoopTestCase):
+
+  def check_send_file(self):
+    contents = os.urandom(1 << 20)
+    f = tempfile.TemporaryFile()
+    f.write(contents)
+    f.flush()
+
+    port, theirs, receiver = self.connect()
+    port.write('head')
+    transfer = port.sendFile(f, 10, len(contents) - 20)
+    port.write('tail')
+
+    expected = 'head' + contents[10:-10] + 'tail'
+    self.assertEqual(expected, self.receive(theirs, len(expected)))
+    self.assertEqual([transfer], receiver.transferred)
+    self.assertEqual(len(contents) - 20, transfer.sent)
+    self.assertEqual(len(expected), receiver.written)
+    theirs.close()
+
+  def check_pipe_to(self):
+    reader, writer = os.pipe()
+    stream = Stream(reader, Collector())
+    port, theirs, receiver = self.connect()
+    transfer = stream.pipeTo(port)
+
+    os.write(writer, 'first')
+    self.assertEqual('first', self.receive(theirs, 5))
+    # nothing in the pipe, the transfer waits on it rather than the socket
+    self.assert_(transfer.starved)
+    self.assert_(transfer in self.run_loop.readers.values())
+    os.write(writer, 'second')
+    os.close(writer)
+    self.assertEqual('second', self.receive(theirs, 6))
+    while not receiver.transferred:
+      self.run_loop.runOnce()
+    self.assertEqual(11, transfer.sent)
+    stream.close()
+    theirs.close()
+
+  def without_syscalls(self, check):
+    saved = syscalls.sendfile, syscalls.splice
+    syscalls.sendfile = syscalls.splice = None
+    try:
+      check()
+    finally:
+      syscalls.sendfile, syscalls.splice = saved
+
+  def test_send_file(self):
+    self.check_send_file()
+
+  def test_send_file_without_sendfile(self):
+    self.without_syscalls(self.check_send_file)
+
+  def test_pipe_to(self):
+    self.check_pipe_to()
+
+  def test_pipe_to_without_splice(self):
+    self.without_syscalls(self.check_pipe_to)
+
+
+class Producer(Receiver):
+  def __init__(self):
+    Receiver.__init__(self)
+    self.events = []
+
+  def pauseProducing(self, port):
+    self.events.append('pause')
+
+  def resumeProducing(self, port):
+    self.events.append('resume')
+
+
+class TestFlowControl(RunLoopTestCase):
+
+  def connect(self):
+    port, theirs, producer = RunLoopTestCase.connect(self, Producer())
+    port.highWaterMark = 1000
+    port.lowWaterMark = 100
+    return port, theirs, producer
+
+  def test_watermarks(self):
+    port, theirs, producer = self.connect()
+    port.write('x' * 1000)
+    self.assertEqual([], producer.events)
+    port.write('x')
+    self.assertEqual(['pause'], producer.events)
+    port.write('x' * 1000)
+    self.assertEqual(['pause'], producer.events)
+
+    self.assertEqual(2001, len(self.receive(theirs, 2001)))
+    self.assertEqual(['pause', 'resume'], producer.events)
+    self.failIf(port.producerPaused)
+    theirs.close()
+
+  def test_pause_reading(self):
+    port, theirs, producer = self.connect()
+    port.read(10)
+    port.pauseReading()
+    self.failIf(port in self.run_loop.readers.values())
+    theirs.send('hello')
+    self.run_loop.runOnce()
+    self.assertEqual([], producer.data)
+
+    port.resumeReading()
+    self.run_loop.runOnce()
+    self.assertEqual(['hello'], producer.data)
+    theirs.close()
+
+
+class Acceptor(Receiver):
+  def __init__(self):
+    Receiver.__init__(self)
+    self.accepted = []
+
+  def onAccept(self, port):
+    self.accepted.append(port)
+
+  def onClose(self, port):
+    pass
+
+
+class TestAdmission(RunLoopTestCase):
+
+  def listen(self, maxConnections=None, rejectOverflow=False):
+    acceptor = Acceptor()
+    listener = Port(('127.0.0.1', 0), acceptor)
+    listener.maxConnections = maxConnections
+    listener.rejectOverflow = rejectOverflow
+    listener.listen(5)
+    clients = []
+    for x in range(3):
+      client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      client.connect(listener._socket.getsockname())
+      clients.append(client)
+    return listener, acceptor, clients
+
+  def test_max_connections(self):
+    listener, acceptor, clients = self.listen(maxConnections=2)
+    self.run_loop.runOnce()
+    self.assertEqual(2, len(acceptor.accepted))
+    self.assertEqual(2, listener.connections)
+    self.assert_(listener.overloaded)
+    self.failIf(listener in self.run_loop.readers.values())
+
+    # closing a connection makes room for the one left in the backlog
+    acceptor.accepted[0]._reset()
+    self.failIf(listener.overloaded)
+    self.run_loop.runOnce()
+    self.assertEqual(3, len(acceptor.accepted))
+    self.assertEqual(2, listener.connections)
+    listener.close()
+
+  def test_reject_overflow(self):
+    listener, acceptor, clients = self.listen(maxConnections=2,
+                                              rejectOverflow=True)
+    self.run_loop.runOnce()
+    self.assertEqual(2, len(acceptor.accepted))
+    self.assertEqual(1, listener.rejected)
+    self.failIf(listener.overloaded)
+    listener.close()
+
+  def test_accept_budget(self):
+    self.run_loop.acceptBudget = 1
+    listener, acceptor, clients = self.listen()
+    self.run_loop.runOnce()
+    self.assertEqual(1, len(acceptor.accepted))
+    self.run_loop.runOnce()
+    self.assertEqual(2, len(acceptor.accepted))
+    listener.close()
+
+  def test_adapt_batch(self):
+    port = Port(None, Receiver())
+    port._adaptAccepting(port.acceptBatch, False)
+    self.assertEqual(2 * Port.NUM_ACCEPT_AT_ONCE, port.acceptBatch)
+    port._adaptAccepting(1, True)
+    self.assertEqual(Port.NUM_ACCEPT_AT_ONCE, port.acceptBatch)
+
+
+class Sleeper(Receiver):
+  def __init__(self):
+    Receiver.__init__(self)
+    self.events = []
+
+  def onTimeOut(self, port):
+    self.events.append(port.timedOut)
+
+  def onClose(self, port):
+    self.events.append('close')
+
+
+class TestTimeouts(RunLoopTestCase):
+
+  def setUp(self):
+    RunLoopTestCase.setUp(self)
+    self.run_loop.sweeper.interval = .01
+
+  def connect(self, **timeouts):
+    port, theirs, sleeper = RunLoopTestCase.connect(self, Sleeper())
+    port._socket.setblocking(0)
+    port.setTimeouts(**timeouts)
+    return port, theirs, sleeper
+
+  def wait(self, port, limit=2):
+    expires = time.time() + limit
+    while port._socket is not None and time.time() < expires:
+      self.run_loop.runOnce()
+
+  def test_idle(self):
+    port, theirs, sleeper = self.connect(idle=.05)
+    self.assertEqual(1, len(self.run_loop.sweeper))
+    self.wait(port)
+    self.assertEqual(['idle', 'close'], sleeper.events)
+    self.assertEqual(0, len(self.run_loop.sweeper))
+    theirs.close()
+
+  def test_read(self):
+    # idle connections are fine, waiting on a read isn't
+    port, theirs, sleeper = self.connect(read=.05)
+    self.run_loop.sweeper.sweep()
+    port.lastWrite = port.lastRead = time.time() - 1
+    self.run_loop.sweeper.sweep()
+    self.assertEqual([], sleeper.events)
+
+    port.read(10)
+    self.wait(port)
+    self.assertEqual(['read', 'close'], sleeper.events)
+    theirs.close()
+
+  def test_read_request_isnt_activity(self):
+    # queueing a read doesn't keep an idle connection alive
+    port, theirs, sleeper = self.connect(idle=.05)
+    lastRead = port.lastWrite = port.lastRead = time.time() - 1
+    port.read(10)
+    self.assertEqual(lastRead, port.lastRead)
+    self.run_loop.sweeper.sweep()
+    self.assertEqual('idle', port.timedOut)
+    theirs.close()
+
+  def test_write(self):
+    port, theirs, sleeper = self.connect(write=.05)
+    # more than the socket buffers will hold, the other end never reads
+    port.write('x' * (8 << 20))
+    self.wait(port)
+    self.assertEqual(['write', 'close'], sleeper.events)
+    theirs.close()
+
+  def test_set_time_out(self):
+    port, theirs, sleeper = self.connect()
+    port.setTimeOut(60)
+    port.setTimeOut(.05)
+    port.setTimeOut(None)
+    port.setTimeOut(None)
+    self.assertEqual(None, port.deadline)
+    port.setTimeOut(.05)
+    self.wait(port)
+    self.assertEqual(['deadline', 'close'], sleeper.events)
+    theirs.close()
+
+  def test_remove_from_run_loop(self):
+    # a port taken off the RunLoop isn't swept, or timed out, there
+    port, theirs, sleeper = self.connect(idle=.05)
+    port.removeFromRunLoop(self.run_loop)
+    self.assertEqual(0, len(self.run_loop.sweeper))
+    port.lastWrite = port.lastRead = time.time() - 1
+    self.run_loop.sweeper.sweep()
+    self.assertEqual(None, port.timedOut)
+    # until it's handed back
+    port.setTimeouts(idle=.05)
+    self.assertEqual(1, len(self.run_loop.sweeper))
+    port._reset()
+    theirs.close()
+
+  def test_one_timer(self):
+    pairs = [self.connect(idle=60) for x in range(50)]
+    self.assertEqual(50, len(self.run_loop.sweeper))
+    self.assertEqual(1, len(self.run_loop.timers))
+    for port, theirs, sleeper in pairs:
+      port._reset()
+      theirs.close()
+    self.assertEqual(0, len(self.run_loop.sweeper))
+
+
+class TestBudgets(RunLoopTestCase):
+
+  def readable(self, count):
+    # returns a collector and count streams with data waiting
+    collector = Collector()
+    self.fds = []
+    for x in range(count):
+      reader, writer = os.pipe()
+      Stream(reader, collector).read(5)
+      os.write(writer, 'hello')
+      self.fds.extend([reader, writer])
+    return collector
+
+  def tearDown(self):
+    for fd in getattr(self, 'fds', []):
+      os.close(fd)
+    RunLoopTestCase.tearDown(self)
+
+  def test_event_batch(self):
+    self.run_loop.eventBatchSize = 1
+    collector = self.readable(3)
+    self.run_loop.runOnce()
+    self.assertEqual(1, len(collector.data))
+    self.assertEqual(2, len(self.run_loop.readyReads))
+
+    start = time.time()
+    self.run_loop.runOnce()
+    self.run_loop.runOnce()
+    self.assertEqual(3, len(collector.data))
+    self.assertEqual([], self.run_loop.readyReads)
+    self.assert_(time.time() - start < 1)
+
+  def test_timer_batch(self):
+    self.run_loop.timerBatchSize = 2
+    fired = []
+    for x in range(5):
+      self.run_loop.waitBeforeCalling(0, fired.append, x)
+    self.run_loop.runOnce()
+    self.assertEqual([0, 1], fired)
+    self.run_loop.runOnce()
+    self.run_loop.runOnce()
+    self.assertEqual(range(5), fired)
+    self.assertEqual(5, self.run_loop.timers.firedCount)
+
+  def test_call_time_slice(self):
+    self.run_loop.callTimeSlice = 0
+    calls = []
+    for x in range(3):
+      self.run_loop.callFromThread(calls.append, x)
+    self.run_loop.runOnce()
+    self.assertEqual([0], calls)
+    self.assertEqual(2, len(self.run_loop.threadCallQueue))
+    self.run_loop.runOnce()
+    self.run_loop.runOnce()
+    self.assertEqual([0, 1, 2], calls)
+
+  def test_lag(self):
+    self.run_loop.waitBeforeCalling(0, lambda: None)
+    time.sleep(.02)
+    self.run_loop.runOnce()
+    self.assertEqual(1, self.run_loop.lag.count)
+    self.assert_(self.run_loop.lag.max >= .02)
+
+
+class TestStats(RunLoopTestCase):
+
+  def test_disabled(self):
+    self.assertEqual(None, self.run_loop.stats)
+    stats = self.run_loop.enableStats()
+    self.assert_(self.run_loop.stats is stats)
+    self.run_loop.disableStats()
+    self.assertEqual(None, self.run_loop.stats)
+
+  def test_pass(self):
+    stats = self.run_loop.enableStats(slowCallback=60)
+    reader, writer, collector = self.pipe()
+    reader.read(5)
+    writer.write('hello')
+    self.run_loop.runOnce()
+    self.run_loop.runOnce()
+    self.assertEqual(['hello'], collector.data)
+    self.assertEqual(2, stats.passes)
+    self.assertEqual(2, stats.pollTime.count)
+    self.assertEqual(2, stats.callbackTime.count)
+    self.assertEqual(0, stats.slowCallbacks)
+    snapshot = stats.snapshot()
+    self.assertEqual(2, snapshot['descriptors']['count'])
+    reader.close()
+    writer.close()
+
+  def test_slow_callback(self):
+    stats = self.run_loop.enableStats(slowCallback=.01)
+    def dawdle():
+      time.sleep(.02)
+    self.run_loop.waitBeforeCalling(0, dawdle)
+    self.run_loop.runOnce()
+    self.assertEqual(1, stats.slowCallbacks)
+    self.assertEqual(1, stats.lag.count)
+    elapsed, kind, description, stack = stats.slowest[0]
+    self.assert_(elapsed >= .02)
+    self.assertEqual('timer', kind)
+    self.assert_(description.startswith('dawdle (%s' % __file__.rstrip('c')),
+                 description)
+    # dispatched from the pass that ran the timer
+    self.assert_('runOnce' in stack, stack)
+
+  def test_slow_callback_that_raises(self):
+    stats = self.run_loop.enableStats(slowCallback=.01)
+    def dawdle():
+      time.sleep(.02)
+      raise ValueError()
+    self.assertRaises(ValueError, stats.call, 'timer', dawdle)
+    elapsed, kind, description, stack = stats.slowest[0]
+    # the stack goes down to where it raised
+    self.assert_('raise ValueError()' in stack, stack)
+
+
+class Datagrams(object):
+  def __init__(self):
+    self.batches = []
+
+  def onDatagrams(self, port, datagrams):
+    self.batches.append(datagrams)
+
+
+class TestDatagramPort(RunLoopTestCase):
+
+  def bind(self, address=('127.0.0.1', 0)):
+    datagrams = Datagrams()
+    port = DatagramPort(address, datagrams)
+    port.bind()
+    return port, datagrams
+
+  def test_batched_receive(self):
+    port, datagrams = self.bind()
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for x in range(10):
+      sender.sendto(str(x), port.getAddress())
+    self.run_loop.runOnce()
+    self.assertEqual(1, len(datagrams.batches))
+    self.assertEqual([str(x) for x in range(10)],
+                     [data for data, address in datagrams.batches[0]])
+    self.assertEqual(sender.getsockname()[1], datagrams.batches[0][0][1][1])
+    self.assertEqual(10, port.received)
+    sender.close()
+    port.close()
+
+  def test_receive_budget(self):
+    port, datagrams = self.bind()
+    port.NUM_RECV_AT_ONCE = 4
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for x in range(10):
+      sender.sendto(str(x), port.getAddress())
+    for x in range(3):
+      self.run_loop.runOnce()
+    self.assertEqual([4, 4, 2], map(len, datagrams.batches))
+    sender.close()
+    port.close()
+
+  def test_unix(self):
+    path = tempfile.mktemp()
+    port, datagrams = self.bind(path)
+    sender = DatagramPort(None)
+    sender.sendTo('hello', path)
+    sender.sendTo('world', path)
+    self.run_loop.runOnce()
+    self.assertEqual(2, sender.sent)
+    self.assertEqual(0, len(self.run_loop.writers))
+    self.run_loop.runOnce()
+    self.assertEqual(['hello', 'world'],
+                     [data for data, address in datagrams.batches[0]])
+    sender.close()
+    port.close()
+    self.failIf(os.path.exists(path))
+
+  def test_queue_limit(self):
+    port, datagrams = self.bind()
+    sender = DatagramPort(port.getAddress())
+    sender.maxQueued = 2
+    sender.connect()
+    for data in 'abc':
+      sender.write(data)
+    self.assertEqual(1, sender.dropped)
+    self.run_loop.runOnce()
+    self.run_loop.runOnce()
+    self.assertEqual(['b', 'c'],
+                     [data for data, address in datagrams.batches[0]])
+    sender.close()
+    port.close()
+
+
+class TestTimingWheel(unittest.TestCase):
+
+  def timer(self, wheel, at):
+    call = DelayedCall(0, lambda: None)
+    call.time = at
+    return wheel.add(call)
+
+  def test_fires_in_order_across_levels(self):
+    wheel = TimingWheel(now=0)
+    # one timer on each of the first three levels and one further
+    # out than the wheel reaches
+    times = [700.5, 0.5, 3.25, 1.25, 3.25, 5e7]
+    timers = [self.timer(wheel, at) for at in times]
+    self.assertEqual(len(times), len(wheel))
+
+    fired = []
+    now = 0
+    while now + wheel.timeout(now) < 800:
+      now += wheel.timeout(now)
+      fired.extend(wheel.expire(now))
+      for timer in fired:
+        self.assert_(timer.time <= now)
+
+    self.assertEqual([0.5, 1.25, 3.25, 3.25, 700.5], [t.time for t in fired])
+    # timers with the same time fire in the order they were added
+    self.assert_(fired[2] is timers[2])
+    self.assertEqual(1, len(wheel))
+    self.assertEqual([timers[-1]], wheel.expire(5e7))
+
+  def test_timeout_sees_higher_levels(self):
+    wheel = TimingWheel(now=0)
+    # 3s out is past the first level, then the wheel moves on so a
+    # later timer lands on the first level
+    self.timer(wheel, 3.0)
+    self.assertEqual([], wheel.expire(2.5))
+    self.timer(wheel, 4.5)
+    self.assertAlmostEqual(0.5, wheel.timeout(2.5))
+
+  def test_cancel_and_push_back(self):
+    wheel = TimingWheel(now=0)
+    timers = [self.timer(wheel, 1 + x * .01) for x in range(1000)]
+    for timer in timers[::2]:
+      timer.cancel()
+    self.assertEqual(500, wheel.live)
+    self.assertEqual(500, wheel.cancelledCount)
+
+    timers[1].pushBack(10)
+    self.assertEqual(timers[3::2], wheel.expire(11))
+    self.assertEqual(1, wheel.live)
+    self.assertEqual([timers[1]], wheel.expire(12))
+    self.assertEqual(None, wheel.timeout(11))
+
+
+class TestDelayedCall(RunLoopTestCase):
+
+  def test_push_back_when_due(self):
+    # b is due in the same pass as the a that pushes it back
+    fired = []
+    b = self.run_loop.waitBeforeCalling(0, fired.append, 'b')
+    a = self.run_loop.waitBeforeCalling(0, lambda: b.pushBack(0.05))
+    # both timers are in the past, and a comes first
+    a.time = b.time - 1
+    self.run_loop.runOnce()
+    self.assertEqual([], fired)
+    self.assertEqual(1, len(self.run_loop.timers))
+    expires = time.time() + 2
+    while not fired and time.time() < expires:
+      self.run_loop.runOnce()
+    self.run_loop.runOnce()
+    self.assertEqual(['b'], fired)
+
+  def test_other_threads_hand_timers_over(self):
+    fired = []
+    thread = threading.Thread(target=self.run_loop.waitBeforeCalling,
+                              args=(0, fired.append, 'later'))
+    thread.start()
+    thread.join()
+    # queued as a call, the wheel is only touched by our thread
+    self.assertEqual(0, len(self.run_loop.timers))
+    self.assertEqual(1, len(self.run_loop.threadCallQueue))
+    self.run_loop.runOnce()
+    self.run_loop.runOnce()
+    self.assertEqual(['later'], fired)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,355 @@
+import errno
+import logging
+import os
+import signal
+import time
+import unittest
+
+from Rambler.RunLoop import RunLoop
+
+from Rambler.controllers.Operation import Operation
+from Rambler.controllers.Pipeline import Pipeline
+from Rambler.controllers.Task import Task, RingBuffer
+
+
+# the Operation base is only filled in once they're assembled
+
+class OperationTask(Task, Operation):
+  pass
+
+
+class OperationPipeline(Pipeline, Operation):
+  pass
+
+
+class TestCloseFds(unittest.TestCase):
+
+  def closed_in_child(self, fd_dir=None):
+    # closes the descriptors in a forked child, returning which of a
+    # kept and an unkept descriptor survived
+    read, write = os.pipe()
+    other = os.open('/dev/null', os.O_RDONLY)
+    pid = os.fork()
+    if pid == 0:
+      try:
+        task = Task()
+        if fd_dir is not None:
+          task.FD_DIR = fd_dir
+        task.add_fd(write)
+        task._close_fds()
+        survived = []
+        for fd in (read, other):
+          try:
+            os.fstat(fd)
+            survived.append(str(fd))
+          except OSError:
+            pass
+        os.write(write, ','.join(survived) or 'none')
+      finally:
+        os._exit(0)
+
+    os.close(write)
+    os.close(other)
+    try:
+      os.waitpid(pid, 0)
+      return os.read(read, 100)
+    finally:
+      os.close(read)
+
+  def test_open_fds(self):
+    fd = os.open('/dev/null', os.O_RDONLY)
+    try:
+      self.assert_(fd in Task()._open_fds())
+    finally:
+      os.close(fd)
+
+  def test_close_listed(self):
+    self.assertEqual('none', self.closed_in_child())
+
+  def test_close_range(self):
+    # without a FD_DIR the gaps between kept descriptors are closed
+    self.assertEqual('none', self.closed_in_child('/no/such/dir'))
+
+
+class Exits(object):
+  def __init__(self):
+    self.exited = []
+
+  def on_exit(self, task):
+    self.exited.append(task.termination_status)
+
+
+class TaskTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.log = Task.__dict__['log']
+    Task.log = logging.getLogger('Task')
+
+  def tearDown(self):
+    Task.log = self.log
+
+  def reap(self, task):
+    # Task's SIGCHLD handler may have beaten us to it
+    try:
+      os.waitpid(task.process_id, 0)
+    except OSError, e:
+      if e.errno != errno.ECHILD:
+        raise
+
+  def launch(self, *args):
+    task = OperationTask()
+    task.launch_path = '/bin/sh'
+    task.args = list(args)
+    task.launch()
+    task.stdin.close()
+    task.stdout.close()
+    task.stderr.close()
+    return task
+
+
+class TestLaunch(TaskTestCase):
+
+  def test_launch_time(self):
+    count = Task.launch_time.count
+    task = Task()
+    task.launch_path = '/bin/true'
+    task.launch()
+    try:
+      self.assertEqual(count + 1, Task.launch_time.count)
+    finally:
+      self.reap(task)
+      task.stdin.close()
+      task.stdout.close()
+      task.stderr.close()
+
+
+class TestReaping(TaskTestCase):
+
+  def setUp(self):
+    TaskTestCase.setUp(self)
+    # other tests can leave Task's SIGCHLD handler installed
+    self.main_run_loop = Task.__dict__.get('mainRunLoop')
+
+  def tearDown(self):
+    TaskTestCase.tearDown(self)
+    Task.mainRunLoop = self.main_run_loop
+
+  def wait_for_zombies(self, tasks):
+    expires = time.time() + 5
+    for task in tasks:
+      while time.time() < expires:
+        state = open('/proc/%s/stat' % task.process_id).read().split()[2]
+        if state == 'Z':
+          break
+        time.sleep(0.01)
+
+  def test_reaps_every_child(self):
+    exits = Exits()
+    tasks = [self.launch('-c', 'exit %s' % i) for i in range(10)]
+    for task in tasks:
+      task.delegate = exits
+    self.wait_for_zombies(tasks)
+
+    # the children's signals coalesced into one
+    Task.reap_child(signal.SIGCHLD, None)
+    self.assertEqual(range(10), sorted(exits.exited))
+    self.failIf([task for task in tasks if not task.is_finished])
+
+  def test_wait(self):
+    exits = Exits()
+    running = self.launch('-c', 'sleep 10')
+    try:
+      self.assertEqual(None, running.wait(0))
+    finally:
+      running.terminate()
+      self.assertEqual(-signal.SIGKILL, running.wait())
+
+    task = self.launch('-c', 'exit 5')
+    task.delegate = exits
+    self.assertEqual(5, task.wait())
+    # reaped as though the SIGCHLD handler had
+    self.assertEqual([5], exits.exited)
+    self.assertRaises(OSError, os.waitpid, task.process_id, os.WNOHANG)
+
+  def test_coalesces_signals(self):
+    run_loop = RunLoop()
+    Task.mainRunLoop = run_loop
+    Task.on_sig_child(signal.SIGCHLD, None)
+    Task.on_sig_child(signal.SIGCHLD, None)
+    self.assertEqual(1, len(run_loop.threadCallQueue))
+    run_loop.runOnce()
+    self.assertEqual(0, len(run_loop.threadCallQueue))
+    Task.on_sig_child(signal.SIGCHLD, None)
+    self.assertEqual(1, len(run_loop.threadCallQueue))
+
+  def test_reaps_after_reset(self):
+    run_loop = RunLoop()
+    Task.mainRunLoop = run_loop
+    # the queued reap is dropped when the loop's reset
+    Task.on_sig_child(signal.SIGCHLD, None)
+    run_loop.reset()
+
+    exits = Exits()
+    task = self.launch('-c', 'exit 3')
+    task.delegate = exits
+    self.wait_for_zombies([task])
+    Task.on_sig_child(signal.SIGCHLD, None)
+    self.assertEqual(1, len(run_loop.threadCallQueue))
+    run_loop.runOnce()
+    self.assertEqual([3], exits.exited)
+
+
+class Output(Exits):
+  def __init__(self):
+    Exits.__init__(self)
+    self.stdout = []
+    self.stderr = []
+
+  def on_stdout(self, pipeline, data):
+    self.stdout.append(data)
+
+  def on_stderr(self, pipeline, data):
+    self.stderr.append(data)
+
+  def on_stdin(self, pipeline, bytes):
+    pass
+
+  def on_close(self, pipeline, stream):
+    pass
+
+
+class TestPipeline(TaskTestCase):
+
+  def task(self, command):
+    task = OperationTask()
+    task.launch_path = '/bin/sh'
+    task.args = ['-c', command]
+    return task
+
+  def start(self, *commands):
+    self.output = Output()
+    pipeline = OperationPipeline.new(*[self.task(c) for c in commands])
+    pipeline.delegate = self.output
+    pipeline.start()
+    return pipeline
+
+  def wait(self, pipeline):
+    # there's no SIGCHLD handler installed, reap the children ourselves
+    run_loop = RunLoop.currentRunLoop()
+    expires = time.time() + 5
+    # the children can exit before we've read everything they wrote
+    while time.time() < expires:
+      if len(run_loop.readers) > 1:
+        run_loop.runOnce()
+      else:
+        if pipeline.is_finished:
+          break
+        Task.reap_child(signal.SIGCHLD, None)
+        time.sleep(0.01)
+
+  def run_pipeline(self, *commands):
+    pipeline = self.start(*commands)
+    self.wait(pipeline)
+    return pipeline
+
+  def test_pipeline(self):
+    pipeline = self.run_pipeline('printf "b\\na\\nc\\n"', 'sort', 'tr a-z A-Z')
+    self.assertEqual('A\nB\nC\n', ''.join(self.output.stdout))
+    self.assertEqual([0, 0, 0], pipeline.termination_statuses)
+    self.assertEqual(0, pipeline.result)
+    self.assertEqual([0], self.output.exited)
+    # the data between the Tasks never came through the RunLoop
+    self.assertEqual([None, None], [t.stdout for t in pipeline.tasks[:-1]])
+    self.assertEqual([None, None], [t.stdin for t in pipeline.tasks[1:]])
+
+  def test_failures(self):
+    pipeline = self.run_pipeline('echo oops >&2; exit 3', 'cat')
+    self.assertEqual([3, 0], pipeline.termination_statuses)
+    self.assertEqual(3, pipeline.termination_status)
+    self.assertEqual('oops\n', ''.join(self.output.stderr))
+
+  def test_launch_failure(self):
+    tasks = [self.task(c) for c in ('sleep 5', 'cat', 'cat')]
+    def fail():
+      raise OSError(errno.EAGAIN, 'fork failed')
+    tasks[1].launch = fail
+    pipeline = OperationPipeline.new(*tasks)
+    before = set(os.listdir('/proc/self/fd'))
+    self.assertRaises(OSError, pipeline.launch)
+    # the pipes around the Task that failed were closed, only the
+    # first Task's stdin and stderr are left open
+    opened = set(os.listdir('/proc/self/fd')) - before
+    self.assertEqual(set([str(tasks[0].stdin.fd), str(tasks[0].stderr.fd)]),
+                     opened)
+    # and the Task already running was killed
+    self.assertEqual(-signal.SIGKILL, tasks[0].wait(5))
+    self.assertEqual(None, tasks[2].process_id)
+    tasks[0].stdin.close()
+    tasks[0].stderr.close()
+
+  def test_write(self):
+    pipeline = self.start('cat', 'wc -c')
+    # only the first Task's stdin is ours
+    self.assertRaises(RuntimeError, pipeline.tasks[1].write, 'hello')
+    pipeline.write('hello')
+    pipeline.close()
+    self.wait(pipeline)
+    self.assertEqual('5', ''.join(self.output.stdout).strip())
+
+
+class TestRingBuffer(unittest.TestCase):
+
+  def test_wraps(self):
+    ring = RingBuffer(5)
+    for piece in ('ab', 'cd', 'ef', 'g'):
+      ring.write(piece)
+    self.assertEqual('cdefg', ring.getvalue())
+    self.assert_(ring.truncated)
+
+  def test_large_write(self):
+    ring = RingBuffer(4)
+    ring.write('a')
+    ring.write('123456')
+    self.assertEqual('3456', ring.getvalue())
+    ring.write('7')
+    self.assertEqual('4567', ring.getvalue())
+
+  def test_fits(self):
+    ring = RingBuffer(4)
+    ring.write('1234')
+    self.assertEqual(('1234', False), (ring.getvalue(), ring.truncated))
+
+
+class TestOutput(TaskTestCase):
+
+  def test_read_sizes(self):
+    task = Task()
+    stream = object()
+    sizes = [task.next_read_size(stream, count)
+             for count in (8192, 16384, 32768, 100, 100)]
+    self.assertEqual([16384, 32768, 65536, 32768, 16384], sizes)
+    task.read_sizes[stream] = task.max_byte_size
+    self.assertEqual(task.max_byte_size,
+                     task.next_read_size(stream, task.max_byte_size))
+
+  def test_capture(self):
+    task = OperationTask()
+    task.capture_limit = 1000
+    task.delegate = Output()
+    task.launch_path = '/bin/sh'
+    task.args = ['-c', 'yes 2>/dev/null | head -c 100000; echo done >&2']
+    task.launch()
+    task.close()
+
+    run_loop = RunLoop.currentRunLoop()
+    expires = time.time() + 5
+    while len(run_loop.readers) > 1 and time.time() < expires:
+      run_loop.runOnce()
+    self.reap(task)
+
+    self.assertEqual(100000, task.stdout_bytes)
+    self.assertEqual('y\n' * 500, task.stdout_capture.getvalue())
+    self.assert_(task.stdout_capture.truncated)
+    self.assertEqual(('done\n', False), (task.stderr_capture.getvalue(),
+                                         task.stderr_capture.truncated))
+    self.assert_(task.reads)
@@ -0,0 +1,72 @@
+import thread
+import time
+import unittest
+
+from Rambler.RunLoop import RunLoop
+from Rambler.Watchdog import Watchdog
+
+
+class TestWatchdog(unittest.TestCase):
+
+  def setUp(self):
+    self.run_loop = RunLoop()
+    self.watchdog = Watchdog(threshold=.05)
+    self.watchdog.watch(self.run_loop, thread.get_ident())
+
+  def test_stall(self):
+    # as if we were in the middle of a pass
+    self.run_loop.active = True
+    now = time.time()
+    self.watchdog.check(now)
+    self.assertEqual(0, self.watchdog.stalls)
+
+    # no progress since we started watching
+    self.watchdog.check(now + .1)
+    self.watchdog.check(now + .2)
+    self.assertEqual(1, self.watchdog.stalls)
+    self.assertEqual(1, self.watchdog.stallsFor(self.run_loop))
+    threadId, seconds, stack = self.watchdog.reports[0]
+    self.assertEqual(thread.get_ident(), threadId)
+    self.assert_('in test_stall' in stack, stack)
+
+    # a new pass is a new chance to stall
+    self.run_loop.progress += 1
+    self.watchdog.check(now + .3)
+    self.watchdog.check(now + .4)
+    self.assertEqual(2, self.watchdog.stalls)
+
+  def test_sleeping(self):
+    self.run_loop.active = True
+    self.run_loop.waker.sleeping = True
+    self.watchdog.check(time.time() + 10)
+    self.assertEqual(0, self.watchdog.stalls)
+
+  def test_not_running(self):
+    # watched before it's run
+    now = time.time()
+    self.watchdog.check(now)
+    self.watchdog.check(now + 10)
+    self.assertEqual(0, self.watchdog.stalls)
+
+    # and after it's stopped
+    self.run_loop.waitBeforeCalling(0, lambda: None)
+    self.run_loop.runOnce()
+    self.failIf(self.run_loop.active)
+    self.watchdog.check(now + 20)
+    self.watchdog.check(now + 30)
+    self.assertEqual(0, self.watchdog.stalls)
+
+  def test_blocking_callback(self):
+    def dawdle():
+      time.sleep(.3)
+    self.run_loop.waitBeforeCalling(0, dawdle)
+    self.watchdog.start()
+    try:
+      self.run_loop.runOnce()
+    finally:
+      self.watchdog.stop()
+
+    self.assertEqual(1, self.watchdog.stalls)
+    threadId, seconds, stack = self.watchdog.reports[0]
+    self.assert_('in dawdle' in stack, stack)
+    self.assert_('in runOnce' in stack, stack)